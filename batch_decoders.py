@@ -0,0 +1,597 @@
+'''
+Decoders of heavy-hex circuits behind one batched interface
+
+Every decoder here decodes bit-packed detection events with the
+decode_batch method of pymatching.Matching,
+
+    decode_batch(shots, *, bit_packed_shots=False, bit_packed_predictions=False)
+
+so any of them can be passed as the matching of decoders.sample_and_decode,
+decoders.decode_chunks or rare_events.estimate_logical_error_rate, like a
+pymatching.Matching or a flag_decoding.FlagAwareDecoder. The decoders are
+known by name:
+
+pymatching  pymatching.Matching -- minimum weight perfect matching
+union_find  UnionFindDecoder -- weighted union-find with peeling, in NumPy.
+            Slower and less accurate than matching: 5x to 9x its time per
+            shot and 1.2x to 1.8x its logical error rate at p=1e-3
+bposd       BpOsdDecoder -- belief propagation with ordered statistics
+            decoding, from the optional ldpc package
+lookup      lookup_decoder.LookupTableDecoder -- a table of the syndromes of
+            a few faults, and pymatching for the others. For d=3 and d=5
+
+compile_decoder builds one of them for a circuit, and sinter_decoders makes
+them available to sinter.collect, and so to sweep.
+
+Example:
+
+    from heavy_hex_code import HeavyHexCode
+    from batch_decoders import compile_decoder, sinter_decoders
+    from decoders import sample_and_decode
+
+    circuit=HeavyHexCode(code_distance=5, num_rounds=5, basis='Z', ...).create_heavy_hex_code(backend='stim')
+    stats=sample_and_decode(circuit, shots=10**6, matching=compile_decoder(circuit, 'union_find'))
+
+    stats=heavy_hex_code.sweep([3, 5, 7], ps, decoders=['union_find'], custom_decoders=sinter_decoders())
+'''
+import importlib.util
+
+import numpy as np
+import pymatching
+import scipy.sparse
+import stim
+
+from decoders import compile_matching
+from dem_cache import build_detector_error_model, matching_to_arrays
+
+DECODERS=('pymatching', 'union_find', 'bposd', 'lookup')
+DEFAULT_BLOCK_SIZE=1024
+
+
+class BatchDecoder:
+    '''
+    Base class of the decoders of a detector error model
+
+    Subclasses implement _decode_packed, which maps bit-packed detection
+    events to bit-packed observable predictions. decode_shots_bit_packed
+    makes every decoder a sinter.CompiledDecoder as well
+    '''
+    # whether the decoder wants the detector error model with its errors decomposed into edges
+    decompose_errors=True
+
+    def __init__(self, detector_error_model):
+        self.num_detectors=detector_error_model.num_detectors
+        self.num_observables=detector_error_model.num_observables
+
+    @classmethod
+    def from_circuit(cls, circuit, *, dem_cache=None, **kwargs):
+        '''
+        Builds the decoder of a stim.Circuit
+
+        Args:
+        circuit: The stim.Circuit
+        dem_cache: A dem_cache.DemCache to take the detector error model from
+        kwargs: Passed on to the constructor
+        '''
+        if not isinstance(circuit, stim.Circuit):
+            circuit=stim.Circuit(circuit)
+        if dem_cache is not None:
+            dem=dem_cache.detector_error_model(circuit, decompose_errors=cls.decompose_errors)
+        else:
+            dem=build_detector_error_model(circuit, decompose_errors=cls.decompose_errors)
+        return cls(dem, **kwargs)
+
+    def decode_batch(self, shots, *, bit_packed_shots=False, bit_packed_predictions=False):
+        '''
+        Decodes a batch of shots, like pymatching.Matching.decode_batch
+
+        Args:
+        shots: The detection events, (shots, num_detectors) booleans or, with
+        bit_packed_shots, (shots, ceil(num_detectors/8)) bit-packed uint8
+        bit_packed_shots: Whether the shots are bit-packed (little endian)
+        bit_packed_predictions: Return the predicted observables bit-packed
+        '''
+        shots=np.asarray(shots)
+        if not bit_packed_shots:
+            shots=np.packbits(shots.astype(bool), axis=1, bitorder='little')
+        predictions=self._decode_packed(shots.astype(np.uint8, copy=False))
+        if bit_packed_predictions:
+            return predictions
+        return np.unpackbits(predictions, axis=1, count=self.num_observables, bitorder='little')
+
+    def decode_shots_bit_packed(self, *, bit_packed_detection_event_data):
+        '''
+        The sinter.CompiledDecoder interface
+        '''
+        return self._decode_packed(bit_packed_detection_event_data)
+
+    def _decode_packed(self, shots):
+        raise NotImplementedError
+
+
+class UnionFindDecoder(BatchDecoder):
+    '''
+    Weighted union-find decoding (Delfosse and Nickerson - arxiv 1709.06218)
+    of the matching graph, vectorized over the shots of a batch
+
+    The clusters of every shot start at its detection events and grow in
+    steps along the edges of the graph. An edge is grown once the clusters at
+    its ends have covered its weight, and a cluster stops growing when it
+    has an even number of detection events or reaches the boundary. Edge
+    weights are rounded to whole growth steps, the lightest edge taking 2
+    steps (the half edges of the paper) and no edge more than
+    2*max_weight_ratio.
+
+    A cluster whose detection events are those of one error mechanism of the
+    detector error model is corrected by that mechanism, the others by
+    peeling a spanning forest of their grown edges. Peeling alone gets many
+    single faults wrong: the decomposed errors of the heavy-hex circuits flip
+    three or four detectors next to the boundary, and the cluster they grow
+    is peeled into boundary edges. A shot whose detection events are those
+    of one mechanism is corrected without growing anything.
+
+    The state of a block of block_size shots is kept for the nodes and edges
+    their clusters reach only, so the cost follows the number of detection
+    events, not the size of the graph. It is still slower than pymatching
+    and less accurate. At p=1e-3 (Z basis, d rounds) it takes 5.2 us a shot
+    at d=5 against 0.9 us, and 312 us at d=15 against 37 us, with 1.2x to
+    1.8x the logical error rate. At d=5 and p=1e-4, where nearly every shot
+    is one mechanism or none, the time is the same and the logical error
+    rate 1.4x. See benchmarks/bench_decoders.py
+    '''
+
+    def __init__(self, detector_error_model, *, weighted=True, max_weight_ratio=4, block_size=DEFAULT_BLOCK_SIZE):
+        '''
+        Args:
+        detector_error_model: The stim.DetectorErrorModel, with decomposed errors
+        weighted: Grow the edges in proportion to their weights, or all at the same speed
+        max_weight_ratio: Edges heavier than this many times the lightest edge grow as if they were not
+        block_size: Shots decoded together
+        '''
+        super().__init__(detector_error_model)
+        self.block_size=block_size
+        arrays=matching_to_arrays(pymatching.Matching.from_detector_error_model(detector_error_model))
+
+        # node 0 is the boundary and detector k is node k+1
+        self._u=arrays['u']+1
+        self._v=np.where(arrays['v']<0, 0, arrays['v']+1)
+        weights=arrays['weights']
+        if weighted and len(weights):
+            weights=np.where(np.isfinite(weights), weights, np.inf)
+            lightest=max(weights.min(), 1e-9)
+            steps=np.clip(np.rint(2*weights/lightest), 2, 2*max_weight_ratio)
+        else:
+            steps=np.full(len(weights), 2)
+        self._steps=steps.astype(np.int32)
+        # the edges of node n are _node_edges[_edge_ptr[n]:_edge_ptr[n+1]]
+        ends=np.concatenate([self._u, self._v])
+        order=np.argsort(ends, kind='stable')
+        self._node_edges=np.concatenate([np.arange(len(self._u))]*2)[order]
+        self._edge_ptr=np.searchsorted(ends[order], np.arange(self.num_detectors+2))
+
+        observable_bits=np.zeros((len(weights), max(self.num_observables, 1)), dtype=bool)
+        edges=np.repeat(np.arange(len(weights)), np.diff(arrays['fault_ptr']))
+        observable_bits[edges, arrays['fault_ids']]=True
+        self._observables=np.packbits(observable_bits[:, :self.num_observables], axis=1, bitorder='little')
+
+        # a set of detection events is known by the XOR of the random hashes of its nodes
+        self._node_hashes=np.random.default_rng(0).integers(1, 2**63, size=self.num_detectors+1, dtype=np.int64)
+        self._node_hashes[0]=0
+        self._mechanisms=_mechanism_table(detector_error_model, self._node_hashes)
+
+    @property
+    def num_edges(self):
+        return len(self._steps)
+
+    def _decode_packed(self, shots):
+        predictions=np.zeros((len(shots), self._observables.shape[1]), dtype=np.uint8)
+        rows, nodes=_detection_events(shots, self.num_detectors)
+        shot_rows, starts, counts=np.unique(rows, return_index=True, return_counts=True)
+        if not len(shot_rows):
+            return predictions
+
+        # the shots whose detection events are those of one error mechanism
+        found, observables=self._lookup(np.bitwise_xor.reduceat(self._node_hashes[nodes], starts), counts)
+        predictions[shot_rows[found]]=observables[found]
+        left=np.repeat(~found, counts)
+        rows, nodes=rows[left], nodes[left]
+        shot_rows=shot_rows[~found]
+
+        block_starts=np.searchsorted(rows, shot_rows[::self.block_size])
+        for k, (start, stop) in enumerate(zip(block_starts, list(block_starts[1:])+[len(rows)])):
+            block=shot_rows[k*self.block_size:(k+1)*self.block_size]
+            predictions[block]=self._decode_block(np.searchsorted(block, rows[start:stop]), nodes[start:stop], len(block))
+        return predictions
+
+    # internals
+    def _lookup(self, hashes, sizes):
+        '''
+        Whether the detection events of the given hashes and sizes are those of
+        an error mechanism, and the bit-packed observables it flips
+        '''
+        table_hashes, table_sizes, table_observables=self._mechanisms
+        index=np.minimum(np.searchsorted(table_hashes, hashes), len(table_hashes)-1)
+        found=(table_hashes[index]==hashes)&(table_sizes[index]==sizes)
+        return found, table_observables[index]
+
+    def _decode_block(self, rows, nodes, num_shots):
+        '''
+        The bit-packed predictions of a block of shots, from the (row, node)
+        of their detection events
+
+        The nodes the clusters reach are items: item k is node item_nodes[k]
+        of shot item_rows[k], and parents[k] leads to the root of its
+        cluster, the item of the cluster reached first
+        '''
+        num_nodes=self.num_detectors+1
+        num_edges=self.num_edges
+        item_rows=rows.astype(np.int64)
+        item_nodes=nodes.astype(np.int64)
+        items=_KeyIndex(item_rows*num_nodes+item_nodes)
+        parents=np.arange(len(item_rows))
+        num_defects=len(item_rows) # the detection events are the first items
+        # the edges the clusters reach, and how far they have grown
+        edge_index=_KeyIndex(np.zeros(0, dtype=np.int64))
+        support=np.zeros(0, dtype=np.int32)
+        grown=np.zeros(0, dtype=bool)
+        forest=[]
+
+        while True:
+            # the clusters with an odd number of detection events that have not reached the boundary
+            roots=_find(parents, np.arange(len(parents)))
+            odd=np.bincount(roots[:num_defects], minlength=len(parents))&1
+            odd[roots[item_nodes==0]]=0
+            active=np.flatnonzero(odd[roots]==1)
+            if not len(active):
+                break
+
+            # every active node grows its edges by one step, an edge grown from both ends twice
+            starts=self._edge_ptr[item_nodes[active]]
+            counts=self._edge_ptr[item_nodes[active]+1]-starts
+            keys, counts=np.unique(np.repeat(item_rows[active], counts)*num_edges
+                                   +self._node_edges[_ranges(starts, counts)], return_counts=True)
+            positions=edge_index.find(keys)
+            new=positions<0
+            if new.any():
+                positions[new]=edge_index.add(keys[new])
+                support=np.concatenate([support, np.zeros(new.sum(), dtype=np.int32)])
+                grown=np.concatenate([grown, np.zeros(new.sum(), dtype=bool)])
+            growing=~grown[positions]
+            if not growing.any():
+                break
+            positions=positions[growing]
+            support[positions]+=counts[growing].astype(np.int32)
+            done=positions[support[positions]>=self._steps[edge_index.keys[positions]%num_edges]]
+            if not len(done):
+                continue
+            grown[done]=True
+
+            # the ends of the grown edges join the clusters. Every boundary
+            # edge ends on a boundary item of its own (keyed by -1-edge), so
+            # that clusters do not merge through the boundary
+            edge_rows=edge_index.keys[done]//num_edges
+            edges=edge_index.keys[done]%num_edges
+            end_rows=np.concatenate([edge_rows, edge_rows])
+            end_nodes=np.concatenate([self._u[edges], self._v[edges]])
+            ends=np.where(end_nodes==0, -1-np.concatenate([done, done]), end_rows*num_nodes+end_nodes)
+            positions=items.find(ends)
+            if (positions<0).any():
+                reached, first=np.unique(ends[positions<0], return_index=True)
+                items.add(reached)
+                item_rows=np.concatenate([item_rows, end_rows[positions<0][first]])
+                item_nodes=np.concatenate([item_nodes, end_nodes[positions<0][first]])
+                parents=np.concatenate([parents, np.arange(len(parents), len(parents)+len(reached))])
+                positions=items.find(ends)
+            # the edges that merged two clusters make up the spanning forest that is peeled
+            merged=_union(parents, positions[:len(done)], positions[len(done):])
+            forest.append((done[merged], positions[:len(done)][merged], positions[len(done):][merged]))
+
+        predictions=np.zeros((num_shots, self._observables.shape[1]), dtype=np.uint8)
+        roots=_find(parents, np.arange(len(parents)))
+        syndromes=np.zeros(len(parents), dtype=np.uint8)
+        syndromes[:num_defects]=1
+
+        # the clusters whose detection events are those of an error mechanism
+        order=np.argsort(roots[:num_defects], kind='stable')
+        cluster_roots, starts, counts=np.unique(roots[:num_defects][order], return_index=True, return_counts=True)
+        found, observables=self._lookup(np.bitwise_xor.reduceat(self._node_hashes[item_nodes[:num_defects][order]], starts),
+                                        counts)
+        np.bitwise_xor.at(predictions, item_rows[cluster_roots[found]], observables[found])
+        solved=np.zeros(len(parents), dtype=bool)
+        solved[cluster_roots[found]]=True
+        syndromes[solved[roots]]=0
+
+        if forest:
+            edges, u, v=(np.concatenate(parts) for parts in zip(*forest))
+            left=~solved[roots[u]]
+            self._peel(predictions, syndromes, roots, item_rows, item_nodes,
+                       edge_index.keys[edges[left]]%num_edges, u[left], v[left])
+        return predictions
+
+    def _peel(self, predictions, syndromes, roots, item_rows, item_nodes, edges, u, v):
+        '''
+        Peels the spanning forest of the edges between items u and v, from
+        the leaves up. A tree is rooted at its boundary items if its cluster
+        reached the boundary, else at the root of the cluster
+        '''
+        depth=np.full(len(roots), -1, dtype=np.int32)
+        boundary=item_nodes==0
+        depth[boundary]=0
+        reached_boundary=np.zeros(len(roots), dtype=bool)
+        reached_boundary[roots[boundary]]=True
+        own_root=roots==np.arange(len(roots))
+        depth[own_root&~reached_boundary]=0
+        # breadth-first search from the roots, over the edges of the forest
+        levels=[]
+        level=0
+        while len(edges):
+            step_u=(depth[u]==level)&(depth[v]<0)
+            step_v=(depth[v]==level)&(depth[u]<0)
+            if not (step_u.any() or step_v.any()):
+                break
+            # an item reached from two roots at once keeps one of its edges
+            reached_items, first=np.unique(np.concatenate([v[step_u], u[step_v]]), return_index=True)
+            depth[reached_items]=level+1
+            levels.append((reached_items, np.concatenate([u[step_u], v[step_v]])[first],
+                           np.concatenate([edges[step_u], edges[step_v]])[first]))
+            pending=~(step_u|step_v)
+            edges, u, v=edges[pending], u[pending], v[pending]
+            level+=1
+
+        for reached_items, parents, edges in reversed(levels):
+            flip=syndromes[reached_items]==1
+            np.bitwise_xor.at(predictions, item_rows[reached_items[flip]], self._observables[edges[flip]])
+            np.bitwise_xor.at(syndromes, parents[flip], 1)
+            syndromes[reached_items[flip]]=0
+
+
+class BpOsdDecoder(BatchDecoder):
+    '''
+    Belief propagation with ordered statistics decoding of the error
+    mechanisms of the undecomposed detector error model, with the ldpc
+    package (pip install ldpc). Shots are decoded one at a time by ldpc
+    '''
+    decompose_errors=False
+
+    def __init__(self, detector_error_model, *, max_iter=20, bp_method='minimum_sum', osd_method='osd_cs', osd_order=6):
+        '''
+        Args:
+        detector_error_model: The stim.DetectorErrorModel
+        max_iter: Belief propagation iterations
+        bp_method: 'product_sum' or 'minimum_sum'
+        osd_method: 'osd_0', 'osd_e' or 'osd_cs'
+        osd_order: Order of the ordered statistics decoding
+        '''
+        try:
+            import ldpc
+        except ImportError as error:
+            raise ImportError("BpOsdDecoder needs the ldpc package (pip install ldpc)") from error
+        super().__init__(detector_error_model)
+        self.options=dict(max_iter=max_iter, bp_method=bp_method, osd_method=osd_method, osd_order=osd_order)
+        check_matrix, self._observable_matrix, priors=dem_matrices(detector_error_model)
+        self._decoder=ldpc.BpOsdDecoder(
+            check_matrix,
+            error_channel=list(priors),
+            max_iter=max_iter,
+            bp_method=bp_method,
+            osd_method=osd_method,
+            osd_order=osd_order,
+        )
+
+    def _decode_packed(self, shots):
+        num_mechanisms=self._observable_matrix.shape[1]
+        nontrivial=np.flatnonzero(shots.any(axis=1))
+        syndromes=np.unpackbits(shots[nontrivial], axis=1, count=self.num_detectors, bitorder='little')
+        corrections=np.zeros((len(nontrivial), num_mechanisms), dtype=np.uint8)
+        for k, syndrome in enumerate(syndromes):
+            corrections[k]=self._decoder.decode(syndrome)
+        flips=np.zeros((len(shots), self.num_observables), dtype=np.uint8)
+        flips[nontrivial]=(self._observable_matrix@corrections.T).T%2
+        return np.packbits(flips, axis=1, bitorder='little')
+
+
+class SinterDecoder:
+    '''
+    A decoder of this module as a sinter.Decoder, for the custom_decoders of
+    sinter.collect. Picklable, so it reaches the sinter workers
+    '''
+
+    def __init__(self, name, **options):
+        '''
+        Args:
+        name: 'union_find', 'bposd' or 'lookup'
+        options: Passed on to the constructor of the decoder
+        '''
+        if name not in DECODERS or name=='pymatching':
+            raise ValueError(f"Unknown decoder {name!r}")
+        self.name=name
+        self.options=options
+
+    def compile_decoder_for_dem(self, *, dem):
+        return _decoder_class(self.name)(dem, **self.options)
+
+
+def compile_decoder(circuit, decoder='pymatching', *, dem_cache=None, **options):
+    '''
+    Returns a decoder of the circuit, with the decode_batch of pymatching.Matching
+
+    Args:
+    circuit: The stim.Circuit
+    decoder: One of DECODERS
+    dem_cache: A dem_cache.DemCache to take the detector error model (or matching graph) from
+    options: Passed on to the constructor of the decoder
+    '''
+    if decoder=='pymatching':
+        if options:
+            raise TypeError("The pymatching decoder takes no options")
+        return compile_matching(circuit, dem_cache)
+    if decoder not in DECODERS:
+        raise ValueError(f"Unknown decoder {decoder!r}, expected one of {DECODERS}")
+    return _decoder_class(decoder).from_circuit(circuit, dem_cache=dem_cache, **options)
+
+
+def sinter_decoders(**options):
+    '''
+    Returns the decoders of this module that can run here, by name, for the
+    custom_decoders of sinter.collect (pymatching is built into sinter)
+
+    Args:
+    options: A dict of constructor options per decoder name, e.g. union_find={'weighted': False}
+    '''
+    decoders={name: SinterDecoder(name, **options.get(name, {})) for name in ('union_find', 'lookup')}
+    if importlib.util.find_spec('ldpc') is not None:
+        decoders['bposd']=SinterDecoder('bposd', **options.get('bposd', {}))
+    return decoders
+
+
+def dem_matrices(dem):
+    '''
+    Returns the (check_matrix, observable_matrix, priors) of the error
+    mechanisms of a detector error model, with one column per mechanism
+    '''
+    rows=[]
+    cols=[]
+    observable_rows=[]
+    observable_cols=[]
+    priors=[]
+    for instruction in dem.flattened():
+        if instruction.type!='error':
+            continue
+        column=len(priors)
+        priors.append(instruction.args_copy()[0])
+        detectors=set()
+        observables=set()
+        # the pieces of a decomposed error flip the XOR of their targets
+        for target in instruction.targets_copy():
+            if target.is_relative_detector_id():
+                detectors^={target.val}
+            elif target.is_logical_observable_id():
+                observables^={target.val}
+        rows+=sorted(detectors)
+        cols+=[column]*len(detectors)
+        observable_rows+=sorted(observables)
+        observable_cols+=[column]*len(observables)
+    num_mechanisms=len(priors)
+    check_matrix=scipy.sparse.csc_matrix((np.ones(len(rows), dtype=np.uint8), (rows, cols)),
+                                         shape=(dem.num_detectors, num_mechanisms))
+    observable_matrix=scipy.sparse.csc_matrix((np.ones(len(observable_rows), dtype=np.uint8), (observable_rows, observable_cols)),
+                                              shape=(dem.num_observables, num_mechanisms))
+    return check_matrix, observable_matrix, np.array(priors, dtype=np.float64)
+
+
+def _decoder_class(name):
+    '''
+    The class of a decoder name, importing the module of the decoders that live in their own
+    '''
+    if name=='lookup':
+        # lookup_decoder imports this module
+        from lookup_decoder import LookupTableDecoder
+        return LookupTableDecoder
+    return {'union_find': UnionFindDecoder, 'bposd': BpOsdDecoder}[name]
+
+
+def _find(parents, items):
+    '''
+    The roots of the clusters of the items, pointing the items straight at them
+    '''
+    roots=parents[items]
+    while True:
+        up=parents[roots]
+        if np.array_equal(up, roots):
+            break
+        roots=up
+    parents[items]=roots
+    return roots
+
+
+def _union(parents, u, v):
+    '''
+    Merges the clusters of items u and v, under the smaller root, as if
+    the pairs were merged one after the other. Returns whether each pair
+    merged two clusters, rather than two items of a cluster already merged
+    '''
+    merged=np.zeros(len(u), dtype=bool)
+    pairs=np.arange(len(u))
+    while len(pairs):
+        root_u=_find(parents, u[pairs])
+        root_v=_find(parents, v[pairs])
+        apart=root_u!=root_v
+        pairs, root_u, root_v=pairs[apart], root_u[apart], root_v[apart]
+        low, high=np.minimum(root_u, root_v), np.maximum(root_u, root_v)
+        np.minimum.at(parents, high, low)
+        # of the pairs that hooked the same roots together, the first one merged them
+        hooked=np.flatnonzero(parents[high]==low)
+        _, first=np.unique(high[hooked], return_index=True)
+        merged[pairs[hooked[first]]]=True
+        pairs=np.delete(pairs, hooked[first])
+    return merged
+
+
+def _ranges(starts, counts):
+    '''
+    The concatenation of range(start, start+count) for all the starts and counts
+    '''
+    return np.repeat(starts-np.cumsum(counts)+counts, counts)+np.arange(counts.sum())
+
+
+class _KeyIndex:
+    '''
+    The positions of int64 keys in the order they were added, found by binary search
+    '''
+
+    def __init__(self, keys):
+        self.keys=np.asarray(keys, dtype=np.int64)
+        self._sort()
+
+    def find(self, keys):
+        '''
+        The positions of the keys, -1 for keys that were never added
+        '''
+        if not len(self.keys):
+            return np.full(len(keys), -1, dtype=np.int64)
+        index=np.minimum(np.searchsorted(self._sorted, keys), len(self.keys)-1)
+        return np.where(self._sorted[index]==keys, self._order[index], -1)
+
+    def add(self, keys):
+        '''
+        Adds keys that are not there yet, and returns their positions
+        '''
+        positions=np.arange(len(self.keys), len(self.keys)+len(keys))
+        self.keys=np.concatenate([self.keys, keys])
+        self._sort()
+        return positions
+
+    def _sort(self):
+        self._order=np.argsort(self.keys, kind='stable')
+        self._sorted=self.keys[self._order]
+
+
+def _detection_events(shots, num_detectors):
+    '''
+    The (rows, nodes) of the detection events of bit-packed shots, by row
+    and node, where detector k is node k+1. Only the nonzero bytes are unpacked
+    '''
+    rows, columns=np.nonzero(shots)
+    bits=np.unpackbits(shots[rows, columns][:, None], axis=1, bitorder='little')
+    events, offsets=np.nonzero(bits)
+    nodes=8*columns[events]+offsets
+    keep=nodes<num_detectors
+    return rows[events][keep], nodes[keep]+1
+
+
+def _mechanism_table(dem, node_hashes):
+    '''
+    The (hashes, sizes, bit-packed observables) of the sets of detection
+    events of the error mechanisms of a detector error model, sorted by
+    hash. Of the mechanisms with the same detection events the likeliest is kept
+    '''
+    check_matrix, observable_matrix, priors=dem_matrices(dem)
+    sizes=np.diff(check_matrix.indptr)
+    keep=np.flatnonzero(sizes>0)
+    hashes=np.bitwise_xor.reduceat(node_hashes[check_matrix.indices+1], check_matrix.indptr[keep]) if len(keep) else np.zeros(0, dtype=np.int64)
+    observables=np.packbits(observable_matrix.toarray().T.astype(bool), axis=1, bitorder='little')[keep]
+    order=np.lexsort((-priors[keep], hashes))
+    hashes, sizes, observables=hashes[order], sizes[keep][order], observables[order]
+    first=np.ones(len(hashes), dtype=bool)
+    first[1:]=hashes[1:]!=hashes[:-1]
+    return hashes[first], sizes[first], observables[first]
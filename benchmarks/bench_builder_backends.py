@@ -0,0 +1,75 @@
+'''
+Compares the two HeavyHexCode builder backends across code distances:
+
+text: create_heavy_hex_code() followed by stim.Circuit(...) on the program text
+stim: create_heavy_hex_code(backend='stim'), which parses the program text once, inside the builder
+
+Both bypass the circuit cache, so every repeat times a full build.
+
+Run from the repository root:
+python benchmarks/bench_builder_backends.py --distances 3 5 7 11 15 21 25
+'''
+import argparse
+import os
+import sys
+import time
+
+import stim
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from heavy_hex_code import HeavyHexCode
+
+
+def make_code(d, rounds, basis, p):
+    return HeavyHexCode(
+        code_distance=d,
+        num_rounds=rounds,
+        basis=basis,
+        after_clifford_depolarization=p,
+        after_reset_flip_probability=p,
+        before_measure_flip_probability=p,
+        before_round_data_depolarization=p,
+    )
+
+
+def best_time(fn, repeats):
+    '''
+    Returns the best wall time of fn() over the repeats, and its last result
+    '''
+    best=float('inf')
+    result=None
+    for _ in range(repeats):
+        t0=time.perf_counter()
+        result=fn()
+        best=min(best, time.perf_counter()-t0)
+    return best, result
+
+
+def main():
+    parser=argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--distances', type=int, nargs='+', default=[3, 5, 7, 9, 11, 15, 19, 25])
+    parser.add_argument('--rounds', type=int, default=None, help='number of rounds (default: d)')
+    parser.add_argument('--basis', default='Z', choices=['X', 'Z'])
+    parser.add_argument('--p', type=float, default=1e-3)
+    parser.add_argument('--repeats', type=int, default=5)
+    args=parser.parse_args()
+
+    print(f"{'d':>4} {'text+parse (ms)':>16} {'stim (ms)':>10} {'speedup':>8} {'match':>6}")
+    for d in args.distances:
+        rounds=args.rounds if args.rounds is not None else d
+
+        t_text, text_circuit=best_time(
+            lambda: stim.Circuit(make_code(d, rounds, args.basis, args.p).create_heavy_hex_code(use_cache=False)),
+            args.repeats)
+        t_stim, stim_circuit=best_time(
+            lambda: make_code(d, rounds, args.basis, args.p).create_heavy_hex_code(backend='stim', use_cache=False),
+            args.repeats)
+
+        match=text_circuit==stim_circuit
+        print(f"{d:>4} {1e3*t_text:>16.2f} {1e3*t_stim:>10.2f} {t_text/t_stim:>8.2f} {str(match):>6}")
+        if not match:
+            raise AssertionError(f"backends disagree at d={d}")
+
+
+if __name__=='__main__':
+    main()
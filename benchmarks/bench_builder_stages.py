@@ -0,0 +1,95 @@
+'''
+Profiles the builder stages of HeavyHexCode across code distances
+
+For every distance the circuit is built with a BuildProfiler, and the time
+of every stage (summed over the sections of the circuit) is printed, with
+the share of the total build time. --json writes the full per-section
+reports.
+
+Run from the repository root:
+python benchmarks/bench_builder_stages.py --distances 5 11 15 21 25 31
+'''
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from heavy_hex_code import BuildProfiler, HeavyHexCode
+
+
+def make_code(d, rounds, basis, p):
+    return HeavyHexCode(
+        code_distance=d,
+        num_rounds=rounds,
+        basis=basis,
+        after_clifford_depolarization=p,
+        after_reset_flip_probability=p,
+        before_measure_flip_probability=p,
+        before_round_data_depolarization=p,
+    )
+
+
+def best_profile(d, rounds, basis, p, backend, repeats):
+    '''
+    Returns the profile of the fastest of the repeated builds
+    '''
+    best=None
+    for _ in range(repeats):
+        profiler=BuildProfiler()
+        make_code(d, rounds, basis, p).create_heavy_hex_code(backend=backend, profiler=profiler)
+        if best is None or profiler.total_seconds<best.total_seconds:
+            best=profiler
+    return best
+
+
+def main():
+    parser=argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--distances', type=int, nargs='+', default=[3, 5, 7, 11, 15, 21, 25])
+    parser.add_argument('--rounds', type=int, default=None, help='number of rounds (default: d)')
+    parser.add_argument('--basis', default='Z', choices=['X', 'Z'])
+    parser.add_argument('--p', type=float, default=1e-3)
+    parser.add_argument('--backend', default='text', choices=['text', 'stim'])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--stages', action='store_true', help='print the per-section table of every distance too')
+    parser.add_argument('--json', default=None, help='file to write the reports to')
+    args=parser.parse_args()
+
+    profiles=[]
+    for d in args.distances:
+        rounds=args.rounds if args.rounds is not None else d
+        profiles.append(best_profile(d, rounds, args.basis, args.p, args.backend, args.repeats))
+
+    stages=[]
+    for profile in profiles:
+        for stage in profile.by_stage():
+            if stage not in stages:
+                stages.append(stage)
+
+    print(f"{'stage':<34}"+"".join(f"{'d='+str(d):>16}" for d in args.distances))
+    for stage in stages:
+        cells=[]
+        for profile in profiles:
+            total=profile.by_stage().get(stage)
+            if total is None:
+                cells.append(f"{'-':>16}")
+            else:
+                share=total['seconds']/profile.total_seconds if profile.total_seconds>0 else 0.0
+                cells.append(f"{1e3*total['seconds']:>9.2f}ms {100*share:>3.0f}%")
+        print(f"{stage:<34}"+"".join(cells))
+    print(f"{'total':<34}"+"".join(f"{1e3*profile.total_seconds:>9.2f}ms     " for profile in profiles))
+    print(f"{'detectors':<34}"+"".join(f"{sum(t['detectors'] for t in profile.by_stage().values()):>16}" for profile in profiles))
+
+    if args.stages:
+        for profile in profiles:
+            print()
+            print(f"d={profile.code_parameters['code_distance']}")
+            print(profile.format())
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump([profile.to_dict() for profile in profiles], f, indent=1)
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,69 @@
+'''
+Compares building every circuit of a sweep from scratch with editing one CircuitIR
+
+For every distance the circuit is needed at --num-p error rates and at the
+--rounds numbers of rounds, as a stim.Circuit. The times per circuit of
+
+rebuild   HeavyHexCode(...).create_heavy_hex_code(backend='stim'), uncached
+ir        CircuitIR.with_noise / with_rounds, then to_stim
+
+are printed, with the sizes of the stim text and of the .npz file of the IR.
+
+Run from the repository root:
+python benchmarks/bench_circuit_ir.py --distances 3 5 7 9 --num-p 20 --rounds 10 100 1000
+'''
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from heavy_hex_code import HeavyHexCode
+from sweep import uniform_noise
+
+
+def main():
+    parser=argparse.ArgumentParser()
+    parser.add_argument('--distances', type=int, nargs='+', default=[3, 5, 7, 9])
+    parser.add_argument('--num-p', type=int, default=20)
+    parser.add_argument('--rounds', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--basis', default='Z')
+    args=parser.parse_args()
+    ps=np.geomspace(1e-4, 1e-2, args.num_p)
+
+    print(f"{'d':>3} {'edit':>7} {'circuits':>8} {'rebuild ms':>11} {'ir ms':>8} {'speedup':>8} "
+          f"{'text bytes':>11} {'npz bytes':>10}")
+    for d in args.distances:
+        def rebuild(p, rounds):
+            return HeavyHexCode(
+                code_distance=d,
+                num_rounds=rounds,
+                basis=args.basis,
+                **uniform_noise(p),
+            ).create_heavy_hex_code(backend='stim', use_cache=False)
+
+        ir=HeavyHexCode(code_distance=d, num_rounds=d, basis=args.basis,
+                        **uniform_noise(ps[0])).create_heavy_hex_code(backend='ir', use_cache=False)
+        with tempfile.TemporaryDirectory() as directory:
+            path=os.path.join(directory, 'circuit.npz')
+            ir.save(path)
+            npz_bytes=os.path.getsize(path)
+        text_bytes=len(ir.to_text())
+
+        for edit, cases in (('noise', [(p, d) for p in ps]), ('rounds', [(ps[0], r) for r in args.rounds])):
+            t0=time.perf_counter()
+            rebuilt=[rebuild(p, rounds) for p, rounds in cases]
+            t1=time.perf_counter()
+            edited=[ir.with_noise(**uniform_noise(p)).with_rounds(rounds).to_stim() for p, rounds in cases]
+            t2=time.perf_counter()
+            if rebuilt!=edited:
+                raise AssertionError("The edited IR differs from the rebuilt circuit")
+            print(f"{d:>3} {edit:>7} {len(cases):>8} {1e3*(t1-t0)/len(cases):>11.2f} {1e3*(t2-t1)/len(cases):>8.2f} "
+                  f"{(t1-t0)/(t2-t1):>7.1f}x {text_bytes:>11} {npz_bytes:>10}", flush=True)
+
+
+if __name__=='__main__':
+    main()
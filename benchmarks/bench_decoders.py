@@ -0,0 +1,68 @@
+'''
+Compares the decoders of batch_decoders on the same shots
+
+For every (basis, distance, p) the shots are sampled once, kept in memory
+as bit-packed chunks, and decoded by every decoder of --decoders through
+decoders.decode_chunks. The logical error rate with its Wilson interval,
+the time to build the decoder and the decoding time per shot of each are
+printed. Decoders that cannot run here (bposd without ldpc) are skipped.
+
+Run from the repository root:
+python benchmarks/bench_decoders.py --distances 3 5 7 --ps 1e-3 5e-3 --shots 100000
+'''
+import argparse
+import importlib.util
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from heavy_hex_code import HeavyHexCode
+from batch_decoders import DECODERS, compile_decoder
+from decoders import decode_chunks
+from sampling import iter_shot_chunks
+from sweep import uniform_noise
+
+
+def main():
+    parser=argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--distances', type=int, nargs='+', default=[3, 5, 7])
+    parser.add_argument('--rounds', type=int, default=None, help='number of rounds (default: d)')
+    parser.add_argument('--bases', nargs='+', default=['Z'], choices=['X', 'Z', 'XZ'])
+    parser.add_argument('--ps', type=float, nargs='+', default=[1e-3, 5e-3])
+    # the lookup table is for d=3 and d=5 only, see bench_lookup_decoder.py
+    parser.add_argument('--decoders', nargs='+', default=[name for name in DECODERS if name!='lookup'], choices=DECODERS)
+    parser.add_argument('--shots', type=int, default=10**5)
+    parser.add_argument('--seed', type=int, default=0)
+    args=parser.parse_args()
+
+    decoders=args.decoders
+    if 'bposd' in decoders and importlib.util.find_spec('ldpc') is None:
+        print("ldpc is not installed, skipping bposd")
+        decoders=[name for name in decoders if name!='bposd']
+
+    print(f"{'basis':>5} {'d':>4} {'p':>8} {'decoder':>11} {'rate':>10} {'low':>10} {'high':>10} "
+          f"{'setup (s)':>10} {'us/shot':>9}")
+    for basis in args.bases:
+        for d in args.distances:
+            for p in args.ps:
+                circuit=HeavyHexCode(
+                    code_distance=d,
+                    num_rounds=args.rounds if args.rounds is not None else d,
+                    basis=basis,
+                    **uniform_noise(p),
+                ).create_heavy_hex_code(backend='stim')
+                chunks=list(iter_shot_chunks(circuit, args.shots, seed=args.seed))
+
+                for name in decoders:
+                    t0=time.perf_counter()
+                    decoder=compile_decoder(circuit, name)
+                    setup=time.perf_counter()-t0
+                    stats=decode_chunks(chunks, decoder, circuit.num_observables)
+                    low, high=stats.confidence_interval()
+                    print(f"{basis:>5} {d:>4} {p:>8.1e} {name:>11} {stats.logical_error_rate:>10.3e} {low:>10.3e} "
+                          f"{high:>10.3e} {setup:>10.3f} {1e6/stats.decoded_shots_per_second:>9.2f}", flush=True)
+
+
+if __name__=='__main__':
+    main()
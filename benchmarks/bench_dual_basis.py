@@ -0,0 +1,60 @@
+'''
+Compares running the X and the Z memory experiment as two circuits with
+running both as one 'XZ' circuit:
+
+separate: build, detector error model, matching graph, sampling and decoding of 'X', then of 'Z'
+dual: the same for the 'XZ' circuit, whose two observables are the X and the Z memory
+
+The setup time (circuit, detector error model and matching graph), the
+sampling and decoding time and the logical error rate of every basis are
+printed for both.
+
+Run from the repository root:
+python benchmarks/bench_dual_basis.py --distances 3 5 7 9 --shots 100000
+'''
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from heavy_hex_code import HeavyHexCode
+from decoders import compile_matching, sample_and_decode
+from sweep import uniform_noise
+
+
+def run(d, rounds, basis, p, shots, seed):
+    '''
+    Returns (setup seconds, sampling and decoding seconds, error rate of every observable)
+    '''
+    t0=time.perf_counter()
+    circuit=HeavyHexCode(code_distance=d, num_rounds=rounds, basis=basis, **uniform_noise(p)).create_heavy_hex_code(
+        backend='stim', use_cache=False)
+    matching=compile_matching(circuit)
+    setup=time.perf_counter()-t0
+    stats=sample_and_decode(circuit, shots=shots, matching=matching, seed=seed)
+    return setup, stats.sample_seconds+stats.decode_seconds, list(stats.observable_error_rates)
+
+
+def main():
+    parser=argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--distances', type=int, nargs='+', default=[3, 5, 7, 9])
+    parser.add_argument('--rounds', type=int, default=None, help='number of rounds (default: d)')
+    parser.add_argument('--p', type=float, default=2e-3)
+    parser.add_argument('--shots', type=int, default=10**5)
+    parser.add_argument('--seed', type=int, default=0)
+    args=parser.parse_args()
+
+    print(f"{'d':>4} {'separate setup (s)':>19} {'dual setup (s)':>15} {'separate run (s)':>17} {'dual run (s)':>13} "
+          f"{'X rate sep/dual':>20} {'Z rate sep/dual':>20}")
+    for d in args.distances:
+        rounds=args.rounds if args.rounds is not None else d
+        x=run(d, rounds, 'X', args.p, args.shots, args.seed)
+        z=run(d, rounds, 'Z', args.p, args.shots, args.seed)
+        dual=run(d, rounds, 'XZ', args.p, args.shots, args.seed)
+        print(f"{d:>4} {x[0]+z[0]:>19.3f} {dual[0]:>15.3f} {x[1]+z[1]:>17.3f} {dual[1]:>13.3f} "
+              f"{x[2][0]:>9.2e}/{dual[2][0]:<9.2e} {z[2][0]:>9.2e}/{dual[2][1]:<9.2e}")
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,70 @@
+'''
+Compares flag-aware matching with plain pymatching on the same shots:
+
+plain: pymatching.Matching of the detector error model, the flag detectors are ordinary nodes
+flag: flag_decoding.FlagAwareDecoder, the flags reweight the graph
+
+Both decoders see the same shots (same sampler seed), and the logical error
+rate and the decoding time per shot of each are printed.
+
+Run from the repository root:
+python benchmarks/bench_flag_decoder.py --distances 3 5 7 --p 1e-3 --shots 100000
+'''
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from heavy_hex_code import HeavyHexCode
+from decoders import compile_matching, sample_and_decode
+from flag_decoding import FlagAwareDecoder
+
+
+def make_code(d, rounds, basis, p):
+    return HeavyHexCode(
+        code_distance=d,
+        num_rounds=rounds,
+        basis=basis,
+        after_clifford_depolarization=p,
+        after_reset_flip_probability=p,
+        before_measure_flip_probability=p,
+        before_round_data_depolarization=p,
+    )
+
+
+def main():
+    parser=argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--distances', type=int, nargs='+', default=[3, 5, 7])
+    parser.add_argument('--rounds', type=int, default=None, help='number of rounds (default: d)')
+    parser.add_argument('--bases', nargs='+', default=['X', 'Z'], choices=['X', 'Z'])
+    parser.add_argument('--p', type=float, default=1e-3)
+    parser.add_argument('--shots', type=int, default=10**5)
+    parser.add_argument('--seed', type=int, default=0)
+    args=parser.parse_args()
+
+    print(f"{'basis':>5} {'d':>4} {'plain rate':>22} {'flag rate':>22} {'plain (us/shot)':>16} {'flag (us/shot)':>15} {'graphs':>7} {'setup (s)':>10}")
+    for basis in args.bases:
+        for d in args.distances:
+            rounds=args.rounds if args.rounds is not None else d
+            code=make_code(d, rounds, basis, args.p)
+            circuit=code.create_heavy_hex_code(backend='stim')
+
+            t0=time.perf_counter()
+            decoder=FlagAwareDecoder.from_heavy_hex_code(code)
+            setup=time.perf_counter()-t0
+
+            plain=sample_and_decode(circuit, shots=args.shots, matching=compile_matching(circuit), seed=args.seed)
+            flag=sample_and_decode(circuit, shots=args.shots, matching=decoder, seed=args.seed)
+
+            columns=[]
+            for stats in (plain, flag):
+                low, high=stats.confidence_interval()
+                columns.append(f"{stats.logical_error_rate:.2e} [{low:.1e},{high:.1e}]")
+            print(f"{basis:>5} {d:>4} {columns[0]:>22} {columns[1]:>22} "
+                  f"{1e6/plain.decoded_shots_per_second:>16.1f} {1e6/flag.decoded_shots_per_second:>15.1f} "
+                  f"{decoder.num_matchings_built:>7} {setup:>10.2f}")
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,76 @@
+'''
+Measures the startup cost of a fresh worker process that builds circuits
+
+Every measurement starts a new interpreter (like the workers of sinter or of
+a process pool) that times
+
+import      import heavy_hex_code
+text        building the first circuit as program text
+stim        building the first circuit with the 'stim' backend (stim is imported then)
+
+and reports which of the heavy dependencies were imported along the way.
+The time of starting an interpreter that does nothing is printed for
+reference. Medians over --repeats processes.
+
+Run from the repository root:
+python benchmarks/bench_import_time.py --repeats 10
+'''
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES=('numpy', 'stim', 'pymatching', 'scipy', 'sinter', 'networkx')
+
+WORKER='''
+import sys, time
+t0=time.perf_counter()
+import heavy_hex_code
+t1=time.perf_counter()
+after_import=[m for m in {modules!r} if m in sys.modules]
+code=heavy_hex_code.HeavyHexCode(code_distance={d}, num_rounds={d}, basis='Z',
+    after_clifford_depolarization=1e-3, after_reset_flip_probability=1e-3,
+    before_measure_flip_probability=1e-3, before_round_data_depolarization=1e-3)
+code.create_heavy_hex_code(use_cache=False)
+t2=time.perf_counter()
+after_text=[m for m in {modules!r} if m in sys.modules]
+code.create_heavy_hex_code(backend='stim', use_cache=False)
+t3=time.perf_counter()
+print(t1-t0, t2-t1, t3-t2, ','.join(after_import), ','.join(after_text))
+'''
+
+
+def run(code):
+    return subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True).stdout
+
+
+def main():
+    parser=argparse.ArgumentParser()
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--distance', type=int, default=5)
+    args=parser.parse_args()
+
+    empty=[]
+    for _ in range(args.repeats):
+        t0=time.perf_counter()
+        run('pass')
+        empty.append(time.perf_counter()-t0)
+    print(f"empty interpreter:   {1e3*statistics.median(empty):8.1f} ms (process start to exit)")
+
+    timings=[]
+    for _ in range(args.repeats):
+        fields=run(WORKER.format(modules=HEAVY_MODULES, d=args.distance)).split(' ')
+        timings.append([float(field) for field in fields[:3]])
+        after_import, after_text=fields[3], fields[4].strip()
+    for name, column in zip(('import heavy_hex_code', f'first text build d={args.distance}',
+                             f'first stim build d={args.distance}'), zip(*timings)):
+        print(f"{name+':':<21}{1e3*statistics.median(column):8.1f} ms")
+    print("imported by import:      "+(after_import or '-'))
+    print("imported by text build:  "+(after_text or '-'))
+
+
+if __name__=='__main__':
+    main()
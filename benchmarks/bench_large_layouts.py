@@ -0,0 +1,78 @@
+'''
+Times the layout, the CNOT schedule and the circuit of large and rectangular patches
+
+For every code distance (a single d, or dx,dz for a rectangular patch) the
+times of
+
+layout    HeavyHexCode(...), which labels the qubits and builds the CNOT schedule
+build     create_heavy_hex_code() with the text backend, uncached
+tables    the per-detector arrays (detector_roles and friends), made on first use
+
+are printed with the number of qubits and detectors and the peak traced
+memory of a second build. Patches with fewer than --check-below qubits also go
+through stim's count_determined_measurements, which must equal the number
+of detectors plus observables.
+
+Run from the repository root:
+python benchmarks/bench_large_layouts.py --distances 51 101 3,9 9,3 25,51
+'''
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from heavy_hex_code import HeavyHexCode
+from sweep import uniform_noise
+
+
+def distance(text):
+    values=tuple(int(value) for value in text.split(','))
+    return values[0] if len(values)==1 else values
+
+
+def main():
+    parser=argparse.ArgumentParser()
+    parser.add_argument('--distances', type=distance, nargs='+', default=[51, 101, (3, 9), (9, 3), (25, 51)])
+    parser.add_argument('--rounds', type=int, default=None, help='rounds of the memory experiment (default: min(dx, dz))')
+    parser.add_argument('--basis', default='Z')
+    parser.add_argument('--p', type=float, default=1e-3)
+    parser.add_argument('--check-below', type=int, default=2000)
+    args=parser.parse_args()
+
+    print(f"{'distance':>9} {'qubits':>7} {'detectors':>10} {'layout ms':>10} {'build ms':>9} "
+          f"{'tables ms':>10} {'peak MB':>8} {'check':>6}")
+    for d in args.distances:
+        rounds=args.rounds or (d if isinstance(d, int) else min(d))
+        t0=time.perf_counter()
+        code=HeavyHexCode(code_distance=d, num_rounds=rounds, basis=args.basis, **uniform_noise(args.p))
+        t1=time.perf_counter()
+        circuit=code.create_heavy_hex_code(use_cache=False)
+        t2=time.perf_counter()
+        roles=code.detector_roles()
+        code.detector_coordinates()
+        t3=time.perf_counter()
+        # tracing slows the build down, so the memory is measured on a second one
+        tracemalloc.start()
+        code.create_heavy_hex_code(use_cache=False)
+        peak=tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        num_qubits=code.grid_shape[0]*code.grid_shape[1]
+        check='-'
+        if num_qubits<args.check_below:
+            import stim
+            stim_circuit=stim.Circuit(circuit)
+            determined=stim_circuit.count_determined_measurements()
+            if determined!=stim_circuit.num_detectors+stim_circuit.num_observables:
+                raise AssertionError(f"{d}: {determined} determined measurements for "
+                                     f"{stim_circuit.num_detectors} detectors")
+            check='ok'
+        label=str(d) if isinstance(d, int) else f"{d[0]}x{d[1]}"
+        print(f"{label:>9} {num_qubits:>7} {len(roles):>10} {1e3*(t1-t0):>10.1f} {1e3*(t2-t1):>9.1f} "
+              f"{1e3*(t3-t2):>10.1f} {peak/2**20:>8.1f} {check:>6}", flush=True)
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,70 @@
+'''
+Compares lookup_decoder.LookupTableDecoder with pymatching at small distances
+
+For every (distance, rounds, p) the lookup table is built (timed, with its
+number of syndromes and the size of its .npz file), the shots are sampled
+once and decoded by both decoders. Printed are the logical error rates, the
+fraction of the shots answered from the table, and the decoding time per
+shot of each decoder.
+
+Run from the repository root:
+python benchmarks/bench_lookup_decoder.py --distances 3 5 --rounds 1 3 --ps 1e-3 1e-4 --shots 1000000
+'''
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from heavy_hex_code import HeavyHexCode
+from decoders import compile_matching, decode_chunks
+from lookup_decoder import LookupTableDecoder
+from sampling import iter_shot_chunks
+from sweep import uniform_noise
+
+
+def main():
+    parser=argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--distances', type=int, nargs='+', default=[3, 5])
+    parser.add_argument('--rounds', type=int, nargs='+', default=[1, 3])
+    parser.add_argument('--basis', default='Z', choices=['X', 'Z', 'XZ'])
+    parser.add_argument('--ps', type=float, nargs='+', default=[1e-3, 1e-4])
+    parser.add_argument('--max-faults', type=int, default=2)
+    parser.add_argument('--max-weight', type=int, default=None)
+    parser.add_argument('--shots', type=int, default=10**6)
+    parser.add_argument('--seed', type=int, default=0)
+    args=parser.parse_args()
+
+    print(f"{'d':>3} {'r':>3} {'p':>8} {'syndromes':>10} {'file MB':>8} {'build s':>8} {'hit':>7} "
+          f"{'matching rate':>14} {'table rate':>11} {'matching us':>12} {'table us':>9} {'speedup':>8}")
+    for d in args.distances:
+        for rounds in args.rounds:
+            for p in args.ps:
+                circuit=HeavyHexCode(
+                    code_distance=d,
+                    num_rounds=rounds,
+                    basis=args.basis,
+                    **uniform_noise(p),
+                ).create_heavy_hex_code(backend='stim')
+                matching=compile_matching(circuit)
+                t0=time.perf_counter()
+                decoder=LookupTableDecoder.from_circuit(circuit, max_faults=args.max_faults, max_weight=args.max_weight)
+                build=time.perf_counter()-t0
+                with tempfile.TemporaryDirectory() as directory:
+                    path=os.path.join(directory, 'table.npz')
+                    decoder.table.save(path)
+                    file_bytes=os.path.getsize(path)
+
+                chunks=list(iter_shot_chunks(circuit, args.shots, seed=args.seed))
+                plain=decode_chunks(chunks, matching, circuit.num_observables)
+                table=decode_chunks(chunks, decoder, circuit.num_observables)
+                plain_us=1e6/plain.decoded_shots_per_second
+                table_us=1e6/table.decoded_shots_per_second
+                print(f"{d:>3} {rounds:>3} {p:>8.1e} {len(decoder.table):>10} {file_bytes/2**20:>8.2f} {build:>8.2f} "
+                      f"{decoder.table_hit_rate:>7.4f} {plain.logical_error_rate:>14.3e} {table.logical_error_rate:>11.3e} "
+                      f"{plain_us:>12.3f} {table_us:>9.3f} {plain_us/table_us:>7.2f}x", flush=True)
+
+
+if __name__=='__main__':
+    main()
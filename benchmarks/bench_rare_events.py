@@ -0,0 +1,62 @@
+'''
+Compares direct sampling with rare_events.estimate_logical_error_rate
+
+At every (distance, p) the logical error rate is estimated both ways, with
+the decoded shots and the time of each. At moderate p the two must agree
+within their error bars; at low p the stratified estimate gets a tight
+interval where direct sampling with the same number of shots sees few or
+no logical errors.
+
+Run from the repository root:
+python benchmarks/bench_rare_events.py --distances 3 5 --ps 3e-3 1e-3 1e-4 --shots 20000 --direct-shots 1000000
+'''
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from heavy_hex_code import HeavyHexCode
+from decoders import compile_matching, sample_and_decode
+from rare_events import estimate_logical_error_rate
+from sweep import uniform_noise
+
+
+def main():
+    parser=argparse.ArgumentParser()
+    parser.add_argument('--distances', type=int, nargs='+', default=[3, 5])
+    parser.add_argument('--ps', type=float, nargs='+', default=[3e-3, 1e-3, 1e-4])
+    parser.add_argument('--basis', default='Z')
+    parser.add_argument('--shots', type=int, default=20000, help='decoded shots of the stratified estimate')
+    parser.add_argument('--direct-shots', type=int, default=10**6, help='shots of direct sampling')
+    parser.add_argument('--seed', type=int, default=0)
+    args=parser.parse_args()
+
+    print(f"{'d':>3} {'p':>8} {'method':>10} {'shots':>9} {'errors':>7} {'rate':>10} "
+          f"{'low':>10} {'high':>10} {'seconds':>8}")
+    for d in args.distances:
+        for p in args.ps:
+            circuit=HeavyHexCode(
+                code_distance=d,
+                num_rounds=d,
+                basis=args.basis,
+                **uniform_noise(p),
+            ).create_heavy_hex_code(backend='stim')
+            matching=compile_matching(circuit)
+
+            t0=time.perf_counter()
+            direct=sample_and_decode(circuit, shots=args.direct_shots, matching=matching, seed=args.seed)
+            t1=time.perf_counter()
+            stratified=estimate_logical_error_rate(circuit, shots=args.shots, matching=matching, seed=args.seed)
+            t2=time.perf_counter()
+
+            low, high=direct.confidence_interval()
+            print(f"{d:>3} {p:>8.1e} {'direct':>10} {direct.shots:>9} {direct.errors:>7} "
+                  f"{direct.logical_error_rate:>10.3e} {low:>10.3e} {high:>10.3e} {t1-t0:>8.2f}")
+            low, high=stratified.confidence_interval()
+            print(f"{d:>3} {p:>8.1e} {'stratified':>10} {stratified.total_shots:>9} {int(stratified.errors.sum()):>7} "
+                  f"{stratified.logical_error_rate:>10.3e} {low:>10.3e} {high:>10.3e} {t2-t1:>8.2f}", flush=True)
+
+
+if __name__=='__main__':
+    main()
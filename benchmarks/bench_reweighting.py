@@ -0,0 +1,79 @@
+'''
+Compares the two ways of getting the matching graph of every p of a sweep:
+
+rebuild: build the circuit, its detector error model and the pymatching.Matching at every p
+reweight: reweighting.ReweightableMatching, fitted once per (distance, rounds, basis)
+
+The time per p of each, the one-off fitting time, and the largest relative
+difference of the edge probabilities of the two graphs are printed.
+
+Run from the repository root:
+python benchmarks/bench_reweighting.py --distances 3 5 7 9 --num-p 50
+'''
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pymatching
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from heavy_hex_code import HeavyHexCode
+from dem_cache import build_detector_error_model
+from reweighting import ReweightableMatching
+from sweep import uniform_noise
+
+
+def rebuild(d, rounds, basis, p):
+    circuit=HeavyHexCode(
+        code_distance=d,
+        num_rounds=rounds,
+        basis=basis,
+        **uniform_noise(p),
+    ).create_heavy_hex_code(backend='stim', use_cache=False)
+    return pymatching.Matching.from_detector_error_model(build_detector_error_model(circuit))
+
+
+def edge_probabilities(matching):
+    return {(u, v): data['error_probability'] for u, v, data in matching.edges()}
+
+
+def main():
+    parser=argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--distances', type=int, nargs='+', default=[3, 5, 7, 9])
+    parser.add_argument('--rounds', type=int, default=None, help='number of rounds (default: d)')
+    parser.add_argument('--basis', default='Z', choices=['X', 'Z'])
+    parser.add_argument('--num-p', type=int, default=20)
+    parser.add_argument('--p-range', type=float, nargs=2, default=[1e-4, 1e-2])
+    args=parser.parse_args()
+    ps=np.geomspace(*args.p_range, args.num_p)
+
+    print(f"{'d':>4} {'edges':>7} {'fit (s)':>8} {'rebuild (ms/p)':>15} {'reweight (ms/p)':>16} {'speedup':>8} {'max rel diff':>13}")
+    for d in args.distances:
+        rounds=args.rounds if args.rounds is not None else d
+
+        t0=time.perf_counter()
+        reweightable=ReweightableMatching(d, rounds, args.basis)
+        fit=time.perf_counter()-t0
+
+        t0=time.perf_counter()
+        rebuilt=[rebuild(d, rounds, args.basis, p) for p in ps]
+        rebuild_time=(time.perf_counter()-t0)/len(ps)
+
+        t0=time.perf_counter()
+        reweighted=[reweightable.matching(**uniform_noise(p)) for p in ps]
+        reweight_time=(time.perf_counter()-t0)/len(ps)
+
+        difference=0.0
+        for a, b in zip(rebuilt, reweighted):
+            a=edge_probabilities(a)
+            b=edge_probabilities(b)
+            difference=max(difference, max(abs(a[edge]-b.get(edge, 0.0))/a[edge] for edge in a))
+
+        print(f"{d:>4} {reweightable.num_edges:>7} {fit:>8.2f} {1e3*rebuild_time:>15.2f} {1e3*reweight_time:>16.3f} "
+              f"{rebuild_time/reweight_time:>7.0f}x {difference:>13.1e}")
+
+
+if __name__=='__main__':
+    main()
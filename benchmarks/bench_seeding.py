@@ -0,0 +1,76 @@
+'''
+Checks that seeding.ShotStream replays shots, and times what it costs
+
+For every distance the stream of a memory experiment is sampled and decoded
+chunk by chunk, and compared with sampling.iter_shot_chunks, which compiles
+one sampler for the whole run. Then the shots the decoder got wrong are
+found with find_mistaken_shots and sampled again on their own with
+ShotStream.shots, and the chunks are sampled again in reverse order; both
+must give the same bits as the first pass.
+
+Run from the repository root:
+python benchmarks/bench_seeding.py --distances 3 5 7 --p 5e-3 --shots 1000000
+'''
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from heavy_hex_code import HeavyHexCode
+from decoders import compile_matching, decode_chunks
+from sampling import iter_shot_chunks
+from seeding import ShotStream, find_mistaken_shots
+from sweep import uniform_noise
+
+
+def main():
+    parser=argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--distances', type=int, nargs='+', default=[3, 5, 7])
+    parser.add_argument('--rounds', type=int, default=None, help='number of rounds (default: d)')
+    parser.add_argument('--basis', default='Z', choices=['X', 'Z', 'XZ'])
+    parser.add_argument('--p', type=float, default=5e-3)
+    parser.add_argument('--shots', type=int, default=10**6)
+    parser.add_argument('--chunk-size', type=int, default=2**16)
+    parser.add_argument('--seed', type=int, default=0)
+    args=parser.parse_args()
+
+    print(f"{'d':>4} {'one sampler (s)':>16} {'stream (s)':>11} {'mistakes':>9} {'replay (s)':>11} {'replayed':>9}")
+    for d in args.distances:
+        circuit=HeavyHexCode(
+            code_distance=d,
+            num_rounds=args.rounds if args.rounds is not None else d,
+            basis=args.basis,
+            **uniform_noise(args.p),
+        ).create_heavy_hex_code(backend='stim')
+        matching=compile_matching(circuit)
+
+        baseline=decode_chunks(iter_shot_chunks(circuit, args.shots, chunk_size=args.chunk_size, seed=args.seed),
+                               matching, circuit.num_observables)
+        stream=ShotStream(circuit, args.seed, chunk_size=args.chunk_size)
+        t0=time.perf_counter()
+        chunks=list(stream.iter_chunks(args.shots))
+        stats=decode_chunks(chunks, matching, circuit.num_observables)
+        stream_seconds=time.perf_counter()-t0
+
+        mistakes=find_mistaken_shots(stream, matching, args.shots)
+        assert len(mistakes)==stats.errors, (len(mistakes), stats.errors)
+        # replay a handful of the mistakes, from the end of the run backwards
+        replayed=mistakes[::-1][:16]
+        t0=time.perf_counter()
+        detection_events, observables=stream.shots(replayed)
+        replay_seconds=time.perf_counter()-t0
+        everything=np.concatenate([chunk[0] for chunk in chunks])
+        assert np.array_equal(detection_events, everything[replayed])
+        assert np.array_equal(observables, np.concatenate([chunk[1] for chunk in chunks])[replayed])
+        for k in reversed(range(len(chunks))):
+            assert np.array_equal(stream.chunk(k)[0][:len(chunks[k][0])], chunks[k][0]), k
+
+        print(f"{d:>4} {baseline.sample_seconds+baseline.decode_seconds:>16.2f} {stream_seconds:>11.2f} "
+              f"{len(mistakes):>9} {replay_seconds:>11.3f} {len(replayed):>9}", flush=True)
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,58 @@
+'''
+Runs the same sharded sweep with different numbers of local workers
+
+For every --workers count a fresh sweep directory is filled by
+sharding.sharded_sweep. The wall time and the number of shards run are
+printed, and the merged counts of every point are checked to be the same
+for all the worker counts (they depend on the seed alone).
+
+Run from the repository root:
+python benchmarks/bench_sharding.py --workers 1 2 4 --distances 3 5 --ps 2e-3 5e-3 --max-errors 200
+'''
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sharding import sharded_sweep
+
+
+def main():
+    parser=argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--distances', type=int, nargs='+', default=[3, 5])
+    parser.add_argument('--ps', type=float, nargs='+', default=[2e-3, 5e-3])
+    parser.add_argument('--bases', nargs='+', default=['X', 'Z'], choices=['X', 'Z', 'XZ'])
+    parser.add_argument('--shots-per-shard', type=int, default=2**13)
+    parser.add_argument('--max-shots', type=int, default=10**6)
+    parser.add_argument('--max-errors', type=int, default=200)
+    parser.add_argument('--decoder', default='pymatching')
+    parser.add_argument('--seed', type=int, default=0)
+    args=parser.parse_args()
+
+    reference=None
+    print(f"{'workers':>7} {'seconds':>8} {'shards':>7} {'merged shots':>13} {'errors':>7}")
+    for workers in args.workers:
+        with tempfile.TemporaryDirectory() as directory:
+            t0=time.perf_counter()
+            stats=sharded_sweep(directory, args.distances, args.ps, args.bases, num_workers=workers,
+                                shots_per_shard=args.shots_per_shard, max_shots=args.max_shots,
+                                max_errors=args.max_errors, seed=args.seed, decoder=args.decoder)
+            seconds=time.perf_counter()-t0
+            shards=len(os.listdir(os.path.join(directory, 'results')))
+        counts={point: (s.shots, s.errors, tuple(s.observable_errors)) for point, s in stats.items()}
+        if reference is None:
+            reference=counts
+        elif counts!=reference:
+            raise AssertionError(f"The merged counts with {workers} workers differ")
+        print(f"{workers:>7} {seconds:>8.2f} {shards:>7} {sum(c[0] for c in counts.values()):>13} "
+              f"{sum(c[1] for c in counts.values()):>7}", flush=True)
+
+    for point, (shots, errors, _) in sorted(reference.items()):
+        print(point, shots, errors, f"{errors/shots:.3e}")
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,59 @@
+'''
+Compares sliding-window decoding with matching all the rounds at once:
+
+full: pymatching.Matching of the whole detector error model
+window: sliding_window.SlidingWindowDecoder, commit and buffer rounds as given
+
+Both decoders see the same shots (same sampler seed). The logical error
+rates, the decoding time per shot of each, and the mean and worst decoding
+time of one window are printed -- the worst window time bounds the latency
+of a real-time decoder that keeps up with the rounds.
+
+Run from the repository root:
+python benchmarks/bench_sliding_window.py --distance 5 --rounds 10 100 1000 --shots 2000
+'''
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from heavy_hex_code import HeavyHexCode
+from decoders import compile_matching, sample_and_decode
+from sliding_window import SlidingWindowDecoder
+from sweep import uniform_noise
+
+
+def main():
+    parser=argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--distance', type=int, default=5)
+    parser.add_argument('--rounds', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--basis', default='Z', choices=['X', 'Z'])
+    parser.add_argument('--p', type=float, default=1e-3)
+    parser.add_argument('--commit-rounds', type=int, default=None, help='default: the distance')
+    parser.add_argument('--buffer-rounds', type=int, default=None, help='default: the distance')
+    parser.add_argument('--shots', type=int, default=2000)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=0)
+    args=parser.parse_args()
+
+    print(f"{'rounds':>7} {'full rate':>10} {'window rate':>12} {'full (us/shot)':>15} {'window (us/shot)':>17} "
+          f"{'windows':>8} {'graphs':>7} {'mean window (us)':>17} {'worst window (us)':>18}")
+    for rounds in args.rounds:
+        code=HeavyHexCode(code_distance=args.distance, num_rounds=rounds, basis=args.basis, **uniform_noise(args.p))
+        circuit=code.create_heavy_hex_code(backend='stim')
+        decoder=SlidingWindowDecoder.from_heavy_hex_code(code, commit_rounds=args.commit_rounds,
+                                                         buffer_rounds=args.buffer_rounds)
+
+        full=sample_and_decode(circuit, shots=args.shots, matching=compile_matching(circuit),
+                               batch_size=args.batch_size, seed=args.seed)
+        window=sample_and_decode(circuit, shots=args.shots, matching=decoder,
+                                 batch_size=args.batch_size, seed=args.seed)
+        latency=decoder.latency_summary()
+        print(f"{rounds:>7} {full.logical_error_rate:>10.3e} {window.logical_error_rate:>12.3e} "
+              f"{1e6/full.decoded_shots_per_second:>15.1f} {1e6/window.decoded_shots_per_second:>17.1f} "
+              f"{decoder.num_windows:>8} {decoder.num_matchings_built:>7} "
+              f"{latency['mean_window_us']:>17.2f} {latency['max_window_us']:>18.2f}")
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,68 @@
+'''
+Paired comparison of two decoders on the shots of a syndrome_store.SyndromeStore
+
+For every distance the shots are sampled into the store once and decoded by
+decoder a and by decoder b; then both logical error rates, the shots that
+only one of them got wrong and the McNemar p-value are printed, with the
+time of sampling, of each decoding pass and of a second, cached pass of a.
+
+Run from the repository root:
+python benchmarks/bench_syndrome_store.py --distances 3 5 7 --p 5e-3 --shots 1000000 --a pymatching --b union_find
+'''
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from heavy_hex_code import HeavyHexCode
+from batch_decoders import DECODERS, compile_decoder
+from seeding import ShotStream
+from sweep import uniform_noise
+from syndrome_store import SyndromeStore
+
+
+def main():
+    parser=argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--distances', type=int, nargs='+', default=[3, 5, 7])
+    parser.add_argument('--rounds', type=int, default=None, help='number of rounds (default: d)')
+    parser.add_argument('--basis', default='Z', choices=['X', 'Z', 'XZ'])
+    parser.add_argument('--p', type=float, default=5e-3)
+    parser.add_argument('--shots', type=int, default=10**6)
+    parser.add_argument('--a', default='pymatching', choices=DECODERS)
+    parser.add_argument('--b', default='union_find', choices=DECODERS)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--directory', default=None, help='the store (default: a temporary directory)')
+    args=parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store=SyndromeStore(args.directory or tmp)
+        print(f"{'d':>4} {'rate a':>10} {'rate b':>10} {'only a':>7} {'only b':>7} {'p-value':>9} "
+              f"{'sample (s)':>11} {'a (s)':>7} {'b (s)':>7} {'a again (s)':>12}")
+        for d in args.distances:
+            circuit=HeavyHexCode(
+                code_distance=d,
+                num_rounds=args.rounds if args.rounds is not None else d,
+                basis=args.basis,
+                **uniform_noise(args.p),
+            ).create_heavy_hex_code(backend='stim')
+            stream=ShotStream(circuit, args.seed)
+
+            t0=time.perf_counter()
+            for _ in store.iter_chunks(stream, args.shots):
+                pass
+            sample_seconds=time.perf_counter()-t0
+            seconds=[]
+            for name in (args.a, args.b, args.a):
+                t0=time.perf_counter()
+                store.decode(stream, args.shots, compile_decoder(circuit, name), name)
+                seconds.append(time.perf_counter()-t0)
+            comparison=store.compare(stream, args.shots, args.a, args.b)
+            print(f"{d:>4} {comparison.errors_a/comparison.shots:>10.3e} {comparison.errors_b/comparison.shots:>10.3e} "
+                  f"{comparison.only_a:>7} {comparison.only_b:>7} {comparison.p_value:>9.2e} {sample_seconds:>11.2f} "
+                  f"{seconds[0]:>7.2f} {seconds[1]:>7.2f} {seconds[2]:>12.2f}", flush=True)
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,80 @@
+'''
+Compares two JSON reports of run_benchmarks.py
+
+Every (distance, rounds, basis, stage) timing of the new report is divided
+by the one of the old report. Ratios above --threshold are marked as
+slowdowns, below 1/--threshold as speedups; timings under --min-ms in both
+reports are too noisy to judge and are not marked. With --fail, the exit
+status is 1 if there is any slowdown, for use in CI.
+
+Run from the repository root:
+python benchmarks/compare_benchmarks.py before.json after.json --threshold 1.2
+'''
+import argparse
+import json
+import sys
+
+
+def load(path):
+    with open(path) as f:
+        report=json.load(f)
+    timings={(r['d'], r['rounds'], r['basis'], r['stage']): r['seconds'] for r in report['results']}
+    return report['metadata'], timings
+
+
+def describe(metadata):
+    commit=metadata.get('git_commit') or 'unknown'
+    dirty='+changes' if metadata.get('git_dirty') else ''
+    return (f"{commit[:10]}{dirty} stim {metadata.get('stim')} pymatching {metadata.get('pymatching')} "
+            f"{metadata.get('machine')} {metadata.get('timestamp')}")
+
+
+def main():
+    parser=argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=1.25)
+    parser.add_argument('--min-ms', type=float, default=1.0)
+    parser.add_argument('--stages', nargs='+', default=None, help='only compare these stages')
+    parser.add_argument('--only-changes', action='store_true', help='print only the marked rows')
+    parser.add_argument('--fail', action='store_true', help='exit with status 1 on any slowdown')
+    args=parser.parse_args()
+
+    old_metadata, old=load(args.old)
+    new_metadata, new=load(args.new)
+    print(f"old: {describe(old_metadata)}")
+    print(f"new: {describe(new_metadata)}")
+    for name in ('stim', 'pymatching', 'numpy', 'python', 'machine', 'shots', 'p'):
+        if old_metadata.get(name)!=new_metadata.get(name):
+            print(f"warning: {name} differs ({old_metadata.get(name)} -> {new_metadata.get(name)})")
+
+    keys=[key for key in new if key in old and (args.stages is None or key[3] in args.stages)]
+    missing=[key for key in old if key not in new]
+    slowdowns=0
+    speedups=0
+    print(f"{'d':>4} {'rounds':>7} {'basis':>5} {'stage':>11} {'old (ms)':>11} {'new (ms)':>11} {'ratio':>7}")
+    for key in sorted(keys):
+        old_ms=1e3*old[key]
+        new_ms=1e3*new[key]
+        ratio=new[key]/old[key] if old[key]>0 else float('inf')
+        mark=''
+        if max(old_ms, new_ms)>=args.min_ms:
+            if ratio>args.threshold:
+                mark='slower'
+                slowdowns+=1
+            elif ratio<1/args.threshold:
+                mark='faster'
+                speedups+=1
+        if mark or not args.only_changes:
+            d, rounds, basis, stage=key
+            print(f"{d:>4} {rounds:>7} {basis:>5} {stage:>11} {old_ms:>11.2f} {new_ms:>11.2f} {ratio:>7.2f} {mark}")
+
+    print(f"{len(keys)} timings compared, {slowdowns} slower, {speedups} faster (threshold {args.threshold}x)")
+    if missing:
+        print(f"{len(missing)} timings of the old report are not in the new one")
+    if args.fail and slowdowns:
+        sys.exit(1)
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,208 @@
+'''
+Benchmark suite of the heavy-hex pipeline, with results saved as JSON
+
+Every (distance, rounds, basis) point is timed through the stages:
+
+build_text  HeavyHexCode.create_heavy_hex_code() -- the program text
+parse       stim.Circuit(...) on that text
+build_stim  HeavyHexCode.create_heavy_hex_code(backend='stim')
+dem         the decomposed detector error model (dem_cache.build_detector_error_model)
+matching    pymatching.Matching.from_detector_error_model
+sample      compiling the detector sampler and sampling --shots bit-packed shots
+decode      Matching.decode_batch on those shots
+
+The circuit cache is bypassed, and every stage of --stages is timed
+--repeats times (or until --repeat-budget seconds are spent on it), keeping
+the best time. Stages left out are not timed, and run once only if a later
+stage needs their result. The sizes of every point (detectors, and errors
+and edges when the DEM is built) are in the 'points' list of the JSON file. The
+JSON file has the versions, the git commit and the machine next to the
+timings, so that two runs can be compared with compare_benchmarks.py:
+
+python benchmarks/run_benchmarks.py --output before.json
+(change the code)
+python benchmarks/run_benchmarks.py --output after.json
+python benchmarks/compare_benchmarks.py before.json after.json
+
+--rounds takes numbers and multiples of d: --rounds 1 d 10d (the default).
+--quick runs a small grid that takes seconds.
+'''
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pymatching
+import stim
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from heavy_hex_code import HeavyHexCode
+from dem_cache import build_detector_error_model
+from sweep import uniform_noise
+
+STAGES=('build_text', 'parse', 'build_stim', 'dem', 'matching', 'sample', 'decode')
+DEFAULT_DISTANCES=(3, 5, 7, 9, 11, 13, 15, 17, 19, 21, 23, 25)
+DEFAULT_ROUNDS=('1', 'd', '10d')
+QUICK_DISTANCES=(3, 5, 7)
+QUICK_ROUNDS=('1', 'd')
+
+
+def parse_rounds(spec, d):
+    '''
+    The number of rounds of a --rounds entry at distance d: '5', 'd' or '10d'
+    '''
+    if spec.endswith('d'):
+        factor=spec[:-1]
+        return d*(int(factor) if factor else 1)
+    return int(spec)
+
+
+def best_time(fn, repeats, budget):
+    '''
+    Returns the best wall time of fn() over up to repeats calls (fewer once
+    budget seconds are spent), the number of calls, and the last result
+    '''
+    best=float('inf')
+    result=None
+    spent=0.0
+    calls=0
+    while calls<repeats and (calls==0 or spent<budget):
+        t0=time.perf_counter()
+        result=fn()
+        seconds=time.perf_counter()-t0
+        best=min(best, seconds)
+        spent+=seconds
+        calls+=1
+    return best, calls, result
+
+
+def git_commit():
+    '''
+    The (commit, dirty) of the repository, or (None, None) outside of git
+    '''
+    root=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit=subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=root, capture_output=True, text=True,
+                              check=True).stdout.strip()
+        status=subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=root,
+                              capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(status.strip())
+
+
+def metadata(args):
+    commit, dirty=git_commit()
+    return {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'git_commit': commit,
+        'git_dirty': dirty,
+        'python': platform.python_version(),
+        'stim': stim.__version__,
+        'pymatching': pymatching.__version__,
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'system': platform.system(),
+        'cpu_count': os.cpu_count(),
+        'p': args.p,
+        'shots': args.shots,
+        'repeats': args.repeats,
+        'repeat_budget': args.repeat_budget,
+        'seed': args.seed,
+    }
+
+
+def run_point(d, rounds, basis, args):
+    '''
+    Times the stages of one point, returns a dict describing the point and
+    a list of result dicts, one per stage of --stages
+    '''
+    def make_code():
+        return HeavyHexCode(code_distance=d, num_rounds=rounds, basis=basis, **uniform_noise(args.p))
+
+    results=[]
+    def record(stage, fn):
+        seconds, calls, result=best_time(fn, args.repeats, args.repeat_budget)
+        results.append({'d': d, 'rounds': rounds, 'basis': basis, 'stage': stage, 'seconds': seconds, 'calls': calls})
+        return result
+
+    def run(stage, fn):
+        # a stage that is not timed runs once, untimed, if a later stage needs its result
+        return record(stage, fn) if stage in args.stages else fn()
+
+    stages=set(args.stages)
+    if 'build_text' in stages:
+        text=record('build_text', lambda: make_code().create_heavy_hex_code(use_cache=False))
+        results[-1]['characters']=len(text)
+    if 'parse' in stages:
+        if 'build_text' not in stages:
+            text=make_code().create_heavy_hex_code(use_cache=False)
+        circuit=record('parse', lambda: stim.Circuit(text))
+    if 'build_stim' in stages:
+        circuit=record('build_stim', lambda: make_code().create_heavy_hex_code(backend='stim', use_cache=False))
+    if not stages&{'parse', 'build_stim'}:
+        circuit=make_code().create_heavy_hex_code(backend='stim', use_cache=False)
+    point={'d': d, 'rounds': rounds, 'basis': basis, 'detectors': circuit.num_detectors}
+
+    if stages&{'dem', 'matching', 'decode'}:
+        dem=run('dem', lambda: build_detector_error_model(circuit))
+        point['errors']=dem.num_errors
+    if stages&{'matching', 'decode'}:
+        matching=run('matching', lambda: pymatching.Matching.from_detector_error_model(dem))
+        point['edges']=matching.num_edges
+    if stages&{'sample', 'decode'}:
+        def sample():
+            sampler=circuit.compile_detector_sampler(seed=args.seed)
+            return sampler.sample(args.shots, bit_packed=True, separate_observables=True)
+        detection_events, _=run('sample', sample)
+        if 'sample' in stages:
+            results[-1]['shots']=args.shots
+    if 'decode' in stages:
+        record('decode', lambda: matching.decode_batch(detection_events, bit_packed_shots=True,
+                                                       bit_packed_predictions=True))
+        results[-1]['shots']=args.shots
+    return point, results
+
+
+def main():
+    parser=argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--distances', type=int, nargs='+', default=None)
+    parser.add_argument('--rounds', nargs='+', default=None, help="numbers of rounds, e.g. 1 d 10d")
+    parser.add_argument('--bases', nargs='+', default=['X', 'Z'], choices=['X', 'Z', 'XZ'])
+    parser.add_argument('--stages', nargs='+', default=list(STAGES), choices=STAGES)
+    parser.add_argument('--p', type=float, default=1e-3)
+    parser.add_argument('--shots', type=int, default=1000)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--repeat-budget', type=float, default=2.0,
+                        help='stop repeating a stage once this many seconds were spent on it')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--quick', action='store_true', help='a small grid, for a smoke test')
+    parser.add_argument('--output', default='benchmark_results.json')
+    args=parser.parse_args()
+    distances=args.distances or (QUICK_DISTANCES if args.quick else DEFAULT_DISTANCES)
+    round_specs=args.rounds or (QUICK_ROUNDS if args.quick else DEFAULT_ROUNDS)
+
+    report={'metadata': metadata(args), 'points': [], 'results': []}
+    print(f"{'d':>4} {'rounds':>7} {'basis':>5} "+" ".join(f"{stage+' (ms)':>15}" for stage in args.stages))
+    for d in distances:
+        for rounds in sorted({parse_rounds(spec, d) for spec in round_specs}):
+            for basis in args.bases:
+                point, results=run_point(d, rounds, basis, args)
+                report['points'].append(point)
+                report['results']+=results
+                times={r['stage']: r['seconds'] for r in results}
+                print(f"{d:>4} {rounds:>7} {basis:>5} "+" ".join(f"{1e3*times[stage]:>15.2f}" for stage in args.stages),
+                      flush=True)
+                # written after every point, so that a long run that is stopped keeps its results
+                with open(args.output, 'w') as f:
+                    json.dump(report, f, indent=1)
+
+
+if __name__=='__main__':
+    main()
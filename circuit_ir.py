@@ -0,0 +1,367 @@
+'''
+A compact array form of the heavy-hex circuits
+
+HeavyHexCode.create_heavy_hex_code(backend='ir') returns a CircuitIR: the
+instructions of the circuit as numpy arrays instead of program text.
+
+ops         the instruction of every row, an index into INSTRUCTION_NAMES
+arg_ptr     the parens arguments of row k are args[arg_ptr[k]:arg_ptr[k+1]]
+target_ptr  the targets of row k are targets[target_ptr[k]:target_ptr[k+1]];
+            qubits are >=0, measurement records rec[-n] are stored as -n
+channels    the noise channel of the error rows (an index into
+            NOISE_CHANNELS), -1 for the other rows
+skip_zero   error rows left out of the circuit while their probability is 0
+
+The body of a REPEAT follows it; its arguments are the repeat count and the
+number of rows of the body. The IR keeps the errors of probability 0, so
+that with_noise can switch them on, and the REPEAT body, so that with_rounds
+can change the number of rounds; both return a new CircuitIR without
+building the circuit again. to_text, to_stim and save/load serialize it.
+
+Example:
+
+    ir=HeavyHexCode(code_distance=5, num_rounds=5, basis='Z', ...).create_heavy_hex_code(backend='ir')
+    circuit=ir.with_noise(after_clifford_depolarization=2e-3).with_rounds(50).to_stim()
+    ir.save('d5.npz')
+'''
+import numpy as np
+
+INSTRUCTION_NAMES=(
+    'QUBIT_COORDS', 'R', 'RX', 'H', 'CNOT', 'MR', 'M', 'MX', 'TICK',
+    'X_ERROR', 'Z_ERROR', 'DEPOLARIZE1', 'DEPOLARIZE2',
+    'DETECTOR', 'OBSERVABLE_INCLUDE', 'SHIFT_COORDS', 'REPEAT',
+)
+# the noise channels of HeavyHexCode, and the error parameter each one takes its rate from
+NOISE_CHANNELS=('single_qubit_gate', 'cnot', 'readout', 'reset', 'idle')
+CHANNEL_PARAMETERS={
+    'single_qubit_gate': 'after_clifford_depolarization',
+    'cnot': 'after_clifford_depolarization',
+    'readout': 'before_measure_flip_probability',
+    'reset': 'after_reset_flip_probability',
+    'idle': 'before_round_data_depolarization',
+}
+# instructions whose targets are measurement records
+RECORD_INSTRUCTIONS=('DETECTOR', 'OBSERVABLE_INCLUDE')
+FILE_FORMAT_VERSION=1
+
+_OPCODES={name: i for i, name in enumerate(INSTRUCTION_NAMES)}
+_REPEAT=_OPCODES['REPEAT']
+_TICK=_OPCODES['TICK']
+
+
+class CircuitIR:
+    '''
+    The instructions of a circuit as numpy arrays, see the module docstring
+    '''
+
+    def __init__(self, *, ops, arg_ptr, args, target_ptr, targets, channels, skip_zero, per_qubit_noise=False):
+        self.ops=_frozen(ops, np.uint8)
+        self.arg_ptr=_frozen(arg_ptr, np.int64)
+        self.args=_frozen(args, np.float64)
+        self.target_ptr=_frozen(target_ptr, np.int64)
+        self.targets=_frozen(targets, np.int32)
+        self.channels=_frozen(channels, np.int8)
+        self.skip_zero=_frozen(skip_zero, np.bool_)
+        # built with a noise_model: the rates of the errors are per qubit
+        self.per_qubit_noise=per_qubit_noise
+        # the program text of every row but the error and REPEAT rows, made by to_text
+        self._row_texts=None
+
+    @classmethod
+    def from_instructions(cls, instructions, per_qubit_noise=False):
+        '''
+        Packs the codeblock of the 'ir' builder backend: a list of
+        (name, targets, args, noise) tuples, noise being None or
+        (channel, skip_zero), and for a REPEAT the body list in place of the
+        targets and the repeat count as the argument
+        '''
+        rows=[]
+        def flatten(block):
+            for name, targets, args, noise in block:
+                if name=='REPEAT':
+                    start=len(rows)
+                    rows.append(None)
+                    flatten(targets)
+                    rows[start]=(name, (), (args[0], len(rows)-start-1), None)
+                else:
+                    rows.append((name, targets, args, noise))
+        flatten(instructions)
+
+        num_targets=np.array([len(targets) for _, targets, _, _ in rows], dtype=np.int64)
+        num_args=np.array([len(args) for _, _, args, _ in rows], dtype=np.int64)
+        return cls(
+            ops=np.array([_OPCODES[name] for name, _, _, _ in rows], dtype=np.uint8),
+            arg_ptr=np.concatenate([[0], np.cumsum(num_args)]),
+            args=np.array([arg for _, _, args, _ in rows for arg in args], dtype=np.float64),
+            target_ptr=np.concatenate([[0], np.cumsum(num_targets)]),
+            targets=np.array([target for _, targets, _, _ in rows for target in targets], dtype=np.int32),
+            channels=np.array([-1 if noise is None else NOISE_CHANNELS.index(noise[0]) for _, _, _, noise in rows],
+                              dtype=np.int8),
+            skip_zero=np.array([noise is not None and noise[1] for _, _, _, noise in rows], dtype=np.bool_),
+            per_qubit_noise=per_qubit_noise,
+        )
+
+    @property
+    def num_instructions(self):
+        return len(self.ops)
+
+    @property
+    def num_rounds(self):
+        '''
+        The number of rounds of the memory experiment: one more than the
+        repeat count of the REPEAT block
+        '''
+        repeats=np.flatnonzero(self.ops==_REPEAT)
+        if len(repeats)==0:
+            return 1
+        return int(self.args[self.arg_ptr[repeats[0]]])+1
+
+    def instruction(self, k):
+        '''
+        Returns the (name, targets, args) of row k
+        '''
+        return (INSTRUCTION_NAMES[self.ops[k]],
+                self.targets[self.target_ptr[k]:self.target_ptr[k+1]],
+                self.args[self.arg_ptr[k]:self.arg_ptr[k+1]])
+
+    @property
+    def layers(self):
+        '''
+        The layer of every row: the number of TICKs before it, the REPEAT body counted once
+        '''
+        return np.cumsum(self.ops==_TICK)-(self.ops==_TICK)
+
+    @property
+    def error_sites(self):
+        '''
+        The rows of the error instructions
+        '''
+        return np.flatnonzero(self.channels>=0)
+
+    def noise(self):
+        '''
+        The error parameter of every noise channel that has error rows, as
+        keyword arguments of HeavyHexCode (the rate of the first row)
+        '''
+        noise={}
+        for row in self.error_sites:
+            parameter=CHANNEL_PARAMETERS[NOISE_CHANNELS[self.channels[row]]]
+            noise.setdefault(parameter, float(self.args[self.arg_ptr[row]]))
+        return noise
+
+    def with_noise(self, **noise):
+        '''
+        Returns a copy with new error parameters
+
+        Args:
+        noise: Any of after_clifford_depolarization, after_reset_flip_probability,
+        before_measure_flip_probability and before_round_data_depolarization
+        '''
+        unknown=set(noise)-set(CHANNEL_PARAMETERS.values())
+        if unknown:
+            raise ValueError("Unknown error parameters: "+", ".join(sorted(unknown)))
+        if self.per_qubit_noise:
+            raise ValueError("The error rates come from a noise model, build the circuit again with the new one")
+        args=self.args.copy()
+        for channel, parameter in CHANNEL_PARAMETERS.items():
+            if parameter in noise:
+                rows=np.flatnonzero(self.channels==NOISE_CHANNELS.index(channel))
+                args[self.arg_ptr[rows]]=noise[parameter]
+        return self._replace(args=args)
+
+    def with_rounds(self, num_rounds):
+        '''
+        Returns a copy with another number of rounds. The REPEAT body is
+        kept, so only an IR built with at least 2 rounds can get more
+        '''
+        if num_rounds<1:
+            raise ValueError("The number of rounds must be at least 1")
+        repeats=np.flatnonzero(self.ops==_REPEAT)
+        if len(repeats)==0:
+            if num_rounds==1:
+                return self
+            raise ValueError("Without a REPEAT block the rounds cannot be changed, build with num_rounds>=2")
+        row=repeats[0]
+        if num_rounds>1:
+            args=self.args.copy()
+            args[self.arg_ptr[row]]=num_rounds-1
+            return self._replace(args=args)
+
+        # the final round only looks back at the last Z and X checks, which
+        # are the same whether or not the REPEAT block runs
+        body_length=int(self.args[self.arg_ptr[row]+1])
+        keep=np.ones(self.num_instructions, dtype=np.bool_)
+        keep[row:row+body_length+1]=False
+        return self._select(keep)
+
+    # serializers
+    def to_text(self):
+        '''
+        Returns the stim program text
+        '''
+        if self._row_texts is None:
+            self._row_texts=self._format_rows(np.flatnonzero((self.channels<0)&(self.ops!=_REPEAT)))
+        row_texts=self._row_texts
+        edited=np.flatnonzero((self.channels>=0)|(self.ops==_REPEAT))
+        edited_texts=dict(zip(edited.tolist(), self._format_rows(edited, keep_none=False)))
+        arg_ptr=self.arg_ptr.tolist()
+        args=self.args.tolist()
+
+        lines=[]
+        def emit(start, stop, indent):
+            k=start
+            while k<stop:
+                if k not in edited_texts:
+                    lines.append(indent+row_texts[k])
+                    k+=1
+                    continue
+                if self.ops[k]==_REPEAT:
+                    count, body_length=int(args[arg_ptr[k]]), int(args[arg_ptr[k]+1])
+                    lines.append(indent+"REPEAT "+str(count)+" {")
+                    emit(k+1, k+1+body_length, indent+"\t")
+                    lines.append(indent+"}")
+                    k+=body_length+1
+                    continue
+                if edited_texts[k] is not None:
+                    lines.append(indent+edited_texts[k])
+                k+=1
+        emit(0, self.num_instructions, "")
+        return "\n".join(lines)+"\n"
+
+    def to_stim(self):
+        '''
+        Returns the stim.Circuit
+        '''
+        import stim
+        return stim.Circuit(self.to_text())
+
+    def save(self, path):
+        '''
+        Writes the IR to a compressed .npz file
+        '''
+        np.savez_compressed(
+            path,
+            version=np.int64(FILE_FORMAT_VERSION),
+            names=np.array(INSTRUCTION_NAMES),
+            channel_names=np.array(NOISE_CHANNELS),
+            per_qubit_noise=np.bool_(self.per_qubit_noise),
+            **self._arrays(),
+        )
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Reads an IR written by save
+        '''
+        with np.load(path) as data:
+            if int(data['version'])!=FILE_FORMAT_VERSION:
+                raise ValueError("Unsupported circuit IR file version "+str(int(data['version'])))
+            # the opcodes and channels are stored with their names, so files survive reordering
+            opcodes=np.array([_OPCODES[str(name)] for name in data['names']], dtype=np.uint8)
+            channel_codes=np.array([NOISE_CHANNELS.index(str(name)) for name in data['channel_names']]+[-1],
+                                   dtype=np.int8)
+            return cls(
+                ops=opcodes[data['ops']],
+                arg_ptr=data['arg_ptr'],
+                args=data['args'],
+                target_ptr=data['target_ptr'],
+                targets=data['targets'],
+                channels=channel_codes[data['channels']],
+                skip_zero=data['skip_zero'],
+                per_qubit_noise=bool(data['per_qubit_noise']),
+            )
+
+    def __eq__(self, other):
+        if not isinstance(other, CircuitIR):
+            return NotImplemented
+        return (self.per_qubit_noise==other.per_qubit_noise
+                and all(np.array_equal(a, b) for a, b in zip(self._arrays().values(), other._arrays().values())))
+
+    def __repr__(self):
+        return (f"CircuitIR(instructions={self.num_instructions}, targets={len(self.targets)}, "
+                f"rounds={self.num_rounds}, error_sites={len(self.error_sites)})")
+
+    # internals
+    def _arrays(self):
+        return {
+            'ops': self.ops,
+            'arg_ptr': self.arg_ptr,
+            'args': self.args,
+            'target_ptr': self.target_ptr,
+            'targets': self.targets,
+            'channels': self.channels,
+            'skip_zero': self.skip_zero,
+        }
+
+    def _replace(self, **arrays):
+        ir=CircuitIR(**{**self._arrays(), **arrays}, per_qubit_noise=self.per_qubit_noise)
+        if set(arrays)=={'args'}:
+            # only the error rates or the repeat count changed, which to_text formats every time
+            ir._row_texts=self._row_texts
+        return ir
+
+    def _format_rows(self, rows, keep_none=True):
+        '''
+        The program text of the given rows, without indentation: a list
+        indexed by row (None for the other rows) if keep_none, else one
+        entry per row, None for the errors of probability 0 that are left out
+        '''
+        ops=self.ops.tolist()
+        arg_ptr=self.arg_ptr.tolist()
+        target_ptr=self.target_ptr.tolist()
+        args=self.args.tolist()
+        targets=self.targets.tolist()
+        texts=[None]*self.num_instructions if keep_none else []
+        for k in rows.tolist():
+            name=INSTRUCTION_NAMES[ops[k]]
+            row_args=args[arg_ptr[k]:arg_ptr[k+1]]
+            if self.channels[k]>=0 and self.skip_zero[k] and not row_args[0]>0.0:
+                text=None
+            else:
+                text=name
+                if row_args and name!='REPEAT':
+                    text+="("+", ".join(_format_number(arg) for arg in row_args)+")"
+                row_targets=targets[target_ptr[k]:target_ptr[k+1]]
+                if name in RECORD_INSTRUCTIONS:
+                    text+="".join(" rec["+str(target)+"]" for target in row_targets)
+                elif row_targets:
+                    text+=" "+" ".join(map(str, row_targets))
+            if keep_none:
+                texts[k]=text
+            else:
+                texts.append(text)
+        return texts
+
+    def _select(self, keep):
+        '''
+        The copy with only the rows where keep is set, whole REPEAT blocks kept or dropped
+        '''
+        arg_keep=np.repeat(keep, np.diff(self.arg_ptr))
+        target_keep=np.repeat(keep, np.diff(self.target_ptr))
+        ir=self._replace(
+            ops=self.ops[keep],
+            arg_ptr=np.concatenate([[0], np.cumsum(np.diff(self.arg_ptr)[keep])]),
+            args=self.args[arg_keep],
+            target_ptr=np.concatenate([[0], np.cumsum(np.diff(self.target_ptr)[keep])]),
+            targets=self.targets[target_keep],
+            channels=self.channels[keep],
+            skip_zero=self.skip_zero[keep],
+        )
+        if self._row_texts is not None:
+            ir._row_texts=[text for text, kept in zip(self._row_texts, keep.tolist()) if kept]
+        return ir
+
+
+def _frozen(array, dtype):
+    array=np.array(array, dtype=dtype)
+    array.flags.writeable=False
+    return array
+
+
+def _format_number(value):
+    '''
+    Integers without a decimal point, the rest exactly (repr)
+    '''
+    if value==int(value):
+        return str(int(value))
+    return repr(value)
@@ -0,0 +1,201 @@
+'''
+Batched sampling and decoding of heavy-hex circuits
+
+The detector sampler of a circuit is compiled once and shots are drawn in
+large bit-packed batches, which are decoded with Matching.decode_batch. This
+avoids sinter's per-task overhead when exploring decoder settings at millions
+of shots per point.
+
+Example:
+
+    from heavy_hex_code import HeavyHexCode
+    from decoders import sample_and_decode
+
+    circuit=HeavyHexCode(code_distance=5, num_rounds=5, basis='Z', ...).create_heavy_hex_code(backend='stim')
+    stats=sample_and_decode(circuit, shots=10**6)
+    print(stats.logical_error_rate, stats.confidence_interval(), stats.shots_per_second)
+'''
+import math
+import time
+
+import numpy as np
+import pymatching
+import stim
+
+from dem_cache import build_detector_error_model
+from sampling import iter_shot_chunks
+
+
+def wilson_interval(errors, shots, z=1.96):
+    '''
+    Returns the (low, high) Wilson score interval of a binomial rate
+
+    Args:
+    errors: Number of failures
+    shots: Number of trials
+    z: The normal quantile -- 1.96 for 95% confidence
+    '''
+    if shots==0:
+        return 0.0, 1.0
+    rate=errors/shots
+    denominator=1+z**2/shots
+    center=(rate+z**2/(2*shots))/denominator
+    half_width=z*math.sqrt(rate*(1-rate)/shots+z**2/(4*shots**2))/denominator
+    return max(0.0, center-half_width), min(1.0, center+half_width)
+
+
+class DecodingStats:
+    '''
+    Logical error counts and throughput of a batched decoding run
+    '''
+
+    def __init__(self, *, shots, errors, observable_errors, sample_seconds, decode_seconds):
+        self.shots=shots
+        self.errors=errors # shots where any observable was mispredicted
+        self.observable_errors=observable_errors # mispredictions per observable
+        self.sample_seconds=sample_seconds
+        self.decode_seconds=decode_seconds
+
+    @property
+    def logical_error_rate(self):
+        return self.errors/self.shots if self.shots else 0.0
+
+    @property
+    def observable_error_rates(self):
+        '''
+        The error rate of every observable -- of the X and the Z memory of an 'XZ' circuit
+        '''
+        if not self.shots:
+            return np.zeros(len(self.observable_errors), dtype=np.float64)
+        return self.observable_errors/self.shots
+
+    def confidence_interval(self, z=1.96):
+        '''
+        The Wilson score interval of the logical error rate
+        '''
+        return wilson_interval(self.errors, self.shots, z)
+
+    @property
+    def shots_per_second(self):
+        '''
+        End to end throughput, sampling included
+        '''
+        seconds=self.sample_seconds+self.decode_seconds
+        return self.shots/seconds if seconds>0 else float('inf')
+
+    @property
+    def decoded_shots_per_second(self):
+        '''
+        Throughput of the decoder alone
+        '''
+        return self.shots/self.decode_seconds if self.decode_seconds>0 else float('inf')
+
+    def __add__(self, other):
+        return DecodingStats(
+            shots=self.shots+other.shots,
+            errors=self.errors+other.errors,
+            observable_errors=self.observable_errors+other.observable_errors,
+            sample_seconds=self.sample_seconds+other.sample_seconds,
+            decode_seconds=self.decode_seconds+other.decode_seconds,
+        )
+
+    def __repr__(self):
+        low, high=self.confidence_interval()
+        return (f"DecodingStats(shots={self.shots}, errors={self.errors}, "
+                f"rate={self.logical_error_rate:.3g} [{low:.3g}, {high:.3g}], "
+                f"shots_per_second={self.shots_per_second:.3g})")
+
+
+def compile_matching(circuit, dem_cache=None):
+    '''
+    Returns the pymatching.Matching of the circuit
+
+    Args:
+    circuit: The stim.Circuit
+    dem_cache: A dem_cache.DemCache to load the matching graph from, if given
+    '''
+    if dem_cache is not None:
+        return dem_cache.matching(circuit)
+    return pymatching.Matching.from_detector_error_model(build_detector_error_model(circuit))
+
+
+def count_mistakes(predictions, observables, num_observables):
+    '''
+    Compares bit-packed predictions with the bit-packed actual observables
+
+    Returns the number of shots with any mistake, and the mistakes per observable
+    '''
+    if predictions.shape[1]<observables.shape[1]: # the matching graph may not know about every observable
+        predictions=np.pad(predictions, ((0, 0), (0, observables.shape[1]-predictions.shape[1])))
+    mistakes=np.bitwise_xor(predictions, observables)
+    errors=int(np.count_nonzero(np.any(mistakes, axis=1)))
+    per_observable=np.unpackbits(mistakes, axis=1, count=num_observables, bitorder='little').sum(axis=0, dtype=np.int64)
+    return errors, per_observable
+
+
+def decode_chunks(chunks, matching, num_observables, *, max_errors=None, decode_kwargs=None):
+    '''
+    Decodes bit-packed (detection_events, observables) chunks with pymatching
+
+    The chunks are consumed one at a time, so memory stays flat whatever the
+    number of shots. The time spent waiting for the next chunk is reported as
+    sampling time.
+
+    Args:
+    chunks: An iterable of chunks, e.g. from sampling.iter_shot_chunks or
+    sampling.iter_shot_file_chunks
+    matching: The pymatching.Matching to decode with
+    num_observables: Observables per shot
+    max_errors: Stop after the chunk in which this many logical errors were seen
+    decode_kwargs: Extra keyword arguments for Matching.decode_batch
+    '''
+    decode_kwargs=decode_kwargs or {}
+    chunks=iter(chunks)
+
+    stats=DecodingStats(shots=0, errors=0, observable_errors=np.zeros(num_observables, dtype=np.int64),
+                        sample_seconds=0.0, decode_seconds=0.0)
+    while max_errors is None or stats.errors<max_errors:
+        t0=time.perf_counter()
+        chunk=next(chunks, None)
+        t1=time.perf_counter()
+        if chunk is None:
+            break
+        detection_events, observables=chunk
+        predictions=matching.decode_batch(detection_events, bit_packed_shots=True,
+                                          bit_packed_predictions=True, **decode_kwargs)
+        t2=time.perf_counter()
+
+        errors, per_observable=count_mistakes(predictions, observables, num_observables)
+        stats+=DecodingStats(shots=len(detection_events), errors=errors, observable_errors=per_observable,
+                             sample_seconds=t1-t0, decode_seconds=t2-t1)
+    return stats
+
+
+def sample_and_decode(circuit, *, shots, matching=None, decoder='pymatching', batch_size=2**16, max_errors=None,
+                      seed=None, dem_cache=None, decode_kwargs=None):
+    '''
+    Samples the circuit and decodes the shots with pymatching, in batches
+
+    Args:
+    circuit: The stim.Circuit (e.g. from HeavyHexCode.create_heavy_hex_code(backend='stim'))
+    shots: Maximum number of shots
+    matching: The pymatching.Matching to decode with, or any decoder with its
+    decode_batch (default: built from the circuit)
+    decoder: The decoder to build when no matching is given, one of batch_decoders.DECODERS
+    batch_size: Shots sampled and decoded at once
+    max_errors: Stop after the batch in which this many logical errors were seen
+    seed: Seed of the stim detector sampler
+    dem_cache: A dem_cache.DemCache to take the matching graph from
+    decode_kwargs: Extra keyword arguments for Matching.decode_batch
+    '''
+    if not isinstance(circuit, stim.Circuit):
+        circuit=stim.Circuit(circuit)
+    if matching is None and decoder=='pymatching':
+        matching=compile_matching(circuit, dem_cache)
+    elif matching is None:
+        # batch_decoders imports this module
+        from batch_decoders import compile_decoder
+        matching=compile_decoder(circuit, decoder, dem_cache=dem_cache)
+    chunks=iter_shot_chunks(circuit, shots, chunk_size=batch_size, seed=seed)
+    return decode_chunks(chunks, matching, circuit.num_observables,
+                         max_errors=max_errors, decode_kwargs=decode_kwargs)
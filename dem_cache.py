@@ -0,0 +1,272 @@
+'''
+Content-addressed on-disk cache of detector error models and matching graphs
+
+All are keyed on the sha256 of the canonical stim text of the circuit, so any
+process that builds the same HeavyHexCode circuit finds them. A cache entry is
+
+<key>.dem                 the detector error model, in stim's text format
+<key>.matching.npz        the edges of the pymatching graph built from it
+<key>-<limits>.table.npz  a lookup_decoder.LookupTable built from it
+
+Files are written atomically (temporary file + os.replace), which makes the
+cache safe to share between the worker processes of a sweep. The total size is
+bounded; the least recently used entries are evicted first.
+'''
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+import pymatching
+import scipy.sparse
+import stim
+
+DEFAULT_CACHE_DIRECTORY=os.path.join(os.path.expanduser('~'), '.cache', 'heavy_hex_code', 'dem')
+DEFAULT_MAX_BYTES=2*1024**3
+
+
+def circuit_hash(circuit):
+    '''
+    Returns the sha256 hex digest of the canonical stim text of the circuit
+
+    Args:
+    circuit: A stim.Circuit or the program text of one
+    '''
+    if not isinstance(circuit, stim.Circuit):
+        circuit=stim.Circuit(circuit)
+    return hashlib.sha256(str(circuit).encode()).hexdigest()
+
+
+def build_detector_error_model(circuit, *, decompose_errors=True):
+    '''
+    Returns the detector error model of the circuit
+
+    With decompose_errors, the errors that stim cannot split into graphlike
+    pieces (some flag-qubit faults of the X memory at d>=7) are kept as
+    hyperedges instead of failing, like sinter does
+    '''
+    if not isinstance(circuit, stim.Circuit):
+        circuit=stim.Circuit(circuit)
+    if not decompose_errors:
+        return circuit.detector_error_model()
+    try:
+        return circuit.detector_error_model(decompose_errors=True)
+    except ValueError:
+        return circuit.detector_error_model(decompose_errors=True, ignore_decomposition_failures=True)
+
+
+def matching_to_arrays(matching):
+    '''
+    Returns the edges of a pymatching.Matching as a dict of numpy arrays
+
+    v is -1 for boundary edges; the fault ids of edge k are
+    fault_ids[fault_ptr[k]:fault_ptr[k+1]]
+    '''
+    edges=matching.edges()
+    fault_ids=[sorted(data['fault_ids']) for _, _, data in edges]
+    return {
+        'u': np.array([u for u, _, _ in edges], dtype=np.int64),
+        'v': np.array([-1 if v is None else v for _, v, _ in edges], dtype=np.int64),
+        'weights': np.array([data['weight'] for _, _, data in edges], dtype=np.float64),
+        'error_probabilities': np.array([data['error_probability'] for _, _, data in edges], dtype=np.float64),
+        'fault_ptr': np.cumsum([0]+[len(f) for f in fault_ids]).astype(np.int64),
+        'fault_ids': np.array([el for f in fault_ids for el in f], dtype=np.int64),
+        'num_detectors': np.int64(matching.num_detectors),
+        'num_fault_ids': np.int64(matching.num_fault_ids),
+    }
+
+
+def check_matrices(arrays):
+    '''
+    Returns the (check_matrix, faults_matrix) of the edges in matching_to_arrays
+    format, with one column per edge -- boundary edges have a single 1
+    '''
+    u=arrays['u']
+    v=arrays['v']
+    num_edges=len(u)
+    num_detectors=int(arrays['num_detectors'])
+    num_fault_ids=int(arrays['num_fault_ids'])
+
+    internal=v>=0
+    rows=np.concatenate([u, v[internal]])
+    cols=np.concatenate([np.arange(num_edges), np.arange(num_edges)[internal]])
+    check_matrix=scipy.sparse.csc_matrix((np.ones(len(rows), dtype=np.uint8), (rows, cols)),
+                                         shape=(num_detectors, num_edges))
+
+    fault_ptr=arrays['fault_ptr']
+    fault_cols=np.repeat(np.arange(num_edges), np.diff(fault_ptr))
+    faults_matrix=scipy.sparse.csc_matrix((np.ones(len(fault_cols), dtype=np.uint8), (arrays['fault_ids'], fault_cols)),
+                                          shape=(num_fault_ids, num_edges))
+    return check_matrix, faults_matrix
+
+
+def matching_from_arrays(arrays):
+    '''
+    Rebuilds a pymatching.Matching from matching_to_arrays output
+    '''
+    if len(arrays['u'])==0:
+        return pymatching.Matching()
+    check_matrix, faults_matrix=check_matrices(arrays)
+    return pymatching.Matching.from_check_matrix(
+        check_matrix,
+        weights=arrays['weights'],
+        error_probabilities=arrays['error_probabilities'],
+        faults_matrix=faults_matrix,
+        use_virtual_boundary_node=True,
+    )
+
+
+class DemCache:
+    '''
+    A size-bounded LRU cache of detector error models and matching graphs on disk
+    '''
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+        '''
+        Args:
+        directory: Where the entries are kept (default: $HEAVY_HEX_DEM_CACHE
+        or ~/.cache/heavy_hex_code/dem)
+        max_bytes: Size the cache is trimmed back to after every write
+        '''
+        if directory is None:
+            directory=os.environ.get('HEAVY_HEX_DEM_CACHE', DEFAULT_CACHE_DIRECTORY)
+        self.directory=directory
+        self.max_bytes=max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, circuit, decompose_errors=True):
+        '''
+        The cache key of the detector error model of the circuit
+        '''
+        return circuit_hash(circuit)+('-decomposed' if decompose_errors else '')
+
+    def detector_error_model(self, circuit, *, decompose_errors=True):
+        '''
+        Returns circuit.detector_error_model(decompose_errors=...), from the cache if possible
+        '''
+        path=self._path(self.key(circuit, decompose_errors), '.dem')
+        try:
+            dem=stim.DetectorErrorModel.from_file(path)
+        except (FileNotFoundError, ValueError): # not cached, or evicted by another process
+            pass
+        else:
+            self._touch(path)
+            return dem
+
+        dem=build_detector_error_model(circuit, decompose_errors=decompose_errors)
+        self._write(path, lambda f: f.write(str(dem).encode()))
+        return dem
+
+    def matching(self, circuit):
+        '''
+        Returns the pymatching.Matching of the circuit, from the cache if possible
+        '''
+        path=self._path(self.key(circuit), '.matching.npz')
+        try:
+            with np.load(path) as arrays:
+                matching=matching_from_arrays(arrays)
+        except (FileNotFoundError, ValueError): # not cached, or evicted by another process
+            pass
+        else:
+            self._touch(path)
+            return matching
+
+        matching=pymatching.Matching.from_detector_error_model(self.detector_error_model(circuit))
+        arrays=matching_to_arrays(matching)
+        self._write(path, lambda f: np.savez(f, **arrays))
+        return matching
+
+    def lookup_table(self, circuit, *, max_faults=2, max_weight=None):
+        '''
+        Returns the lookup_decoder.LookupTable of the circuit, from the cache if possible
+        '''
+        # lookup_decoder imports this module
+        from lookup_decoder import LookupTable
+
+        limits=f'-{max_faults}f'+('' if max_weight is None else f'-{max_weight}w')
+        path=self._path(self.key(circuit)+limits, '.table.npz')
+        try:
+            table=LookupTable.load(path)
+        except (FileNotFoundError, ValueError): # not cached, or evicted by another process
+            pass
+        else:
+            self._touch(path)
+            return table
+
+        table=LookupTable.build(self.detector_error_model(circuit), max_faults=max_faults, max_weight=max_weight)
+        self._write(path, table.save)
+        return table
+
+    def size_bytes(self):
+        '''
+        Total size of the cache entries
+        '''
+        return sum(size for _, size, _ in self._entries())
+
+    def clear(self):
+        '''
+        Removes every cache entry
+        '''
+        for path, _, _ in self._entries():
+            self._remove(path)
+
+    # internals
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key+suffix)
+
+    def _entries(self):
+        entries=[]
+        for name in os.listdir(self.directory):
+            if not name.endswith(('.dem', '.matching.npz', '.table.npz')):
+                continue
+            path=os.path.join(self.directory, name)
+            try:
+                stat=os.stat(path)
+            except FileNotFoundError: # evicted by another process
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _touch(self, path):
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _write(self, path, write):
+        fd, tmp_path=tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            self._remove(tmp_path)
+            raise
+        self._evict()
+
+    def _evict(self):
+        entries=sorted(self._entries(), key=lambda entry: entry[2])
+        total=sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total<=self.max_bytes:
+                break
+            self._remove(path)
+            total-=size
+
+
+_default_cache=None
+
+def default_cache():
+    '''
+    The DemCache in the default directory, created on first use
+    '''
+    global _default_cache
+    if _default_cache is None:
+        _default_cache=DemCache()
+    return _default_cache
@@ -0,0 +1,137 @@
+'''
+Lookup of detectors by their space-time coordinates
+
+The detectors of HeavyHexCode have (i, j, round) coordinates -- the grid
+position of the qubit they belong to and the round, which SHIFT_COORDS
+advances in every repetition of the REPEAT block. DetectorIndex sorts them
+into a (round, i, j) grid once, after which the detectors of a cell, of a
+range of rounds or of a block of rows are numpy slices:
+
+    index=code.detector_index() # or DetectorIndex.from_circuit(circuit)
+    index.at(3, 4, round=2)     # the detectors of one cell
+    index.in_rounds(5, 10)      # all detectors of rounds 5 to 9
+    index.round_slice(5, 10)    # the same as a slice of detector ids
+    index.region(rounds=(5, 10), rows=(0, 4))
+
+Several detectors can share a cell: the flag and the Z gauge detectors of
+the heavy-hex code sit on the same grid positions.
+'''
+import numpy as np
+
+
+class DetectorIndex:
+    '''
+    The detectors of a circuit, sorted into a (round, i, j) grid
+    '''
+
+    def __init__(self, coordinates):
+        '''
+        Args:
+        coordinates: (num_detectors, 3) integer (i, j, round) coordinates, in detector order
+        '''
+        coordinates=np.asarray(coordinates)
+        if coordinates.ndim!=2 or coordinates.shape[1]!=3:
+            raise ValueError("Detector coordinates must be (i, j, round) triples")
+        if not np.issubdtype(coordinates.dtype, np.integer):
+            if not np.all(coordinates==np.round(coordinates)):
+                raise ValueError("Detector coordinates must be integers")
+            coordinates=np.round(coordinates)
+        self.coordinates=coordinates.astype(np.int64)
+        self.coordinates.flags.writeable=False
+        if len(self.coordinates) and self.coordinates.min()<0:
+            raise ValueError("Detector coordinates must not be negative")
+        self.num_detectors=len(self.coordinates)
+
+        rows, cols, rounds=(self.coordinates.max(axis=0)+1) if self.num_detectors else (0, 0, 0)
+        self.shape=(int(rounds), int(rows), int(cols)) # (rounds, i, j)
+        cells=self._cells(self.coordinates[:, 2], self.coordinates[:, 0], self.coordinates[:, 1])
+        # order lists the detectors cell by cell, the detectors of cell c are order[cell_ptr[c]:cell_ptr[c+1]]
+        self.order=np.argsort(cells, kind='stable')
+        self.cell_ptr=np.searchsorted(cells[self.order], np.arange(int(np.prod(self.shape))+1))
+        self.order.flags.writeable=False
+        self.cell_ptr.flags.writeable=False
+
+        # detector ids of round t are round_ptr[t]..round_ptr[t+1]-1, if the detectors are in round order
+        self.rounds_in_order=bool(np.all(np.diff(self.rounds)>=0))
+        self.round_ptr=np.searchsorted(self.rounds, np.arange(self.shape[0]+1)) if self.rounds_in_order else None
+
+    @classmethod
+    def from_circuit(cls, circuit):
+        '''
+        The index of the DETECTOR coordinates of a stim.Circuit, shifts applied
+        '''
+        coordinates=circuit.get_detector_coordinates()
+        if any(len(coordinates[k])!=3 for k in range(circuit.num_detectors)):
+            raise ValueError("Every detector needs (i, j, round) coordinates")
+        return cls(np.array([coordinates[k] for k in range(circuit.num_detectors)], dtype=np.float64).reshape(-1, 3))
+
+    @property
+    def rounds(self):
+        '''
+        The round of every detector
+        '''
+        return self.coordinates[:, 2]
+
+    @property
+    def num_rounds(self):
+        return self.shape[0]
+
+    def at(self, i, j, round):
+        '''
+        Returns the detectors at grid position (i, j) in a round
+        '''
+        if not (0<=round<self.shape[0] and 0<=i<self.shape[1] and 0<=j<self.shape[2]):
+            return self.order[:0]
+        cell=self._cells(round, i, j)
+        return self.order[self.cell_ptr[cell]:self.cell_ptr[cell+1]]
+
+    def in_rounds(self, first, stop=None):
+        '''
+        Returns the detectors of rounds first..stop-1 (default: only round
+        first), sorted by (round, i, j)
+        '''
+        first, stop=self._round_range(first, stop)
+        cells_per_round=self.shape[1]*self.shape[2]
+        return self.order[self.cell_ptr[first*cells_per_round]:self.cell_ptr[stop*cells_per_round]]
+
+    def round_slice(self, first, stop=None):
+        '''
+        Returns the slice of detector ids of rounds first..stop-1 (default:
+        only round first), for circuits whose detectors are in round order
+        '''
+        if not self.rounds_in_order:
+            raise ValueError("The detectors are not in round order, use in_rounds")
+        first, stop=self._round_range(first, stop)
+        return slice(int(self.round_ptr[first]), int(self.round_ptr[stop]))
+
+    def region(self, rounds=None, rows=None, cols=None):
+        '''
+        Returns the detectors in a block of the grid, sorted by (round, i, j)
+
+        Args:
+        rounds, rows, cols: (first, stop) ranges of rounds, i and j (default: all)
+        '''
+        first_round, stop_round=self._clip(rounds, 0)
+        first_row, stop_row=self._clip(rows, 1)
+        first_col, stop_col=self._clip(cols, 2)
+        if first_round>=stop_round or first_row>=stop_row or first_col>=stop_col:
+            return self.order[:0]
+        t, i=np.meshgrid(np.arange(first_round, stop_round), np.arange(first_row, stop_row), indexing='ij')
+        starts=self.cell_ptr[self._cells(t, i, first_col).ravel()]
+        stops=self.cell_ptr[self._cells(t, i, stop_col-1).ravel()+1]
+        return np.concatenate([self.order[a:b] for a, b in zip(starts, stops)])
+
+    # internals
+    def _cells(self, t, i, j):
+        return (t*self.shape[1]+i)*self.shape[2]+j
+
+    def _round_range(self, first, stop):
+        if stop is None:
+            stop=first+1
+        return min(max(first, 0), self.shape[0]), min(max(stop, 0), self.shape[0])
+
+    def _clip(self, bounds, axis):
+        if bounds is None:
+            return 0, self.shape[axis]
+        first, stop=bounds
+        return max(first, 0), min(stop, self.shape[axis])
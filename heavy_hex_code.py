@@ -1,7 +1,56 @@
-import stim
-import pymatching
+import collections
+import enum
+import functools
+import re
+import time
+
+# stim is imported where the 'stim' backend (or an 'XZ' circuit) needs it, and
+# the decoders are lazy attributes (see _LAZY_ATTRIBUTES), so that a process
+# that only builds circuit text does not pay for importing them
 import numpy as np
 
+from circuit_ir import CircuitIR
+from detector_index import DetectorIndex
+
+# number of code distances whose layout and CNOT schedule are kept around
+LAYOUT_CACHE_SIZE=64
+# number of finished circuits kept around by create_heavy_hex_code
+CIRCUIT_CACHE_SIZE=128
+
+class QubitRole(enum.IntFlag):
+    '''
+    The roles a position on the heavy-hex grid can play. Flag qubits also act
+    as Z gauge qubits, so their role is Z_GAUGE|FLAG
+    '''
+    NONE=0
+    DATA=1
+    X_GAUGE=2
+    Z_GAUGE=4
+    FLAG=8
+
+
+def _builder_stage(method):
+    '''
+    Marks a method as a builder stage, whose time and output size are
+    recorded when create_heavy_hex_code is given a BuildProfiler. Stages
+    called from within another stage are part of the outer one
+    '''
+    @functools.wraps(method)
+    def stage(self, *args, **kwargs):
+        profiler=self._profiler
+        if profiler is None or profiler._depth>0:
+            return method(self, *args, **kwargs)
+        profiler._depth+=1
+        try:
+            t0=time.perf_counter()
+            codeblock=method(self, *args, **kwargs)
+            seconds=time.perf_counter()-t0
+        finally:
+            profiler._depth-=1
+        profiler.record(method.__name__.lstrip('_'), seconds, codeblock)
+        return codeblock
+    return stage
+
 class HeavyHexCode:
     '''
     A class to generate one instance of the heavy-hex code
@@ -11,18 +60,25 @@ class HeavyHexCode:
                 after_clifford_depolarization,
                 after_reset_flip_probability,
                 before_measure_flip_probability,
-                before_round_data_depolarization):
-        
-        # code parameters
-        self.cd=code_distance
+                before_round_data_depolarization,
+                noise_model=None):
+        
+        # code parameters -- code_distance is d, or (dx, dz) for a rectangular patch
+        self.dx, self.dz=_distances(code_distance)
+        self.cd=min(self.dx, self.dz)
+        # the (rows, columns) of the qubit grid, the qubit labels run over it row by row
+        self.grid_shape=_grid_shape(self.dx, self.dz)
         self.nr=num_rounds
-        self.basis=basis
+        self.basis=basis # 'X', 'Z', or 'XZ' for both memory experiments side by side in one circuit
         
         # error parameters
         self.acd=after_clifford_depolarization
         self.arfp=after_reset_flip_probability
         self.bmfp=before_measure_flip_probability
         self.brdd=before_round_data_depolarization
+        # per-qubit and per-pair rates (e.g. a noise_model.DeviceNoiseModel), the four
+        # parameters above are then the rates of the qubits it does not list
+        self.noise_model=noise_model
         
         # define the qubit-types
         self.data_qubits=None # data qubits
@@ -30,6 +86,8 @@ class HeavyHexCode:
         self.flag_qubits=None # these are the flag qubits -- all of them also act as Z gauge measurements
         self.z_gauge_qubits=None # these are the Z gauge qubits -- quite a few of them also act as flag qubits. We combine them together to do Z stabilizers
         
+        self.qubit_roles=None # QubitRole flags of every position on the grid, indexed by qubit label
+        
         self._label_qubits()
         
         # define the CNOT sets -- corresponding to the measurement cycles
@@ -45,233 +103,309 @@ class HeavyHexCode:
         
         self._get_cnot_sets(self.x_gauge_qubits, self.data_qubits)
         
-        # measurement history
-        self.total_measurement_history={i:[] for i in self.data_qubits+self.x_gauge_qubits+self.z_gauge_qubits} # the flag qubits are subset of the z-gauge qubits
-        self.current_measurement_counter=0
-    
+        # measurement history -- an array-backed ledger indexed by qubit label
+        self.measurement_ledger=None
+        self._reset_measurement_history()
+
+        # QubitRole, round and coordinates of every detector of the last circuit built, see detector_roles;
+        # the per-detector arrays are made out of the log on first use
+        self._detector_role_log=None
+        self._detector_roles=None
+        self._detector_rounds=None
+        self._detector_coordinates=None
+        # sum of the SHIFT_COORDS time shifts emitted so far
+        self._round_shift=0
+
+        # the builder backend -- 'text' and 'stim' emit stim program text ('stim' parses it once at the end),
+        # 'ir' collects (name, targets, args, noise) tuples for a circuit_ir.CircuitIR
+        self._backend='text'
+        
+        # the BuildProfiler of the circuit being built, if any
+        self._profiler=None
+
     # called during initialization
     def _label_qubits(self):
         '''
         For all physical qubits in the code, label each qubit with a unique
         ID. And sort the qubits out according to their functionality - i.e.
         data_qubit/x_gauge_qubit/flag_qubit
+
+        The labels only depend on the code distance and are cached per distance
         '''
-        data_qubits=[]
-        x_gauge_qubits=[]
-        flag_qubits=[]
-        z_gauge_qubits=[]
+        data_qubits, x_gauge_qubits, flag_qubits, z_gauge_qubits=_qubit_labels(self.grid_shape)
         
-        code_distance=self.cd    
-        n_rows=2*code_distance-1
-        n_cols=2*code_distance-1
-        
-        for i in range(n_rows):
-            for j in range(n_cols):
-                
-                qubit_label=n_cols*i+j
-                
-                if i%2==0 and j%2==0: # the data qubits
-                    data_qubits.append(qubit_label)
-                elif ((i%4==1 or i==n_rows-1) and j%4==3) or ((i%4==3 or i==0) and j%4==1): # the X gauge qubits in the bulk
-                    x_gauge_qubits.append(qubit_label)
-                elif (j%2==0 and i%2==1): # the z-stb qubits
-                    z_gauge_qubits.append(qubit_label)
-                    if not((j==0 and i%4==1) or (j==n_cols-1 and i%4==3)): 
-                        flag_qubits.append(qubit_label) # flag qubits
-                else:
-                    continue
+        self.data_qubits=list(data_qubits)
+        self.x_gauge_qubits=list(x_gauge_qubits)
+        self.flag_qubits=list(flag_qubits)
+        self.z_gauge_qubits=list(z_gauge_qubits)
         
-        self.data_qubits=data_qubits
-        self.x_gauge_qubits=x_gauge_qubits
-        self.flag_qubits=flag_qubits
-        self.z_gauge_qubits=z_gauge_qubits
+        # role index over the grid
+        self.qubit_roles=_role_index(self.grid_shape)
     
     def _get_cnot_sets(self, x_gauge_qubits, data_qubits):
         '''
         Args:
         data_qubits: The data qubits
+
+        The CNOT schedule only depends on the grid shape and is cached per shape
         '''
-        code_distance=self.cd    
-        n_rows=2*code_distance-1
-        n_cols=2*code_distance-1
-        
-        # before applying the X gauge checks, we categorize the qubits into the different sets
-        # this convention is according to Fig 2 of Chamberland et al - arxiv 1907.09528v2
-        second_cycle_pairs=[]
-        third_cycle_pairs=[]
-        fourth_cycle_pairs=[]
-        fifth_cycle_pairs=[]
-        sixth_cycle_pairs=[]
-        
-        eighth_cycle_pairs=[]
-        ninth_cycle_pairs=[]
-        tenth_cycle_pairs=[]
-        
-        for i in range(n_rows):
-            for j in range(n_cols):
-                if j%2==0 and i%2==1:
-                    qubit_label=n_rows*i+j
-                    
-                    # the bulk x-gauge checks
-                    if qubit_label-1 in x_gauge_qubits:
-                        second_cycle_pairs.append((qubit_label-1, qubit_label))
-                        fifth_cycle_pairs.append((qubit_label-1, qubit_label))
-                        if qubit_label-n_cols in data_qubits:
-                            third_cycle_pairs.append((qubit_label, qubit_label-n_cols))
-                            eighth_cycle_pairs.append((qubit_label-n_cols, qubit_label))
-                        if qubit_label+n_cols in data_qubits:
-                            fourth_cycle_pairs.append((qubit_label, qubit_label+n_cols))
-                            ninth_cycle_pairs.append((qubit_label+n_cols, qubit_label))
-                    if qubit_label+1 in x_gauge_qubits:
-                        third_cycle_pairs.append((qubit_label+1, qubit_label))
-                        sixth_cycle_pairs.append((qubit_label+1, qubit_label))
-                        if qubit_label+n_cols in data_qubits:
-                            fourth_cycle_pairs.append((qubit_label, qubit_label+n_cols))
-                            ninth_cycle_pairs.append((qubit_label+n_cols, qubit_label))
-                        if qubit_label-n_cols in data_qubits:
-                            fifth_cycle_pairs.append((qubit_label, qubit_label-n_cols))
-                            tenth_cycle_pairs.append((qubit_label-n_cols, qubit_label))
-                    if not(qubit_label+1 in x_gauge_qubits) and not(qubit_label-1 in x_gauge_qubits):
-                        if j==0:
-                            if qubit_label-n_cols in data_qubits:
-                                eighth_cycle_pairs.append((qubit_label-n_cols, qubit_label))
-                            if qubit_label+n_cols in data_qubits:
-                                ninth_cycle_pairs.append((qubit_label+n_cols, qubit_label))
-                        elif j==n_cols-1:
-                            if qubit_label-n_cols in data_qubits:
-                                tenth_cycle_pairs.append((qubit_label-n_cols, qubit_label))
-                            if qubit_label+n_cols in data_qubits:
-                                ninth_cycle_pairs.append((qubit_label+n_cols, qubit_label))
-                    
-                # bacon-strip checks
-                elif i==0 and j%4==2:
-                    qubit_label=n_rows*i+j
-                    if qubit_label-1 in x_gauge_qubits:
-                        fourth_cycle_pairs.append((qubit_label-1, qubit_label))
-                elif i==0 and j%4==0:
-                    qubit_label=n_rows*i+j
-                    if qubit_label+1 in x_gauge_qubits:
-                        fifth_cycle_pairs.append((qubit_label+1, qubit_label))
-                elif i==n_rows-1 and j%4==2:
-                    qubit_label=n_rows*i+j
-                    if qubit_label+1 in x_gauge_qubits:
-                        sixth_cycle_pairs.append((qubit_label+1, qubit_label))
-                elif i==n_rows-1 and j%4==0:
-                    qubit_label=n_rows*i+j
-                    if qubit_label-1 in x_gauge_qubits:
-                        fifth_cycle_pairs.append((qubit_label-1, qubit_label))
+        cnot_sets=_cnot_sets(self.grid_shape)
         
         # label the CNOT sets
-        self.second_cycle_pairs=second_cycle_pairs
-        self.third_cycle_pairs=third_cycle_pairs
-        self.fourth_cycle_pairs=fourth_cycle_pairs
-        self.fifth_cycle_pairs=fifth_cycle_pairs
-        self.sixth_cycle_pairs=sixth_cycle_pairs
-        
-        self.eighth_cycle_pairs=eighth_cycle_pairs
-        self.ninth_cycle_pairs=ninth_cycle_pairs
-        self.tenth_cycle_pairs=tenth_cycle_pairs
-        
-   
+        self.second_cycle_pairs=list(cnot_sets[0])
+        self.third_cycle_pairs=list(cnot_sets[1])
+        self.fourth_cycle_pairs=list(cnot_sets[2])
+        self.fifth_cycle_pairs=list(cnot_sets[3])
+        self.sixth_cycle_pairs=list(cnot_sets[4])
+        
+        self.eighth_cycle_pairs=list(cnot_sets[5])
+        self.ninth_cycle_pairs=list(cnot_sets[6])
+        self.tenth_cycle_pairs=list(cnot_sets[7])
+
+    def _reset_measurement_history(self):
+        '''
+        Clears the measurement history. Every circuit build starts from here,
+        so generating twice on the same instance gives the same rec[...] offsets
+        '''
+        self.measurement_ledger=MeasurementLedger(self.grid_shape[0]*self.grid_shape[1])
+
+    @property
+    def total_measurement_history(self):
+        '''
+        The measurement indices of every qubit, as a dict of lists
+        '''
+        qubits=self.data_qubits+self.x_gauge_qubits+self.z_gauge_qubits # the flag qubits are subset of the z-gauge qubits
+        return {i:self.measurement_ledger.history(i) for i in qubits}
+
+    @property
+    def current_measurement_counter(self):
+        '''
+        The number of measurements made so far
+        '''
+        return self.measurement_ledger.counter
+
+    def detector_roles(self):
+        '''
+        Returns a uint8 array with the QubitRole of every detector of the
+        circuit, in detector (and detector error model) order
+
+        Detectors of the flag qubit measurements are QubitRole.FLAG, those
+        that compare the final data measurements with the last stabilizer
+        measurements are QubitRole.DATA. The roles do not depend on the
+        error parameters
+        '''
+        self._tabulate_detectors()
+        return self._detector_roles
+
+    def detector_rounds(self):
+        '''
+        Returns an int64 array with the round of every detector of the
+        circuit, in detector (and detector error model) order
+
+        The detectors of the first round are in round 0, those of the k-th
+        repetition of the REPEAT block in round k, and the detectors of the
+        final data measurements in round num_rounds
+        '''
+        self._tabulate_detectors()
+        return self._detector_rounds
+
+    def detector_coordinates(self):
+        '''
+        Returns a (num_detectors, 3) int64 array with the (i, j, round)
+        coordinates of every detector, the same as the DETECTOR coordinates
+        of the circuit with the SHIFT_COORDS shifts applied
+        '''
+        self._tabulate_detectors()
+        return self._detector_coordinates
+
+    def _tabulate_detectors(self):
+        '''
+        Makes the per-detector arrays out of the detector log of the last
+        circuit built, building one first if there is none
+        '''
+        if self._detector_roles is not None:
+            return
+        if self._detector_role_log is None:
+            self.create_heavy_hex_code(use_cache=False)
+            if self._detector_roles is not None:
+                return
+        log=self._detector_role_log
+        counts=[len(coords) for _, _, coords in log]
+        roles=np.repeat(np.array([int(role) for role, _, _ in log], dtype=np.uint8), counts)
+        rounds=np.repeat(np.array([r for _, r, _ in log], dtype=np.int64), counts)
+        coordinates=np.zeros((len(rounds), 3), dtype=np.int64)
+        if len(rounds):
+            # the rounds of the REPEAT block share their coordinate tuples, convert each one once
+            converted={}
+            for _, _, coords in log:
+                if id(coords) not in converted:
+                    converted[id(coords)]=np.array(coords, dtype=np.int64).reshape(-1, 2)
+            coordinates[:, :2]=np.concatenate([converted[id(coords)] for _, _, coords in log])
+        coordinates[:, 2]=rounds
+        for array in (roles, rounds, coordinates):
+            array.flags.writeable=False
+        self._detector_roles, self._detector_rounds, self._detector_coordinates=roles, rounds, coordinates
+
+    def detector_index(self):
+        '''
+        Returns the detector_index.DetectorIndex of the circuit, to look
+        detectors up by round and position
+        '''
+        return DetectorIndex(self.detector_coordinates())
+
+    # the builder backends
+    def _new_block(self):
+        '''
+        Returns an empty codeblock for the active backend. Both kinds of
+        codeblock support +=, so the helpers below assemble them the same way
+        '''
+        if self._backend=='ir':
+            return []
+        return """"""
+
+    def _instruction(self, name, targets, arg=None):
+        '''
+        Emits a single instruction for the active backend
+
+        Args:
+        name: The name of the stim instruction
+        targets: The flat list of qubit targets
+        arg: The parens argument of the instruction, if any
+        '''
+        if self._backend=='ir':
+            args=() if arg is None else tuple(arg) if isinstance(arg, (list, tuple)) else (arg,)
+            return [(name, tuple(targets), args, None)]
+
+        codeblock=name
+        if isinstance(arg, (list, tuple)):
+            codeblock+="""("""+""", """.join(str(el) for el in arg)+""")"""
+        elif arg is not None:
+            codeblock+="""("""+str(arg)+""")"""
+        if len(targets)>0:
+            codeblock+=""" """+""" """.join(map(str, targets))
+        codeblock+="""\n"""
+        return codeblock
+
+    def _tick(self):
+        '''
+        Emits a TICK
+        '''
+        return self._instruction("TICK", [])
+
+    def _shift_coords(self, shift):
+        '''
+        Emits a SHIFT_COORDS that moves the coordinates of the detectors that follow
+        '''
+        if self._backend=='ir':
+            return [("SHIFT_COORDS", (), tuple(shift), None)]
+        return """SHIFT_COORDS("""+""", """.join(str(el) for el in shift)+""")\n"""
+
+    def _detector(self, coords, relative_meas_histories):
+        '''
+        Emits a DETECTOR over the given (negative) measurement record offsets
+        '''
+        if self._backend=='ir':
+            return [("DETECTOR", tuple(relative_meas_histories), tuple(coords), None)]
+
+        codeblock="""DETECTOR("""+""", """.join(str(el) for el in coords)+""")"""
+        for el in relative_meas_histories:
+            codeblock+=""" rec["""+str(el)+"""]"""
+        codeblock+="""\n"""
+        return codeblock
+
+    @_builder_stage
+    def _repeat_block(self, repeat_count, body):
+        '''
+        Wraps the body codeblock into a REPEAT block
+        '''
+        if self._backend=='ir':
+            return [("REPEAT", body, (repeat_count,), None)]
+
+        # insert the tab
+        codeblock="REPEAT "+str(repeat_count)+""" {\n"""
+        codeblock+=("""\t"""+body).replace("\n", "\n\t")
+        codeblock+="""}\n"""
+        return codeblock
+
+    @_builder_stage
     def define_qubits(self):
         '''
         Initialize the qubits -- this function works
         '''
-        code_distance=self.cd    
-        n_cols=2*code_distance-1
-        
-        codeblock=""""""
-        
-        for qubit_label in self.data_qubits:
-            i=qubit_label//n_cols
-            j=qubit_label%n_cols
-            codeblock+="""QUBIT_COORDS("""+str(i)+""", """+str(j)+""") """+str(qubit_label)+"""\n"""
-        
-        for qubit_label in self.x_gauge_qubits:
-            i=qubit_label//n_cols
-            j=qubit_label%n_cols
-            codeblock+="""QUBIT_COORDS("""+str(i)+""", """+str(j)+""") """+str(qubit_label)+"""\n"""
-        
-        for qubit_label in self.z_gauge_qubits:
+        n_cols=self.grid_shape[1]
+
+        codeblock=self._new_block()
+
+        for qubit_label in self.data_qubits+self.x_gauge_qubits+self.z_gauge_qubits:
             i=qubit_label//n_cols
             j=qubit_label%n_cols
-            codeblock+="""QUBIT_COORDS("""+str(i)+""", """+str(j)+""") """+str(qubit_label)+"""\n"""
-        
+            codeblock+=self._instruction("QUBIT_COORDS", [qubit_label], [i, j])
+
         return codeblock
 
+    @_builder_stage
     def reset_qubits(self, qubits, reset_basis):
         '''
         Reset the qubits - this could be the data qubits, the X gauge qubits or the flag qubits
         '''
         # reset all qubits to 0
         if reset_basis=='Z':
-            codeblock="""R"""
+            return self._instruction("R", qubits)
         elif reset_basis=='X':
-            codeblock="""RX"""
+            return self._instruction("RX", qubits)
         else:
             raise ValueError("Invalid reset basis")
-        
-        for el in qubits:
-            codeblock+=""" """+str(el)
-        codeblock+="""\n"""
-        
-        return codeblock
 
-    
+
     def apply_h_gate(self, qubits):
         '''
         Apply the Hadamard gate to the qubits
         '''
-        codeblock="""H"""
-        for el in qubits:
-            codeblock+=""" """+str(el)
-        codeblock+="""\n"""
-        return codeblock
+        return self._instruction("H", qubits)
 
     def apply_cnots(self, qubit_pairs):
         '''
         Apply CNOT gates to the qubit pairs
         '''
-        codeblock="""CNOT"""
-        for el in qubit_pairs:
-            codeblock+=""" """+str(el[0])+""" """+str(el[1])
-        codeblock+="""\n"""
-        return codeblock
-    
+        return self._instruction("CNOT", [q for el in qubit_pairs for q in el])
+
     def apply_mr(self, qubits):
         '''
         Apply the measurement and reset operation to the qubits
         '''
-        codeblock="""MR"""
-        for el in qubits:
-            codeblock+=""" """+str(el)
-            self.total_measurement_history[el].append(self.current_measurement_counter)
-            self.current_measurement_counter+=1
-        codeblock+="""\n"""
-        return codeblock
+        self.measurement_ledger.record(qubits)
+        return self._instruction("MR", qubits)
+
+    @_builder_stage
+    def apply_m(self, qubits, measure_basis):
+        '''
+        Measure the qubits (without a reset) in the given basis
+        '''
+        if measure_basis=='Z':
+            name="M"
+        elif measure_basis=='X':
+            name="MX"
+        else:
+            raise ValueError("Invalid basis")
+
+        self.measurement_ledger.record(qubits)
+        return self._instruction(name, qubits)
+
 
-    
     def apply_x_err(self, qubits, p_err):
         '''
         Inserts an X error
         '''
-        codeblock="""X_ERROR("""+str(p_err)+""")"""
-        for el in qubits:
-            codeblock+=""" """+str(el)
-        codeblock+="""\n"""
-        return codeblock
-    
+        return self._instruction("X_ERROR", qubits, p_err)
+
     def apply_z_err(self, qubits, p_err):
         '''
         Inserts a Z error
         '''
-        codeblock="""Z_ERROR("""+str(p_err)+""")"""
-        for el in qubits:
-            codeblock+=""" """+str(el)
-        codeblock+="""\n"""
-        return codeblock
+        return self._instruction("Z_ERROR", qubits, p_err)
 
     
+    @_builder_stage
     def apply_flip_error(self, basis, qubits, p_err):
         '''
         Args:
@@ -287,27 +421,58 @@ class HeavyHexCode:
             codeblock=self.apply_x_err(qubits, p_err)
         return codeblock
     
+    @_builder_stage
     def apply_one_qb_depolarization_err(self, qubits, p_err):
         '''
         Inserts single qubit depolarizing error
         '''
-        codeblock="""DEPOLARIZE1("""+str(p_err)+""")"""
-        for el in qubits:
-            codeblock+=""" """+str(el)
-        codeblock+="""\n"""
-        return codeblock
+        return self._instruction("DEPOLARIZE1", qubits, p_err)
 
     def apply_two_qb_depolarization_err(self, qubit_pairs, p_err):
         '''
         Inserts two qubit depolarizing error
         '''
-        codeblock="""DEPOLARIZE2("""+str(p_err)+""")"""
-        for el in qubit_pairs:
-            codeblock+=""" """+str(el[0])+""" """+str(el[1])
-        codeblock+="""\n"""
+        return self._instruction("DEPOLARIZE2", [q for el in qubit_pairs for q in el], p_err)
+
+    def _apply_noise(self, channel, apply_err, targets, p_err, skip_zero=True):
+        '''
+        Inserts the errors of a noise channel
+        
+        Args:
+        channel: The noise channel of the noise model -- 'single_qubit_gate',
+        'cnot', 'readout', 'reset' or 'idle'
+        apply_err: The helper that emits the error, called as apply_err(targets, p)
+        targets: The qubits, or the qubit pairs for 'cnot'
+        p_err: The error parameter of the channel. Without a noise model every
+        target gets it, with one it is the rate of the targets the calibration
+        does not list
+        skip_zero: Leave out errors of probability 0
+        
+        With a noise model, targets with the same rate share one instruction.
+        The 'ir' backend keeps the errors of probability 0 and tags every
+        error with its channel, so that CircuitIR.with_noise can change them
+        '''
+        if self._backend=='ir':
+            groups=[(p_err, targets)] if self.noise_model is None else self.noise_model.group(channel, targets, p_err)
+            codeblock=self._new_block()
+            for p, group in groups:
+                codeblock+=[(name, group_targets, args, (channel, skip_zero))
+                            for name, group_targets, args, _ in apply_err(group, p)]
+            return codeblock
+        
+        if self.noise_model is None:
+            if skip_zero and not p_err>0.0:
+                return self._new_block()
+            return apply_err(targets, p_err)
+        
+        codeblock=self._new_block()
+        for p, group in self.noise_model.group(channel, targets, p_err):
+            if p>0.0 or not skip_zero:
+                codeblock+=apply_err(group, p)
         return codeblock
 
     
+    @_builder_stage
     def apply_x_checks(self):
         '''
         Generates instruction for the X gauge checks
@@ -325,90 +490,82 @@ class HeavyHexCode:
         after_reset_flip_probability=self.arfp
         before_measure_flip_probability=self.bmfp
         
-        codeblock=""""""
+        codeblock=self._new_block()
         
         # apply the first layer of hadamards
         c1=self.apply_h_gate(x_gauge_qubits)
         codeblock+=c1
-        if after_clifford_depolarization>0.0:
-            c2=self.apply_one_qb_depolarization_err(x_gauge_qubits, after_clifford_depolarization)
-            codeblock+=c2
+        c2=self._apply_noise('single_qubit_gate', self.apply_one_qb_depolarization_err, x_gauge_qubits, after_clifford_depolarization)
+        codeblock+=c2
             
         # apply second cycle operations
         c1=self.apply_cnots(second_cycle_pairs)
         codeblock+=c1
-        if after_clifford_depolarization>0.0:
-            c2=self.apply_two_qb_depolarization_err(second_cycle_pairs, after_clifford_depolarization)
-            codeblock+=c2
+        c2=self._apply_noise('cnot', self.apply_two_qb_depolarization_err, second_cycle_pairs, after_clifford_depolarization)
+        codeblock+=c2
         
         # insert tick
-        codeblock+="""TICK\n"""
+        codeblock+=self._tick()
         
         # apply third cycle operations
         c1=self.apply_cnots(third_cycle_pairs)
         codeblock+=c1
-        if after_clifford_depolarization>0.0:
-            c2=self.apply_two_qb_depolarization_err(third_cycle_pairs, after_clifford_depolarization)
-            codeblock+=c2
+        c2=self._apply_noise('cnot', self.apply_two_qb_depolarization_err, third_cycle_pairs, after_clifford_depolarization)
+        codeblock+=c2
         
         # insert tick
-        codeblock+="""TICK\n"""
+        codeblock+=self._tick()
         
         # apply fourth cycle operations
         c1=self.apply_cnots(fourth_cycle_pairs)
         codeblock+=c1
-        if after_clifford_depolarization>0.0:
-            c2=self.apply_two_qb_depolarization_err(fourth_cycle_pairs, after_clifford_depolarization)
-            codeblock+=c2
+        c2=self._apply_noise('cnot', self.apply_two_qb_depolarization_err, fourth_cycle_pairs, after_clifford_depolarization)
+        codeblock+=c2
         
         # insert tick
-        codeblock+="""TICK\n"""
+        codeblock+=self._tick()
         
         # apply fifth cycle operations
         c1=self.apply_cnots(fifth_cycle_pairs)
         codeblock+=c1
-        if after_clifford_depolarization>0.0:
-            c2=self.apply_two_qb_depolarization_err(fifth_cycle_pairs, after_clifford_depolarization)
-            codeblock+=c2
+        c2=self._apply_noise('cnot', self.apply_two_qb_depolarization_err, fifth_cycle_pairs, after_clifford_depolarization)
+        codeblock+=c2
         
         # insert tick
-        codeblock+="""TICK\n"""
+        codeblock+=self._tick()
         
         # apply sixth cycle operations
         c1=self.apply_cnots(sixth_cycle_pairs)
         codeblock+=c1
-        if after_clifford_depolarization>0.0:
-            c2=self.apply_two_qb_depolarization_err(sixth_cycle_pairs, after_clifford_depolarization)
-            codeblock+=c2
+        c2=self._apply_noise('cnot', self.apply_two_qb_depolarization_err, sixth_cycle_pairs, after_clifford_depolarization)
+        codeblock+=c2
         
         # insert tick
-        codeblock+="""TICK\n"""
+        codeblock+=self._tick()
         
         # apply hadamard on the x gauge qubit
         c1=self.apply_h_gate(x_gauge_qubits)
         codeblock+=c1
-        if after_clifford_depolarization>0.0:
-            c2=self.apply_one_qb_depolarization_err(x_gauge_qubits, after_clifford_depolarization)
-            codeblock+=c2
+        c2=self._apply_noise('single_qubit_gate', self.apply_one_qb_depolarization_err, x_gauge_qubits, after_clifford_depolarization)
+        codeblock+=c2
         
         # insert tick
-        codeblock+="""TICK\n"""
+        codeblock+=self._tick()
         
         # measure the flag qubits and x gauge qubits
-        if before_measure_flip_probability>0.0:
-            c1=self.apply_x_err(flag_qubits+x_gauge_qubits, before_measure_flip_probability)
-            codeblock+=c1
+        c1=self._apply_noise('readout', self.apply_x_err, flag_qubits+x_gauge_qubits, before_measure_flip_probability)
+        codeblock+=c1
         
         c1=self.apply_mr(flag_qubits+x_gauge_qubits)
         codeblock+=c1
         
         # after reset flip
-        if after_reset_flip_probability>0.0:
-            c1=self.apply_x_err(flag_qubits+x_gauge_qubits, after_reset_flip_probability)
-            codeblock+=c1
+        c1=self._apply_noise('reset', self.apply_x_err, flag_qubits+x_gauge_qubits, after_reset_flip_probability)
+        codeblock+=c1
         
         return codeblock
 
+    @_builder_stage
     def apply_z_checks(self):
         '''
         Generates instruction for the Z gauge checks
@@ -422,55 +579,51 @@ class HeavyHexCode:
         after_reset_flip_probability=self.arfp
         before_measure_flip_probability=self.bmfp
         
-        codeblock=""""""
+        codeblock=self._new_block()
         
         # apply the eighth cycle operations
         c1=self.apply_cnots(eighth_cycle_pairs)
         codeblock+=c1
-        if after_clifford_depolarization>0.0:
-            c2=self.apply_two_qb_depolarization_err(eighth_cycle_pairs, after_clifford_depolarization)
-            codeblock+=c2
+        c2=self._apply_noise('cnot', self.apply_two_qb_depolarization_err, eighth_cycle_pairs, after_clifford_depolarization)
+        codeblock+=c2
         
         # insert tick
-        codeblock+="""TICK\n"""
+        codeblock+=self._tick()
         
         # apply the ninth cycle operations
         c1=self.apply_cnots(ninth_cycle_pairs)
         codeblock+=c1
-        if after_clifford_depolarization>0.0:
-            c2=self.apply_two_qb_depolarization_err(ninth_cycle_pairs, after_clifford_depolarization)
-            codeblock+=c2
+        c2=self._apply_noise('cnot', self.apply_two_qb_depolarization_err, ninth_cycle_pairs, after_clifford_depolarization)
+        codeblock+=c2
         
         # insert tick
-        codeblock+="""TICK\n"""
+        codeblock+=self._tick()
         
         # apply the tenth cycle operations
         c1=self.apply_cnots(tenth_cycle_pairs)
         codeblock+=c1
-        if after_clifford_depolarization>0.0:
-            c2=self.apply_two_qb_depolarization_err(tenth_cycle_pairs, after_clifford_depolarization)
-            codeblock+=c2
+        c2=self._apply_noise('cnot', self.apply_two_qb_depolarization_err, tenth_cycle_pairs, after_clifford_depolarization)
+        codeblock+=c2
         
         # insert tick
-        codeblock+="""TICK\n"""
+        codeblock+=self._tick()
         
         # measure the flag qubits
-        if before_measure_flip_probability>0.0:
-            c1=self.apply_x_err(z_gauge_qubits, before_measure_flip_probability)
-            codeblock+=c1
+        c1=self._apply_noise('readout', self.apply_x_err, z_gauge_qubits, before_measure_flip_probability)
+        codeblock+=c1
         
         c1=self.apply_mr(z_gauge_qubits)
         codeblock+=c1
         
         # after reset flip
-        if after_reset_flip_probability>0.0:
-            c1=self.apply_x_err(z_gauge_qubits, after_reset_flip_probability)
-            codeblock+=c1
+        c1=self._apply_noise('reset', self.apply_x_err, z_gauge_qubits, after_reset_flip_probability)
+        codeblock+=c1
         
         return codeblock
     
     
-    def apply_measurement_detectors(self, *, qubits_to_detect, parity_factor, round_num):
+    @_builder_stage
+    def apply_measurement_detectors(self, *, qubits_to_detect, parity_factor, round_num, role=None):
         '''
         Applies detectors to the code
         
@@ -480,103 +633,46 @@ class HeavyHexCode:
         Eg - If parity_factor=1, we consider the most-recent single measurement DETECTOR rec[-1], if
         parity_factor=2, we consider the most-recent two measurements DETECTOR rec[-1] and rec[-2] and so on
         round_num: Which round is currently being processed
+        role: The QubitRole of qubits_to_detect (QubitRole.FLAG, QubitRole.Z_GAUGE or
+        QubitRole.X_GAUGE). If not given, it is worked out by comparing qubits_to_detect
+        against the qubit lists of the code
         '''
-        codeblock=""""""
-        n_cols=2*self.cd-1
-        n_rows=2*self.cd-1
+        if role is None:
+            role=self._role_of_qubit_set(qubits_to_detect)
         
-        for el in qubits_to_detect:
-            
-            i=el//n_cols
-            j=el%n_cols
-            
-            if qubits_to_detect==self.flag_qubits:
-                assert parity_factor==1 # flag qubits are always parity factor 1
-                relative_meas_history=self.total_measurement_history[el][-1]-self.current_measurement_counter
-                codeblock+="""DETECTOR("""+str(i)+""", """+str(j)+""", """+str(round_num)+""") rec["""+str(relative_meas_history)+"""]\n"""
-            elif qubits_to_detect==self.z_gauge_qubits:
-                if parity_factor==1:
-                    if (j==0 and i%4==3) or (j==n_cols-1 and i%4==1):
-                        relative_meas_history=self.total_measurement_history[el][-1]-self.current_measurement_counter
-                        codeblock+="""DETECTOR("""+str(i)+""", """+str(j)+""", """+str(round_num)+""") rec["""+str(relative_meas_history)+"""]\n"""
-                    elif j==0 and i%4==1:
-                        relative_meas_history=self.total_measurement_history[el][-1]-self.current_measurement_counter
-                        relative_meas_history_2=self.total_measurement_history[el+2][-1]-self.current_measurement_counter
-                        codeblock+="""DETECTOR("""+str(i)+""", """+str(j)+""", """+str(round_num)+""") rec["""+str(relative_meas_history)+"""] rec["""+str(relative_meas_history_2)+"""]\n"""
-                    elif j==n_cols-1 and i%4==3:
-                        pass
-                    elif not((el+1) in self.x_gauge_qubits):
-                        relative_meas_history_1=self.total_measurement_history[el][-1]-self.current_measurement_counter
-                        relative_meas_history_2=self.total_measurement_history[el+2][-1]-self.current_measurement_counter
-                        codeblock+="""DETECTOR("""+str(i)+""", """+str(j+1)+""", """+str(round_num)+""") rec["""+str(relative_meas_history_1)+"""] rec["""+str(relative_meas_history_2)+"""]\n"""
-                    else:
-                        pass
-                elif parity_factor==2:
-                    if (j==0 and i%4==3) or (j==n_cols-1 and i%4==1):
-                        if el in self.flag_qubits:
-                            relative_meas_history_1=self.total_measurement_history[el][-1]-self.current_measurement_counter
-                            relative_meas_history_2=self.total_measurement_history[el][-3]-self.current_measurement_counter
-                            codeblock+="""DETECTOR("""+str(i)+""", """+str(j)+""", """+str(round_num)+""") rec["""+str(relative_meas_history_1)+"""] rec["""+str(relative_meas_history_2)+"""]\n"""
-                        else:
-                            relative_meas_history_1=self.total_measurement_history[el][-1]-self.current_measurement_counter
-                            relative_meas_history_2=self.total_measurement_history[el][-2]-self.current_measurement_counter
-                            codeblock+="""DETECTOR("""+str(i)+""", """+str(j)+""", """+str(round_num)+""") rec["""+str(relative_meas_history_1)+"""] rec["""+str(relative_meas_history_2)+"""]\n"""
-                    elif j==0 and i%4==1:
-                        relative_meas_history_1=self.total_measurement_history[el][-1]-self.current_measurement_counter
-                        relative_meas_history_2=self.total_measurement_history[el][-2]-self.current_measurement_counter
-                        relative_meas_history_3=self.total_measurement_history[el+2][-1]-self.current_measurement_counter
-                        relative_meas_history_4=self.total_measurement_history[el+2][-3]-self.current_measurement_counter
-                        codeblock+="""DETECTOR("""+str(i)+""", """+str(j+1)+""", """+str(round_num)+""") rec["""+str(relative_meas_history_1)+"""] rec["""+str(relative_meas_history_2)+"""] rec["""+str(relative_meas_history_3)+"""] rec["""+str(relative_meas_history_4)+"""]\n"""    
-                    elif j==n_cols-1 and i%4==3:
-                        pass
-                    elif not((el+1) in self.x_gauge_qubits):
-                        relative_meas_history_1=self.total_measurement_history[el][-1]-self.current_measurement_counter
-                        relative_meas_history_2=self.total_measurement_history[el+2][-1]-self.current_measurement_counter
-                        relative_meas_history_3=None
-                        relative_meas_history_4=None
-                        
-                        if el not in self.flag_qubits:
-                            relative_meas_history_3=self.total_measurement_history[el][-2]-self.current_measurement_counter
-                        else:
-                            relative_meas_history_3=self.total_measurement_history[el][-3]-self.current_measurement_counter
-                            
-                        if el+2 not in self.flag_qubits:
-                            relative_meas_history_4=self.total_measurement_history[el+2][-2]-self.current_measurement_counter
-                        else:
-                            relative_meas_history_4=self.total_measurement_history[el+2][-3]-self.current_measurement_counter
-                        
-                        codeblock+="""DETECTOR("""+str(i)+""", """+str(j+1)+""", """+str(round_num)+""") rec["""+str(relative_meas_history_1)+"""] rec["""+str(relative_meas_history_2)+"""] rec["""+str(relative_meas_history_3)+"""] rec["""+str(relative_meas_history_4)+"""]\n"""
-                    else:
-                        pass
-            elif qubits_to_detect==self.x_gauge_qubits:
-                codeblock_for_stb=""""""
-                if i==0 or i==1:
-                    codeblock_for_check=""""""
-                    if parity_factor==1:
-                        codeblock_for_check+="""DETECTOR("""+str(i)+""", """+str(j)+""", """+str(round_num)+""")"""
-                        for q_idx in range(el, n_rows*n_cols, n_cols):
-                            if q_idx in self.x_gauge_qubits:
-                                relative_meas_history=self.total_measurement_history[q_idx][-1]-self.current_measurement_counter
-                                codeblock_for_check+=""" rec["""+str(relative_meas_history)+"""]"""
-                        codeblock_for_check+="""\n"""
-                        codeblock_for_stb+=codeblock_for_check
-                    
-                    elif parity_factor==2:
-                        codeblock_for_check+="""DETECTOR("""+str(i)+""", """+str(j)+""", """+str(round_num)+""")"""
-                        for q_idx in range(el, n_rows*n_cols, n_cols):
-                            if q_idx in self.x_gauge_qubits:
-                                relative_meas_history_1=self.total_measurement_history[q_idx][-1]-self.current_measurement_counter
-                                relative_meas_history_2=self.total_measurement_history[q_idx][-2]-self.current_measurement_counter
-                                codeblock_for_check+=""" rec["""+str(relative_meas_history_1)+"""] rec["""+str(relative_meas_history_2)+"""]"""
-                        codeblock_for_check+="""\n"""
-                        codeblock_for_stb+=codeblock_for_check
-                    else:
-                        raise ValueError("Invalid parity factor")
-                
-                codeblock+=codeblock_for_stb
-
+        template=_measurement_detector_template(self.grid_shape, role, parity_factor, tuple(qubits_to_detect))
+        return self._apply_detector_template(template, round_num, role)
+    
+    def _apply_detector_template(self, template, round_num, role):
+        '''
+        Emits the detectors of a template, with the record offsets of all of
+        them looked up in the measurement ledger in one go
+        '''
+        coords, rec_qubits, lookbacks, ends=template
+        self._detector_role_log.append((role, round_num+self._round_shift, coords))
+        relative_meas_histories=self.measurement_ledger.relative(rec_qubits, lookbacks).tolist()
+        
+        codeblock=self._new_block()
+        start=0
+        for (i, j), end in zip(coords, ends):
+            codeblock+=self._detector((i, j, round_num), relative_meas_histories[start:end])
+            start=end
         return codeblock
     
+    def _role_of_qubit_set(self, qubits):
+        '''
+        Returns the QubitRole whose qubit list equals qubits
+        '''
+        if qubits==self.flag_qubits:
+            return QubitRole.FLAG
+        elif qubits==self.z_gauge_qubits:
+            return QubitRole.Z_GAUGE
+        elif qubits==self.x_gauge_qubits:
+            return QubitRole.X_GAUGE
+        else:
+            raise ValueError("qubits_to_detect is not one of the qubit sets of the code, pass role explicitly")
+    
+    @_builder_stage
     def apply_data_measurement_detectors(self):
         '''
         After the data qubits are measured, we do a final parity check 
@@ -584,86 +680,11 @@ class HeavyHexCode:
         initialized (and measured) in and the data qubits surrounding
         the stabilizer qubits
         '''
-        if self.basis=='Z':
-            
-            codeblock=""""""
-            n_cols=2*self.cd-1
-            n_rows=2*self.cd-1
-            
-            for el in self.z_gauge_qubits:
-                
-                i=el//n_cols
-                j=el%n_cols
-                
-                if (j==0 and i%4==3) or (j==n_cols-1 and i%4==1): # Z stb has only two qubits to check
-                    
-                    relative_meas_history=self.total_measurement_history[el][-1]-self.current_measurement_counter
-                    if el in self.flag_qubits:
-                        relative_meas_history=self.total_measurement_history[el][-2]-self.current_measurement_counter
-                    
-                    codeblock+="""DETECTOR("""+str(i)+""", """+str(j)+""", """+str(self.nr)+""") rec["""+str(relative_meas_history)+"""]"""
-                    data_qubits_to_check=[el-n_cols, el, el+n_cols]
-                    for qb in data_qubits_to_check:
-                        relative_meas_history=self.total_measurement_history[qb][-1]-self.current_measurement_counter
-                        codeblock+=""" rec["""+str(relative_meas_history)+"""]"""
-                    codeblock+="""\n"""
-                elif j==n_cols-1 and i%4==3: # boundary condition
-                    continue
-                elif not((el+1) in self.x_gauge_qubits): # remaining qubits
-                    
-                    relative_meas_history=self.total_measurement_history[el][-1]-self.current_measurement_counter
-                    if el in self.flag_qubits:
-                        relative_meas_history=self.total_measurement_history[el][-2]-self.current_measurement_counter
-                    
-                    relative_meas_history_2=self.total_measurement_history[el+2][-1]-self.current_measurement_counter
-                    if el+2 in self.flag_qubits:
-                        relative_meas_history_2=self.total_measurement_history[el+2][-2]-self.current_measurement_counter
-                    
-                    codeblock+="""DETECTOR("""+str(i)+""", """+str(j)+""", """+str(self.nr)+""") rec["""+str(relative_meas_history)+"""] rec["""+str(relative_meas_history_2)+"""]"""
-                    data_qubits_to_check=[el-n_cols, el+n_cols, el-n_cols+2, el+n_cols+2]
-                    for dq in data_qubits_to_check:
-                        relative_meas_history=self.total_measurement_history[dq][-1]-self.current_measurement_counter
-                        codeblock+=""" rec["""+str(relative_meas_history)+"""]"""
-                    codeblock+="""\n"""
-                else:
-                    pass # the cases on the right
-                
-        elif self.basis=='X':
-            
-            codeblock=""""""
-            n_cols=2*self.cd-1
-            n_rows=2*self.cd-1
-            
-            for el in self.x_gauge_qubits:
-                
-                i=el//n_cols
-                j=el%n_cols
-                
-                if i==0 or i==1:
-                    codeblock_for_stb="""DETECTOR("""+str(i)+""", """+str(j)+""", """+str(self.nr)+""")"""
-                    for q_idx in range(el, n_rows*n_cols, n_cols):
-                        if q_idx in self.x_gauge_qubits:
-                            relative_meas_history=self.total_measurement_history[q_idx][-1]-self.current_measurement_counter
-                            codeblock_for_stb+=""" rec["""+str(relative_meas_history)+"""]"""
-                            
-                            data_qubits_to_check=None
-                            q_idx_row=q_idx//n_cols
-                            if q_idx_row==0 or q_idx_row==n_rows-1:
-                                data_qubits_to_check=[q_idx-1, q_idx+1]
-                            else:
-                                data_qubits_to_check=[q_idx-n_cols-1, q_idx-n_cols+1, q_idx+n_cols-1, q_idx+n_cols+1]
-                            
-                            for dq in data_qubits_to_check:
-                                relative_meas_history=self.total_measurement_history[dq][-1]-self.current_measurement_counter
-                                codeblock_for_stb+=""" rec["""+str(relative_meas_history)+"""]"""
-                    codeblock_for_stb+="""\n"""
-                    codeblock+=codeblock_for_stb
-                else:
-                    continue
-                
-        return codeblock
+        template=_data_detector_template(self.grid_shape, self.basis)
+        return self._apply_detector_template(template, self.nr-self._round_shift, QubitRole.DATA)
 
 
+    @_builder_stage
     def apply_observable_label(self):
         '''
         Gives the observable
@@ -672,38 +693,113 @@ class HeavyHexCode:
         The X logical operator is the vertical one, and the Z operator
         is the horizontal one
         '''
-        n_cols=2*self.cd-1
+        n_cols=self.grid_shape[1]
         
-        codeblock="""OBSERVABLE_INCLUDE(0)"""
         if self.basis=='X':
             candidate_qubits=[i for i in self.data_qubits if i%n_cols==0] # first column -- logical X observable
-            for el in candidate_qubits:
-                relative_measurement_history=self.total_measurement_history[el][-1]-self.current_measurement_counter
-                codeblock+=""" rec["""+str(relative_measurement_history)+"""]"""
         elif self.basis=='Z':
             candidate_qubits=[i for i in self.data_qubits if i//n_cols==0] # first row -- logical Z observable
-            for el in candidate_qubits:
-                relative_measurement_history=self.total_measurement_history[el][-1]-self.current_measurement_counter
-                codeblock+=""" rec["""+str(relative_measurement_history)+"""]"""
+        else:
+            candidate_qubits=[]
+        relative_measurement_histories=self.measurement_ledger.relative(candidate_qubits, 1).tolist()
         
+        if self._backend=='ir':
+            return [("OBSERVABLE_INCLUDE", tuple(relative_measurement_histories), (0,), None)]
+        
+        codeblock="""OBSERVABLE_INCLUDE(0)"""
+        for el in relative_measurement_histories:
+            codeblock+=""" rec["""+str(el)+"""]"""
+        codeblock+="""\n"""
         return codeblock
     
-    def create_heavy_hex_code(self):
+    def create_heavy_hex_code(self, backend='text', use_cache=True, profiler=None):
         '''
         Args:
-        code_distance: the distance of the heavy-hex code
-        rounds: the number of rounds to run the code
-        after_clifford_depolarization: the probability of applying a depolarizing error after the Clifford gates
-        after_reset_flip_probability: the probability of flipping the qubit after the reset
-        before_measure_flip_probability: the probability of flipping the qubit before the measurement
-        before_round_data_depolarization: the probability of applying a depolarizing error before the round
+        backend: 'text' returns the stim program as a string, 'stim' returns a
+        stim.Circuit (the program text, parsed once: appending instruction by
+        instruction into a stim.Circuit is over ten times slower), 'ir' returns a
+        circuit_ir.CircuitIR ('X' and 'Z' only) that serializes to either and
+        can change its error parameters and rounds. All describe the same circuit
+        use_cache: Look the circuit up in (and add it to) the module-level LRU cache of
+        finished circuits, keyed on (distance, rounds, basis, error parameters, noise model, backend)
+        profiler: A BuildProfiler that records the time and the output size of every
+        builder stage. The circuit is then always built, the cache is bypassed
+
+        Generation does not depend on earlier calls, so the same instance can be
+        used any number of times. The measurement history left on the instance
+        is the one of the last circuit that was actually built
+
+        The code parameters (code_distance, rounds) and the error parameters
+        (after_clifford_depolarization, after_reset_flip_probability,
+        before_measure_flip_probability, before_round_data_depolarization) are
+        the ones given to the constructor
         '''
-        # number of rows and columns in the code-block
-        code_distance=self.cd
-        n_rows=2*code_distance-1
-        n_cols=2*code_distance-1
-        
-        full_codeblock=""""""
+        if backend not in ('text', 'stim', 'ir'):
+            raise ValueError("Invalid backend")
+        if backend=='ir' and self.basis=='XZ':
+            raise ValueError("The 'ir' backend builds 'X' and 'Z' circuits")
+        
+        if profiler is not None:
+            use_cache=False
+        
+        key=self._cache_key(backend)
+        if use_cache:
+            cached=_circuit_cache.get(key)
+            if cached is not None:
+                return cached.copy() if backend=='stim' else cached
+        
+        self._backend=backend
+        self._profiler=profiler
+        try:
+            if profiler is not None:
+                profiler.start(self, backend)
+            t0=time.perf_counter()
+            full_codeblock=self._build_code()
+            if backend=='stim' and isinstance(full_codeblock, str):
+                import stim
+                full_codeblock=stim.Circuit(full_codeblock)
+            if profiler is not None:
+                profiler.finish(time.perf_counter()-t0)
+        finally:
+            self._backend='text'
+            self._profiler=None
+        if backend=='ir':
+            full_codeblock=CircuitIR.from_instructions(full_codeblock, per_qubit_noise=self.noise_model is not None)
+        
+        if use_cache:
+            _circuit_cache.put(key, full_codeblock.copy() if backend=='stim' else full_codeblock)
+        return full_codeblock
+    
+    def _cache_key(self, backend):
+        '''
+        The parameters that fully determine the generated circuit
+        '''
+        noise_model_key=None if self.noise_model is None else self.noise_model.cache_key()
+        return (type(self), self.dx, self.dz, self.nr, self.basis,
+                (self.acd, self.arfp, self.bmfp, self.brdd), noise_model_key, backend)
+    
+    def _enter_section(self, section, *, first_round, num_rounds):
+        '''
+        Tells the profiler (if any) which part of the circuit is built next
+        '''
+        if self._profiler is not None:
+            self._profiler.enter_section(section, first_round=first_round, num_rounds=num_rounds)
+    
+    def _build_code(self):
+        '''
+        Builds the full memory experiment with the active backend
+        '''
+        if self.basis=='XZ':
+            return self._build_dual_basis_code()
+        if self.noise_model is not None:
+            self.noise_model.check_code(self)
+        self._reset_measurement_history()
+        self._detector_role_log=[]
+        self._detector_roles=self._detector_rounds=self._detector_coordinates=None
+        self._round_shift=0
+        self._enter_section('init', first_round=0, num_rounds=1)
+        
+        full_codeblock=self._new_block()
         
         # define the qubits -- this function looks good
         codeblock=self.define_qubits()
@@ -712,37 +808,32 @@ class HeavyHexCode:
         # reset the data qubits
         codeblock=self.reset_qubits(self.data_qubits, reset_basis=self.basis)
         full_codeblock+=codeblock
-        if self.arfp>0.0:
-            # apply a flip after the reset
-            codeblock=self.apply_flip_error(self.basis, self.data_qubits, self.arfp)
-            full_codeblock+=codeblock
+        # apply a flip after the reset
+        codeblock=self._apply_noise('reset', functools.partial(self.apply_flip_error, self.basis), self.data_qubits, self.arfp)
+        full_codeblock+=codeblock
         
         # reset the X gauge qubits -- the X gauge qubits are always reset in the Z basis
         codeblock=self.reset_qubits(self.x_gauge_qubits, reset_basis='Z')
         full_codeblock+=codeblock
-        if self.arfp>0.0:
-            # apply a flip after the reset
-            codeblock=self.apply_flip_error('Z', self.x_gauge_qubits, self.arfp)
-            full_codeblock+=codeblock
+        # apply a flip after the reset
+        codeblock=self._apply_noise('reset', functools.partial(self.apply_flip_error, 'Z'), self.x_gauge_qubits, self.arfp)
+        full_codeblock+=codeblock
         
         # reset the flag qubits - the flag qubits are always reset in the Z basis
         codeblock=self.reset_qubits(self.z_gauge_qubits, reset_basis='Z')
         full_codeblock+=codeblock
-        if self.arfp>0.0:
-            # apply a flip after the reset
-            codeblock=self.apply_flip_error('Z', self.z_gauge_qubits, self.arfp)
-            full_codeblock+=codeblock
+        # apply a flip after the reset
+        codeblock=self._apply_noise('reset', functools.partial(self.apply_flip_error, 'Z'), self.z_gauge_qubits, self.arfp)
+        full_codeblock+=codeblock
         
         # insert tick
-        full_codeblock+="""TICK\n"""
+        full_codeblock+=self._tick()
         
         # ------------------------------------------------------------ start the first round ------------------------------------------------------------
         
         # apply before-round data depolarization
-        if self.brdd>0.0:
-            # apply depolarizing error before the round
-            codeblock=self.apply_one_qb_depolarization_err(self.data_qubits, self.brdd)
-            full_codeblock+=codeblock
+        codeblock=self._apply_noise('idle', self.apply_one_qb_depolarization_err, self.data_qubits, self.brdd)
+        full_codeblock+=codeblock
         
         # initialize the qubits
         if self.basis=='Z': 
@@ -753,7 +844,8 @@ class HeavyHexCode:
             
             codeblock=self.apply_measurement_detectors(qubits_to_detect=self.flag_qubits, 
                                         parity_factor=1,
-                                        round_num=0)
+                                        round_num=0,
+                                        role=QubitRole.FLAG)
             full_codeblock+=codeblock
             
             # first Z check
@@ -762,7 +854,8 @@ class HeavyHexCode:
             
             codeblock=self.apply_measurement_detectors(qubits_to_detect=self.z_gauge_qubits, 
                                         parity_factor=1,
-                                        round_num=0)
+                                        round_num=0,
+                                        role=QubitRole.Z_GAUGE)
             full_codeblock+=codeblock
             
             # first X check
@@ -771,12 +864,14 @@ class HeavyHexCode:
             
             codeblock=self.apply_measurement_detectors(qubits_to_detect=self.x_gauge_qubits, 
                                     parity_factor=2,
-                                    round_num=0)
+                                    round_num=0,
+                                    role=QubitRole.X_GAUGE)
             full_codeblock+=codeblock
             
             codeblock=self.apply_measurement_detectors(qubits_to_detect=self.flag_qubits, 
                                         parity_factor=1,
-                                        round_num=0)
+                                        round_num=0,
+                                        role=QubitRole.FLAG)
             full_codeblock+=codeblock
             
         elif self.basis=='X': # already in the X basis, project in Z basis as well
@@ -791,13 +886,15 @@ class HeavyHexCode:
             
             codeblock=self.apply_measurement_detectors(qubits_to_detect=self.x_gauge_qubits, 
                                     parity_factor=1,
-                                    round_num=0)
+                                    round_num=0,
+                                    role=QubitRole.X_GAUGE)
             full_codeblock+=codeblock
             
             # flag qubit measurements -- always deterministic
             codeblock=self.apply_measurement_detectors(qubits_to_detect=self.flag_qubits, 
                                         parity_factor=1,
-                                        round_num=0)
+                                        round_num=0,
+                                        role=QubitRole.FLAG)
             full_codeblock+=codeblock
             
             # apply the first Z check
@@ -806,7 +903,8 @@ class HeavyHexCode:
             
             codeblock=self.apply_measurement_detectors(qubits_to_detect=self.z_gauge_qubits, 
                                         parity_factor=2,
-                                        round_num=0)
+                                        round_num=0,
+                                        role=QubitRole.Z_GAUGE)
             full_codeblock+=codeblock
             
         else:
@@ -816,14 +914,16 @@ class HeavyHexCode:
         
         ######################################### Repeat the block ##############################################
         if self.nr>1:
-            full_codeblock+= "REPEAT "+str(self.nr-1)+""" {\n"""
-            temp_codeblock= """\tTICK\n"""
+            self._enter_section('repeat', first_round=1, num_rounds=self.nr-1)
+            body_start=len(self._detector_role_log)
+            temp_codeblock=self._tick()
+            # every repetition is one round later -- its detectors are emitted with round_num=0
+            temp_codeblock+=self._shift_coords((0, 0, 1))
+            self._round_shift=1
             
             # apply before-round data depolarization
-            if self.brdd>0.0:
-                # apply depolarizing error before the round
-                codeblock=self.apply_one_qb_depolarization_err(self.data_qubits, self.brdd)
-                temp_codeblock+=codeblock
+            codeblock=self._apply_noise('idle', self.apply_one_qb_depolarization_err, self.data_qubits, self.brdd)
+            temp_codeblock+=codeblock
             
             if self.basis=='Z':
                 codeblock=self.apply_z_checks()
@@ -831,7 +931,8 @@ class HeavyHexCode:
                 
                 codeblock=self.apply_measurement_detectors(qubits_to_detect=self.z_gauge_qubits, 
                                             parity_factor=2,
-                                            round_num=0)
+                                            round_num=0,
+                                            role=QubitRole.Z_GAUGE)
                 temp_codeblock+=codeblock
                 
                 # Compare parity with last round of X checks
@@ -840,13 +941,15 @@ class HeavyHexCode:
                 
                 codeblock=self.apply_measurement_detectors(qubits_to_detect=self.x_gauge_qubits, 
                                         parity_factor=2,
-                                        round_num=0)
+                                        round_num=0,
+                                        role=QubitRole.X_GAUGE)
                 temp_codeblock+=codeblock
                 
                 # flag qubit measurements -- always deterministic
                 codeblock=self.apply_measurement_detectors(qubits_to_detect=self.flag_qubits, 
                                             parity_factor=1,
-                                            round_num=0)
+                                            round_num=0,
+                                            role=QubitRole.FLAG)
                 temp_codeblock+=codeblock  
             
             elif self.basis=='X':
@@ -855,12 +958,14 @@ class HeavyHexCode:
                 
                 codeblock=self.apply_measurement_detectors(qubits_to_detect=self.x_gauge_qubits, 
                                             parity_factor=2,
-                                            round_num=0)
+                                            round_num=0,
+                                            role=QubitRole.X_GAUGE)
                 temp_codeblock+=codeblock
                 
                 codeblock=self.apply_measurement_detectors(qubits_to_detect=self.flag_qubits, 
                                         parity_factor=1,
-                                        round_num=0)
+                                        round_num=0,
+                                        role=QubitRole.FLAG)
                 temp_codeblock+=codeblock
                 
                 codeblock=self.apply_z_checks()
@@ -868,37 +973,26 @@ class HeavyHexCode:
                 
                 codeblock=self.apply_measurement_detectors(qubits_to_detect=self.z_gauge_qubits, 
                                             parity_factor=2,
-                                            round_num=0)
+                                            round_num=0,
+                                            role=QubitRole.Z_GAUGE)
                 temp_codeblock+=codeblock
                 
             else:
                 raise ValueError("Invalid basis")
         
-            # insert the tab
-            temp_codeblock=temp_codeblock.replace("\n", "\n\t")
-            temp_codeblock+="""}\n"""
-            full_codeblock+=temp_codeblock
+            full_codeblock+=self._repeat_block(self.nr-1, temp_codeblock)
+            body=self._detector_role_log[body_start:]
+            self._detector_role_log[body_start:]=[(role, r, coords) for r in range(1, self.nr) for role, _, coords in body]
+            self._round_shift=self.nr-1
+        
+        self._enter_section('final', first_round=self.nr, num_rounds=1)
         
         # measure the data qubits
-        codeblock=self.apply_flip_error(basis=self.basis, qubits=self.data_qubits, p_err=self.bmfp)
+        codeblock=self._apply_noise('readout', functools.partial(self.apply_flip_error, self.basis), self.data_qubits, self.bmfp,
+                                    skip_zero=False)
         full_codeblock+=codeblock
         
-        if self.basis=='X':
-            codeblock="""MX"""
-            for el in self.data_qubits:
-                codeblock+=""" """+str(el)
-                self.total_measurement_history[el].append(self.current_measurement_counter)
-                self.current_measurement_counter+=1
-        elif self.basis=='Z':
-            codeblock="""M"""
-            for el in self.data_qubits:
-                codeblock+=""" """+str(el)
-                self.total_measurement_history[el].append(self.current_measurement_counter)
-                self.current_measurement_counter+=1
-        else:
-            raise ValueError("Invalid basis")
-        
-        codeblock+="""\n"""
+        codeblock=self.apply_m(self.data_qubits, measure_basis=self.basis)
         full_codeblock+=codeblock
         
         # get the data-measurement detectors
@@ -911,8 +1005,636 @@ class HeavyHexCode:
         
         return full_codeblock
 
+    def _build_dual_basis_code(self):
+        '''
+        Builds the X and the Z memory experiment side by side, as one circuit:
+        the Z patch gets the qubit labels after those of the X patch, is
+        placed below it with an empty row in between and measures observable 1
+        '''
+        # the patches are joined as stim circuits, whatever the backend
+        import stim
+        blocks=[]
+        logs=[]
+        for basis in ('X', 'Z'):
+            code=HeavyHexCode(
+                code_distance=self.cd if self.dx==self.dz else (self.dx, self.dz),
+                num_rounds=self.nr,
+                basis=basis,
+                after_clifford_depolarization=self.acd,
+                after_reset_flip_probability=self.arfp,
+                before_measure_flip_probability=self.bmfp,
+                before_round_data_depolarization=self.brdd,
+                noise_model=self.noise_model,
+            )
+            code._backend=self._backend
+            code._profiler=self._profiler
+            block=code._build_code()
+            blocks.append(stim.Circuit(block))
+            logs.append(code)
+
+        n_rows, n_cols=self.grid_shape
+        row_offset=n_rows+1
+        full_codeblock=blocks[0]
+        full_codeblock.append("SHIFT_COORDS", [], (row_offset, 0, -logs[0]._round_shift))
+        full_codeblock+=_offset_patch(blocks[1], qubit_offset=n_rows*n_cols, row_offset=row_offset, observable_offset=1)
+
+        self._reset_measurement_history()
+        self._round_shift=logs[1]._round_shift
+        self._detector_role_log=[]
+        self._detector_roles=np.concatenate([code.detector_roles() for code in logs])
+        self._detector_roles.flags.writeable=False
+        self._detector_rounds=np.concatenate([code.detector_rounds() for code in logs])
+        self._detector_rounds.flags.writeable=False
+        self._detector_coordinates=np.concatenate([logs[0].detector_coordinates(),
+                                                   logs[1].detector_coordinates()+(row_offset, 0, 0)])
+        self._detector_coordinates.flags.writeable=False
+        if self._backend=='stim':
+            return full_codeblock
+        return str(full_codeblock)+"""\n"""
+
+class MeasurementLedger:
+    '''
+    Array-backed record of when every qubit was measured
+
+    records[q, k] is the index (in the measurement record) of the k-th
+    measurement of qubit q, and counts[q] the number of measurements of q
+    so far. The slots grow on demand
+    '''
+
+    def __init__(self, num_qubits, num_slots=8):
+        self.records=np.full((num_qubits, num_slots), -1, dtype=np.int32)
+        self.counts=np.zeros(num_qubits, dtype=np.int32)
+        self.counter=0
+
+    def record(self, qubits):
+        '''
+        Appends one measurement of each of the qubits, in order
+        '''
+        qubits=np.asarray(qubits, dtype=np.intp)
+        if len(qubits)==0:
+            return
+        # a qubit measured twice in one instruction (not np.unique, which imports numpy.ma)
+        if np.any(np.diff(np.sort(qubits))==0):
+            for el in qubits:
+                self.record(el[None])
+            return
+        
+        slots=self.counts[qubits]
+        if slots.max()>=self.records.shape[1]:
+            grown=np.full((self.records.shape[0], 2*self.records.shape[1]), -1, dtype=np.int32)
+            grown[:, :self.records.shape[1]]=self.records
+            self.records=grown
+        
+        self.records[qubits, slots]=self.counter+np.arange(len(qubits), dtype=np.int32)
+        self.counts[qubits]+=1
+        self.counter+=len(qubits)
+
+    def relative(self, qubits, lookbacks):
+        '''
+        Returns the rec[...] offsets of measurement -lookbacks of the qubits
+        (lookback 1 is the most recent one), relative to the current end of the
+        measurement record
+
+        Args:
+        qubits: The qubit labels
+        lookbacks: How far back to look, per qubit or for all of them
+        '''
+        qubits=np.asarray(qubits, dtype=np.intp)
+        slots=self.counts[qubits]-np.asarray(lookbacks, dtype=np.int32)
+        if len(qubits)>0 and slots.min()<0:
+            raise IndexError("Looking further back than the measurement history of a qubit")
+        return self.records[qubits, slots]-self.counter
+
+    def history(self, qubit):
+        '''
+        Returns the measurement indices of one qubit as a list
+        '''
+        return self.records[qubit, :self.counts[qubit]].tolist()
+
+StageStats=collections.namedtuple('StageStats', [
+    'stage', # name of the builder method
+    'section', # 'init' (round 0), 'repeat' (the REPEAT body) or 'final' (the data measurements)
+    'first_round', # first round the section covers
+    'num_rounds', # rounds the section covers -- the REPEAT body is built once and runs num_rounds times
+    'calls', # calls of the stage in the section
+    'seconds', # wall time of those calls
+    'instructions', # instructions emitted by them, a REPEAT block counts as one
+    'targets', # targets of those instructions
+    'detectors', # DETECTOR instructions among them
+])
+
+_INSTRUCTION_LINE=re.compile(r'([A-Z_0-9]+)(\([^)]*\))?(.*)')
+
+class BuildProfiler:
+    '''
+    Records the wall time and the output size of every builder stage of
+    HeavyHexCode.create_heavy_hex_code, per section of the circuit
+
+    Usage:
+    profiler=BuildProfiler()
+    HeavyHexCode(...).create_heavy_hex_code(profiler=profiler)
+    print(profiler.format())
+    '''
+
+    def __init__(self):
+        self.stages=[] # StageStats, in the order the stages first ran
+        self.code_parameters=None
+        self.backend=None
+        self.total_seconds=0.0
+        self._index={}
+        self._section=('init', 0, 1)
+        self._depth=0
+        self._overhead=0.0
+
+    def start(self, code, backend):
+        '''
+        Called when a build starts, clears what was recorded before
+        '''
+        self.stages=[]
+        self.code_parameters={'code_distance': code.cd if code.dx==code.dz else (code.dx, code.dz),
+                              'num_rounds': code.nr, 'basis': code.basis}
+        self.backend=backend
+        self.total_seconds=0.0
+        self._index={}
+        self._section=('init', 0, 1)
+        self._depth=0
+        self._overhead=0.0
+
+    def finish(self, seconds):
+        '''
+        Called when a build is done, with its total wall time -- the time
+        spent in record is taken out
+        '''
+        self.total_seconds=seconds-self._overhead
+
+    def enter_section(self, section, *, first_round, num_rounds):
+        self._section=(section, first_round, num_rounds)
+
+    def record(self, stage, seconds, codeblock):
+        '''
+        Adds one call of a stage and the codeblock it returned
+        '''
+        t0=time.perf_counter()
+        instructions, targets, detectors=_codeblock_size(codeblock)
+        section, first_round, num_rounds=self._section
+        key=(stage, section)
+        if key not in self._index:
+            self._index[key]=len(self.stages)
+            self.stages.append(StageStats(stage, section, first_round, num_rounds, 0, 0.0, 0, 0, 0))
+        k=self._index[key]
+        previous=self.stages[k]
+        self.stages[k]=previous._replace(
+            calls=previous.calls+1,
+            seconds=previous.seconds+seconds,
+            instructions=previous.instructions+instructions,
+            targets=previous.targets+targets,
+            detectors=previous.detectors+detectors,
+        )
+        self._overhead+=time.perf_counter()-t0
+
+    def by_stage(self):
+        '''
+        Returns {stage: totals} over all sections, where the sizes count the
+        REPEAT body once per round it runs -- as in the flattened circuit
+        '''
+        totals={}
+        for row in self.stages:
+            total=totals.setdefault(row.stage, {'calls': 0, 'seconds': 0.0, 'instructions': 0, 'targets': 0, 'detectors': 0})
+            total['calls']+=row.calls
+            total['seconds']+=row.seconds
+            for field in ('instructions', 'targets', 'detectors'):
+                total[field]+=getattr(row, field)*row.num_rounds
+        return totals
+
+    def to_dict(self):
+        '''
+        The report as plain python data, e.g. for json.dump
+        '''
+        return {
+            **(self.code_parameters or {}),
+            'backend': self.backend,
+            'total_seconds': self.total_seconds,
+            'stages': [row._asdict() for row in self.stages],
+        }
+
+    def format(self):
+        '''
+        The report as a table, one line per stage and section
+        '''
+        lines=[f"{'stage':<34} {'section':<7} {'rounds':>9} {'calls':>5} {'ms':>9} {'instructions':>12} {'targets':>9} {'detectors':>9}"]
+        for row in self.stages:
+            rounds=f"{row.first_round}-{row.first_round+row.num_rounds-1}" if row.num_rounds>1 else str(row.first_round)
+            lines.append(f"{row.stage:<34} {row.section:<7} {rounds:>9} {row.calls:>5} {1e3*row.seconds:>9.3f} "
+                         f"{row.instructions:>12} {row.targets:>9} {row.detectors:>9}")
+        lines.append(f"{'total':<34} {'':<7} {'':>9} {'':>5} {1e3*self.total_seconds:>9.3f}")
+        return "\n".join(lines)
+
+
+def _codeblock_size(codeblock):
+    '''
+    Returns the (instructions, targets, detectors) at the top level of a
+    codeblock of either backend -- a REPEAT block counts as one instruction
+    '''
+    if isinstance(codeblock, list): # the 'ir' backend
+        return (len(codeblock), sum(len(targets) for name, targets, _, _ in codeblock if name!='REPEAT'),
+                sum(name=='DETECTOR' for name, _, _, _ in codeblock))
+    instructions=targets=detectors=0
+    for line in str(codeblock).splitlines():
+        if not line or line[0].isspace() or line=='}':
+            continue
+        name, _, rest=_INSTRUCTION_LINE.match(line).groups()
+        instructions+=1
+        if name=='REPEAT':
+            continue
+        targets+=len(rest.split())
+        if name=='DETECTOR':
+            detectors+=1
+    return instructions, targets, detectors
+
+
+def _offset_patch(circuit, *, qubit_offset, row_offset, observable_offset):
+    '''
+    Returns a copy of a stim.Circuit with the qubit labels, the row of the
+    QUBIT_COORDS and the observable indices moved by the given offsets. The
+    measurement record targets are relative and stay as they are
+
+    The circuit is rewritten as program text, which is much faster than
+    rebuilding it target by target
+    '''
+    import stim
+    lines=[]
+    for line in str(circuit).splitlines():
+        stripped=line.lstrip()
+        if not stripped or stripped=='}' or stripped.startswith('REPEAT'):
+            lines.append(line)
+            continue
+        name, args, rest=_INSTRUCTION_LINE.match(stripped).groups()
+        if name=='QUBIT_COORDS':
+            coords=args[1:-1].split(',')
+            args="("+", ".join([repr(float(coords[0])+row_offset)]+coords[1:])+")"
+        elif name=='OBSERVABLE_INCLUDE':
+            args="("+str(int(float(args[1:-1]))+observable_offset)+")"
+        targets=[str(int(target)+qubit_offset) if target.isdigit() else target for target in rest.split()]
+        lines.append(line[:len(line)-len(stripped)]+name+(args or "")+" "+" ".join(targets))
+    return stim.Circuit("\n".join(lines))
+
+
+class _LRUCache:
+    '''
+    A least-recently-used cache holding at most maxsize entries
+    '''
+
+    def __init__(self, maxsize):
+        self.maxsize=maxsize
+        self._entries=collections.OrderedDict()
+
+    def get(self, key):
+        if key not in self._entries:
+            return None
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def put(self, key, value):
+        self._entries[key]=value
+        self._entries.move_to_end(key)
+        self._evict()
+
+    def resize(self, maxsize):
+        self.maxsize=maxsize
+        self._evict()
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict(self):
+        while len(self._entries)>self.maxsize:
+            self._entries.popitem(last=False)
+
+_circuit_cache=_LRUCache(CIRCUIT_CACHE_SIZE)
+
+def clear_circuit_cache():
+    '''
+    Drops every circuit memoized by create_heavy_hex_code
+    '''
+    _circuit_cache.clear()
+
+def set_circuit_cache_size(maxsize):
+    '''
+    Changes how many finished circuits create_heavy_hex_code keeps around,
+    evicting the least recently used ones if needed. 0 disables the cache
+    '''
+    _circuit_cache.resize(maxsize)
+
+# the layout and the CNOT schedule only depend on the grid shape, so they are
+# built once per shape and shared by every HeavyHexCode instance. They are
+# worked out with index arithmetic over the whole grid, in row-major order
+def _distances(code_distance):
+    '''
+    Returns the (dx, dz) of a code_distance argument: d, or a (dx, dz) pair
+    '''
+    if isinstance(code_distance, (tuple, list)):
+        if len(code_distance)!=2:
+            raise ValueError("code_distance must be d or a (dx, dz) pair")
+        dx, dz=(int(d) for d in code_distance)
+        if dx<3 or dz<3 or dx%2==0 or dz%2==0:
+            raise ValueError("dx and dz must be odd and at least 3")
+        return dx, dz
+    return code_distance, code_distance
+
+def _grid_shape(dx, dz):
+    '''
+    The (rows, columns) of the qubit grid of a dx by dz patch: the data
+    qubits sit on the even rows and columns, dx rows of dz of them. The X
+    logical operator runs down a column and the Z one along a row, so dx
+    is the distance against X errors (of the 'Z' memory experiment) and
+    dz the one against Z errors (of the 'X' memory experiment)
+    '''
+    return 2*dx-1, 2*dz-1
+
+def _grid_indices(shape):
+    '''
+    The row and column of every position of the grid, by qubit label
+    '''
+    n_rows, n_cols=shape
+    return np.divmod(np.arange(n_rows*n_cols), n_cols)
+
+@functools.lru_cache(maxsize=LAYOUT_CACHE_SIZE)
+def _qubit_labels(shape):
+    '''
+    Returns the (data, x gauge, flag, z gauge) qubit labels of the code as tuples
+    '''
+    roles=_role_index(shape)
+    labels=[tuple(np.flatnonzero(roles&np.uint8(role)).tolist())
+            for role in (QubitRole.DATA, QubitRole.X_GAUGE, QubitRole.FLAG, QubitRole.Z_GAUGE)]
+    return tuple(labels)
+
+@functools.lru_cache(maxsize=LAYOUT_CACHE_SIZE)
+def _role_index(shape):
+    '''
+    Returns a read-only uint8 array with the QubitRole flags of every position
+    of the grid, indexed by qubit label
+    '''
+    n_rows, n_cols=shape
+    i, j=_grid_indices(shape)
+    
+    data=(i%2==0)&(j%2==0)
+    # the X gauge qubits in the bulk, and the weight-two ones on the top and bottom rows
+    x_gauge=(((i%4==1)|(i==n_rows-1))&(j%4==3))|(((i%4==3)|(i==0))&(j%4==1))
+    # the z-stb qubits
+    z_gauge=(j%2==0)&(i%2==1)
+    # all but the ends of the weight-two Z checks on the left and right boundaries are flag qubits
+    flag=z_gauge&~(((j==0)&(i%4==1))|((j==n_cols-1)&(i%4==3)))
+    
+    roles=np.zeros(n_rows*n_cols, dtype=np.uint8)
+    roles[data]|=np.uint8(QubitRole.DATA)
+    roles[x_gauge&~data]|=np.uint8(QubitRole.X_GAUGE)
+    roles[z_gauge]|=np.uint8(QubitRole.Z_GAUGE)
+    roles[flag]|=np.uint8(QubitRole.FLAG)
+    roles.flags.writeable=False
+    return roles
+
+# the detectors compare fixed measurements of fixed qubits, so which qubits and
+# how far back is worked out once per layout. A template is a tuple
+# (coords, rec_qubits, lookbacks, ends) -- detector k sits at coords[k] and
+# compares measurement -lookbacks[t] of qubit rec_qubits[t] for t in range(ends[k-1], ends[k])
+def _detector_template(detectors):
+    '''
+    Packs a list of ((i, j), [(qubit, lookback), ...]) detectors into a template
+    '''
+    coords=tuple(coord for coord, _ in detectors)
+    terms=[term for _, detector_terms in detectors for term in detector_terms]
+    rec_qubits=np.array([q for q, _ in terms], dtype=np.intp)
+    lookbacks=np.array([k for _, k in terms], dtype=np.int32)
+    ends=tuple(np.cumsum([len(detector_terms) for _, detector_terms in detectors]).tolist())
+    return coords, rec_qubits, lookbacks, ends
+
+@functools.lru_cache(maxsize=LAYOUT_CACHE_SIZE)
+def _measurement_detector_template(shape, role, parity_factor, qubits_to_detect):
+    '''
+    The template of HeavyHexCode.apply_measurement_detectors
+    '''
+    n_rows, n_cols=shape
+    _, x_gauge_qubits, flag_qubits, _=_qubit_labels(shape)
+    x_gauge_set=frozenset(x_gauge_qubits)
+    flag_set=frozenset(flag_qubits)
+    
+    detectors=[]
+    for el in qubits_to_detect:
+        
+        i=el//n_cols
+        j=el%n_cols
+        
+        if role==QubitRole.FLAG:
+            assert parity_factor==1 # flag qubits are always parity factor 1
+            detectors.append(((i, j), [(el, 1)]))
+        elif role==QubitRole.Z_GAUGE:
+            if parity_factor==1:
+                if (j==0 and i%4==3) or (j==n_cols-1 and i%4==1):
+                    detectors.append(((i, j), [(el, 1)]))
+                elif j==0 and i%4==1:
+                    detectors.append(((i, j), [(el, 1), (el+2, 1)]))
+                elif j==n_cols-1 and i%4==3:
+                    pass
+                elif not((el+1) in x_gauge_set):
+                    detectors.append(((i, j+1), [(el, 1), (el+2, 1)]))
+                else:
+                    pass
+            elif parity_factor==2:
+                # the flag qubits were also measured in the X checks in between
+                if (j==0 and i%4==3) or (j==n_cols-1 and i%4==1):
+                    detectors.append(((i, j), [(el, 1), (el, 3 if el in flag_set else 2)]))
+                elif j==0 and i%4==1:
+                    detectors.append(((i, j+1), [(el, 1), (el, 2), (el+2, 1), (el+2, 3)]))
+                elif j==n_cols-1 and i%4==3:
+                    pass
+                elif not((el+1) in x_gauge_set):
+                    detectors.append(((i, j+1), [(el, 1), (el+2, 1),
+                                                 (el, 3 if el in flag_set else 2),
+                                                 (el+2, 3 if el+2 in flag_set else 2)]))
+                else:
+                    pass
+            else:
+                raise ValueError("Invalid parity factor")
+        elif role==QubitRole.X_GAUGE:
+            if i==0 or i==1:
+                if parity_factor not in (1, 2):
+                    raise ValueError("Invalid parity factor")
+                terms=[]
+                for q_idx in range(el, n_rows*n_cols, n_cols):
+                    if q_idx in x_gauge_set:
+                        terms+=[(q_idx, k) for k in range(1, parity_factor+1)]
+                detectors.append(((i, j), terms))
+        else:
+            raise ValueError("Invalid qubit role")
+    
+    return _detector_template(detectors)
+
+@functools.lru_cache(maxsize=LAYOUT_CACHE_SIZE)
+def _data_detector_template(shape, basis):
+    '''
+    The template of HeavyHexCode.apply_data_measurement_detectors
+    '''
+    n_rows, n_cols=shape
+    _, x_gauge_qubits, flag_qubits, z_gauge_qubits=_qubit_labels(shape)
+    x_gauge_set=frozenset(x_gauge_qubits)
+    flag_set=frozenset(flag_qubits)
+    
+    detectors=[]
+    if basis=='Z':
+        for el in z_gauge_qubits:
+            
+            i=el//n_cols
+            j=el%n_cols
+            
+            # the last Z gauge measurement of a flag qubit is followed by one more X check
+            if (j==0 and i%4==3) or (j==n_cols-1 and i%4==1): # Z stb has only two qubits to check
+                terms=[(el, 2 if el in flag_set else 1)]
+                terms+=[(qb, 1) for qb in [el-n_cols, el, el+n_cols]]
+                detectors.append(((i, j), terms))
+            elif j==n_cols-1 and i%4==3: # boundary condition
+                continue
+            elif not((el+1) in x_gauge_set): # remaining qubits
+                terms=[(el, 2 if el in flag_set else 1), (el+2, 2 if el+2 in flag_set else 1)]
+                terms+=[(dq, 1) for dq in [el-n_cols, el+n_cols, el-n_cols+2, el+n_cols+2]]
+                detectors.append(((i, j), terms))
+            else:
+                pass # the cases on the right
+    
+    elif basis=='X':
+        for el in x_gauge_qubits:
+            
+            i=el//n_cols
+            j=el%n_cols
+            
+            if i==0 or i==1:
+                terms=[]
+                for q_idx in range(el, n_rows*n_cols, n_cols):
+                    if q_idx in x_gauge_set:
+                        terms.append((q_idx, 1))
+                        
+                        q_idx_row=q_idx//n_cols
+                        if q_idx_row==0 or q_idx_row==n_rows-1:
+                            data_qubits_to_check=[q_idx-1, q_idx+1]
+                        else:
+                            data_qubits_to_check=[q_idx-n_cols-1, q_idx-n_cols+1, q_idx+n_cols-1, q_idx+n_cols+1]
+                        terms+=[(dq, 1) for dq in data_qubits_to_check]
+                detectors.append(((i, j), terms))
+    
+    else:
+        raise ValueError("Invalid basis")
+    
+    return _detector_template(detectors)
+
+@functools.lru_cache(maxsize=LAYOUT_CACHE_SIZE)
+def _cnot_sets(shape):
+    '''
+    Returns the CNOT pairs of the second to sixth and the eighth to tenth
+    measurement cycles as tuples
+    '''
+    n_rows, n_cols=shape
+    i, j=_grid_indices(shape)
+    # one False past the end, for the neighbours to the right of the last position
+    is_x_gauge=np.append(_role_index(shape)&np.uint8(QubitRole.X_GAUGE), 0).astype(bool)
+    
+    # before applying the X gauge checks, we categorize the qubits into the different sets
+    # this convention is according to Fig 2 of Chamberland et al - arxiv 1907.09528v2
+    # every set collects (position, control, target) pieces, sorted by position at the end
+    pieces={cycle: [] for cycle in ('second', 'third', 'fourth', 'fifth', 'sixth', 'eighth', 'ninth', 'tenth')}
+    def add(cycle, positions, controls, targets):
+        pieces[cycle].append(np.stack([positions, controls, targets], axis=1))
+    
+    # the Z gauge positions, with data qubits above and below them. At most
+    # one of their two neighbours in the row is an X gauge qubit
+    q=np.flatnonzero((j%2==0)&(i%2==1))
+    
+    # the bulk x-gauge checks, with the X gauge qubit on the left
+    left=q[is_x_gauge[q-1]]
+    add('second', left, left-1, left)
+    add('fifth', left, left-1, left)
+    add('third', left, left, left-n_cols)
+    add('eighth', left, left-n_cols, left)
+    add('fourth', left, left, left+n_cols)
+    add('ninth', left, left+n_cols, left)
+    
+    # and on the right
+    right=q[is_x_gauge[q+1]]
+    add('third', right, right+1, right)
+    add('sixth', right, right+1, right)
+    add('fourth', right, right, right+n_cols)
+    add('ninth', right, right+n_cols, right)
+    add('fifth', right, right, right-n_cols)
+    add('tenth', right, right-n_cols, right)
+    
+    # the weight-two Z checks on the left and right boundaries
+    alone=~is_x_gauge[q-1]&~is_x_gauge[q+1]
+    first_column=q[alone&(j[q]==0)]
+    add('eighth', first_column, first_column-n_cols, first_column)
+    add('ninth', first_column, first_column+n_cols, first_column)
+    last_column=q[alone&(j[q]==n_cols-1)]
+    add('tenth', last_column, last_column-n_cols, last_column)
+    add('ninth', last_column, last_column+n_cols, last_column)
+    
+    # bacon-strip checks
+    top=np.arange(n_cols)
+    bottom=(n_rows-1)*n_cols+top
+    pairs=top[(top%4==2)&is_x_gauge[top-1]]
+    add('fourth', pairs, pairs-1, pairs)
+    pairs=top[(top%4==0)&is_x_gauge[top+1]]
+    add('fifth', pairs, pairs+1, pairs)
+    pairs=bottom[(top%4==2)&is_x_gauge[bottom+1]]
+    add('sixth', pairs, pairs+1, pairs)
+    pairs=bottom[(top%4==0)&is_x_gauge[bottom-1]]
+    add('fifth', pairs, pairs-1, pairs)
+    
+    cnot_sets=[]
+    for cycle, cycle_pieces in pieces.items():
+        rows=np.concatenate(cycle_pieces)
+        rows=rows[np.argsort(rows[:, 0], kind='stable')]
+        cnot_sets.append(tuple(map(tuple, rows[:, 1:].tolist())))
+    return tuple(cnot_sets)
+
 ############################################### ALL THE DECODERS ############################################################################
 
+# the decoders live in decoders.py. They, and the other entry points that live in
+# their own modules, are available from this module too and imported on first use
+_LAZY_ATTRIBUTES={
+    'sweep': ('sweep', 'sweep'),
+    'sharded_sweep': ('sharding', 'sharded_sweep'),
+    'ShardCoordinator': ('sharding', 'ShardCoordinator'),
+    'ShotStream': ('seeding', 'ShotStream'),
+    'find_mistaken_shots': ('seeding', 'find_mistaken_shots'),
+    'SyndromeStore': ('syndrome_store', 'SyndromeStore'),
+    'DecodingStats': ('decoders', 'DecodingStats'),
+    'compile_matching': ('decoders', 'compile_matching'),
+    'sample_and_decode': ('decoders', 'sample_and_decode'),
+    'decode_chunks': ('decoders', 'decode_chunks'),
+    'iter_shot_chunks': ('sampling', 'iter_shot_chunks'),
+    'write_shot_files': ('sampling', 'write_shot_files'),
+    'iter_shot_file_chunks': ('sampling', 'iter_shot_file_chunks'),
+    'FlagAwareDecoder': ('flag_decoding', 'FlagAwareDecoder'),
+    'compile_decoder': ('batch_decoders', 'compile_decoder'),
+    'UnionFindDecoder': ('batch_decoders', 'UnionFindDecoder'),
+    'BpOsdDecoder': ('batch_decoders', 'BpOsdDecoder'),
+    'sinter_decoders': ('batch_decoders', 'sinter_decoders'),
+    'LookupTableDecoder': ('lookup_decoder', 'LookupTableDecoder'),
+    'DeviceNoiseModel': ('noise_model', 'DeviceNoiseModel'),
+    'ReweightableMatching': ('reweighting', 'ReweightableMatching'),
+    'SlidingWindowDecoder': ('sliding_window', 'SlidingWindowDecoder'),
+    'DetectorIndex': ('detector_index', 'DetectorIndex'),
+    'estimate_logical_error_rate': ('rare_events', 'estimate_logical_error_rate'),
+}
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        module_name, attribute=_LAZY_ATTRIBUTES[name]
+        module=__import__(module_name)
+        return getattr(module, attribute)
+    raise AttributeError("module "+repr(__name__)+" has no attribute "+repr(name))
+
+
 # create an instance of the heavy-hex code
 # hhc=HeavyHexCode(
 #     code_distance=5,
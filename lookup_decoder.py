@@ -0,0 +1,313 @@
+'''
+Lookup-table decoding of small heavy-hex circuits
+
+At d=3 and d=5 with a few rounds most shots have a few detection events,
+left by one or two faults. LookupTable enumerates the sets of up to
+max_faults error mechanisms of the detector error model and keeps, for
+every syndrome they leave (with at most max_weight detection events), the
+observable flips of largest total probability. LookupTableDecoder answers
+the shots whose syndrome is in the table with a binary search, and hands
+the others to pymatching.
+
+Syndromes are identified by a 64-bit Zobrist hash, the XOR of a random key
+per detection event, which is computed straight from the bit-packed shots
+with one table of 256 hashes per byte. Two different syndromes share a hash
+with probability 2^-64. The table is kept as its sorted hashes and
+bit-packed predictions, 8+ceil(num_observables/8) bytes per syndrome, in a
+.npz file (see LookupTable.save, and DemCache.lookup_table, which keeps it
+next to the detector error model).
+
+Enumerating the fault sets costs about (number of mechanisms)^max_faults,
+so max_faults=2 suits d=3 and d=5 with up to d rounds, and max_faults=3 d=3
+with a few rounds.
+
+Example:
+
+    from heavy_hex_code import HeavyHexCode
+    from lookup_decoder import LookupTableDecoder
+    from decoders import sample_and_decode
+
+    circuit=HeavyHexCode(code_distance=3, num_rounds=3, basis='Z', ...).create_heavy_hex_code(backend='stim')
+    decoder=LookupTableDecoder.from_circuit(circuit, max_faults=2)
+    stats=sample_and_decode(circuit, shots=10**6, matching=decoder)
+    print(stats, decoder.table_hit_rate)
+'''
+import hashlib
+
+import numpy as np
+import pymatching
+
+from batch_decoders import BatchDecoder, dem_matrices
+from sampling import packed_width
+
+DEFAULT_MAX_FAULTS=2
+DEFAULT_SEED=0
+# number of set bits of every byte
+_POPCOUNT=np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.int64)
+
+
+def dem_fingerprint(dem):
+    '''
+    The sha256 hex digest of the text of a detector error model
+    '''
+    return hashlib.sha256(str(dem).encode()).hexdigest()
+
+
+class LookupTable:
+    '''
+    The most likely observable flips of the syndromes of up to max_faults faults
+    '''
+
+    def __init__(self, detector_keys, hashes, predictions, *, num_observables, max_faults, max_weight, fingerprint):
+        '''
+        Args:
+        detector_keys: The uint64 Zobrist key of every detector
+        hashes: The sorted uint64 hashes of the syndromes in the table
+        predictions: Their bit-packed observable flips
+        num_observables: Observables of the detector error model
+        max_faults: Faults per syndrome the table was built with
+        max_weight: Detection events per syndrome, or None for no limit
+        fingerprint: dem_fingerprint of the detector error model
+        '''
+        self.detector_keys=np.asarray(detector_keys, dtype=np.uint64)
+        self.hashes=np.asarray(hashes, dtype=np.uint64)
+        self.predictions=np.asarray(predictions, dtype=np.uint8)
+        self.num_detectors=len(self.detector_keys)
+        self.num_observables=int(num_observables)
+        self.max_faults=int(max_faults)
+        self.max_weight=max_weight
+        self.fingerprint=fingerprint
+
+        # the hash of every value of every byte of the bit-packed shots
+        keys=np.zeros(8*packed_width(self.num_detectors), dtype=np.uint64)
+        keys[:self.num_detectors]=self.detector_keys
+        keys=keys.reshape(-1, 8)
+        bits=np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1, bitorder='little').astype(bool)
+        self._byte_hashes=np.zeros((len(keys), 256), dtype=np.uint64)
+        for bit in range(8):
+            self._byte_hashes^=np.where(bits[:, bit], keys[:, bit:bit+1], np.uint64(0))
+
+    @classmethod
+    def build(cls, dem, *, max_faults=DEFAULT_MAX_FAULTS, max_weight=None, seed=DEFAULT_SEED):
+        '''
+        Builds the table of a detector error model
+
+        Args:
+        dem: The stim.DetectorErrorModel, decomposed or not
+        max_faults: Largest number of faults per syndrome
+        max_weight: Largest number of detection events per syndrome, None for no limit
+        seed: Seed of the Zobrist keys
+        '''
+        check_matrix, observable_matrix, priors=dem_matrices(dem)
+        usable=(priors>0)&(np.diff(check_matrix.indptr)>0)
+        if np.any(priors[usable]>=0.5):
+            raise ValueError("Error probabilities must be below 0.5")
+        syndromes=np.packbits(check_matrix[:, usable].T.toarray().astype(bool), axis=1, bitorder='little')
+        observables=np.packbits(observable_matrix[:, usable].T.toarray().astype(bool), axis=1, bitorder='little')
+        log_odds=np.log(priors[usable]/(1-priors[usable]))
+
+        rng=np.random.default_rng(seed)
+        detector_keys=rng.integers(0, np.iinfo(np.uint64).max, size=dem.num_detectors, dtype=np.uint64, endpoint=True)
+        table=cls(detector_keys, np.zeros(0, dtype=np.uint64), np.zeros((0, observables.shape[1]), dtype=np.uint8),
+                  num_observables=dem.num_observables, max_faults=max_faults, max_weight=max_weight,
+                  fingerprint=dem_fingerprint(dem))
+
+        hashes=[]
+        codes=[]
+        probabilities=[]
+        for set_syndromes, set_observables, set_log_odds in _fault_sets(syndromes, observables, log_odds,
+                                                                        max_faults, max_weight):
+            hashes.append(table.hash(set_syndromes))
+            codes.append(set_observables)
+            probabilities.append(np.exp(set_log_odds))
+        hashes=np.concatenate(hashes)
+        codes=np.concatenate(codes)
+        probabilities=np.concatenate(probabilities)
+
+        # total probability of every (syndrome, observable flips), then the most likely flips per syndrome
+        _, code_ids=np.unique(codes, axis=0, return_inverse=True)
+        code_ids=code_ids.ravel()
+        order=np.lexsort((code_ids, hashes))
+        hashes, code_ids, codes, probabilities=hashes[order], code_ids[order], codes[order], probabilities[order]
+        starts=np.flatnonzero(np.concatenate([[True], (np.diff(hashes)!=0)|(np.diff(code_ids)!=0)]))
+        totals=np.add.reduceat(probabilities, starts)
+        hashes, codes=hashes[starts], codes[starts]
+        order=np.lexsort((-totals, hashes))
+        first=order[np.concatenate([[True], np.diff(hashes[order])!=0])]
+        table.hashes=hashes[first]
+        table.predictions=codes[first]
+        return table
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def hash(self, shots):
+        '''
+        The Zobrist hashes of bit-packed syndromes
+        '''
+        shots=np.asarray(shots, dtype=np.uint8)
+        hashes=np.zeros(len(shots), dtype=np.uint64)
+        # zero bytes hash to 0, so only the others are looked at
+        rows, columns=np.nonzero(shots)
+        if len(rows):
+            starts=np.flatnonzero(np.concatenate([[True], rows[1:]!=rows[:-1]]))
+            hashes[rows[starts]]=np.bitwise_xor.reduceat(self._byte_hashes[columns, shots[rows, columns]], starts)
+        return hashes
+
+    def lookup(self, shots):
+        '''
+        Looks bit-packed shots up
+
+        Returns a boolean array of the shots found in the table, and the
+        bit-packed predictions of all the shots (zero for those not found)
+        '''
+        shots=np.asarray(shots, dtype=np.uint8)
+        predictions=np.zeros((len(shots), packed_width(self.num_observables)), dtype=np.uint8)
+        if not len(self.hashes):
+            return np.zeros(len(shots), dtype=bool), predictions
+        hashes=self.hash(shots)
+        index=np.minimum(np.searchsorted(self.hashes, hashes), len(self.hashes)-1)
+        found=self.hashes[index]==hashes
+        if self.max_weight is not None:
+            found&=_POPCOUNT[shots].sum(axis=1)<=self.max_weight
+        predictions[found]=self.predictions[index[found]]
+        return found, predictions
+
+    def save(self, file):
+        '''
+        Writes the table to a .npz file (a path or a binary file object)
+        '''
+        np.savez(
+            file,
+            detector_keys=self.detector_keys,
+            hashes=self.hashes,
+            predictions=self.predictions,
+            num_observables=np.int64(self.num_observables),
+            max_faults=np.int64(self.max_faults),
+            max_weight=np.int64(-1 if self.max_weight is None else self.max_weight),
+            fingerprint=np.array(self.fingerprint),
+        )
+
+    @classmethod
+    def load(cls, file):
+        '''
+        Reads a table written by save
+        '''
+        with np.load(file) as arrays:
+            max_weight=int(arrays['max_weight'])
+            return cls(
+                arrays['detector_keys'],
+                arrays['hashes'],
+                arrays['predictions'],
+                num_observables=int(arrays['num_observables']),
+                max_faults=int(arrays['max_faults']),
+                max_weight=None if max_weight<0 else max_weight,
+                fingerprint=str(arrays['fingerprint']),
+            )
+
+
+class LookupTableDecoder(BatchDecoder):
+    '''
+    Decodes the shots in a LookupTable from the table and the others with pymatching
+
+    decode_batch has the signature of pymatching.Matching.decode_batch, see
+    batch_decoders. num_table_shots and num_fallback_shots count the shots
+    answered each way
+    '''
+    # counters left out of syndrome_store.decoder_fingerprint
+    _fingerprint_skip=('num_table_shots', 'num_fallback_shots')
+
+    def __init__(self, detector_error_model, *, max_faults=DEFAULT_MAX_FAULTS, max_weight=None,
+                 table=None, matching=None):
+        '''
+        Args:
+        detector_error_model: The stim.DetectorErrorModel, with decomposed errors
+        max_faults, max_weight: The limits of the table, see LookupTable.build
+        table: The LookupTable of the detector error model (default: built from it)
+        matching: The pymatching.Matching of the shots not in the table (default: built from it)
+        '''
+        super().__init__(detector_error_model)
+        if table is None:
+            table=LookupTable.build(detector_error_model, max_faults=max_faults, max_weight=max_weight)
+        elif table.fingerprint!=dem_fingerprint(detector_error_model):
+            raise ValueError("The lookup table was built for another detector error model")
+        if matching is None:
+            matching=pymatching.Matching.from_detector_error_model(detector_error_model)
+        self.table=table
+        self.matching=matching
+        self.num_table_shots=0
+        self.num_fallback_shots=0
+
+    @classmethod
+    def from_circuit(cls, circuit, *, dem_cache=None, max_faults=DEFAULT_MAX_FAULTS, max_weight=None):
+        '''
+        Builds the decoder of a stim.Circuit
+
+        Args:
+        circuit: The stim.Circuit
+        dem_cache: A dem_cache.DemCache to take the detector error model, the
+        table and the matching graph from
+        max_faults, max_weight: The limits of the table, see LookupTable.build
+        '''
+        if dem_cache is None:
+            return super().from_circuit(circuit, max_faults=max_faults, max_weight=max_weight)
+        return cls(
+            dem_cache.detector_error_model(circuit),
+            table=dem_cache.lookup_table(circuit, max_faults=max_faults, max_weight=max_weight),
+            matching=dem_cache.matching(circuit),
+        )
+
+    @property
+    def table_hit_rate(self):
+        '''
+        The fraction of the shots decoded so far that were found in the table
+        '''
+        shots=self.num_table_shots+self.num_fallback_shots
+        return self.num_table_shots/shots if shots else 0.0
+
+    def _decode_packed(self, shots):
+        found, predictions=self.table.lookup(shots)
+        rest=np.flatnonzero(~found)
+        if len(rest):
+            fallback=self.matching.decode_batch(shots[rest], bit_packed_shots=True, bit_packed_predictions=True)
+            predictions[rest, :fallback.shape[1]]=fallback
+        self.num_table_shots+=len(shots)-len(rest)
+        self.num_fallback_shots+=len(rest)
+        return predictions
+
+
+def _fault_sets(syndromes, observables, log_odds, max_faults, max_weight):
+    '''
+    Yields the (syndromes, observables, log_odds) of the sets of 0 to
+    max_faults mechanisms whose syndrome has at most max_weight detection
+    events, one array per number of faults. The log odds of a set are the
+    sum of those of its mechanisms
+    '''
+    num_mechanisms=len(log_odds)
+    yield (np.zeros((1, syndromes.shape[1]), dtype=np.uint8),
+           np.zeros((1, observables.shape[1]), dtype=np.uint8),
+           np.zeros(1))
+    if max_weight is None:
+        max_weight=syndromes.shape[1]*8
+    # a fault clears at most this many detection events
+    largest=int(_POPCOUNT[syndromes].sum(axis=1).max()) if num_mechanisms else 0
+
+    # the sets of k mechanisms, each one with the largest mechanism it holds
+    set_syndromes, set_observables, set_log_odds=syndromes, observables, log_odds
+    last=np.arange(num_mechanisms)
+    for k in range(1, max_faults+1):
+        weights=_POPCOUNT[set_syndromes].sum(axis=1)
+        kept=weights<=max_weight
+        yield set_syndromes[kept], set_observables[kept], set_log_odds[kept]
+        if k==max_faults:
+            break
+
+        # extend the sets that more faults can still bring down to max_weight by a later mechanism
+        viable=np.flatnonzero((weights<=max_weight+(max_faults-k)*largest)&(last<num_mechanisms-1))
+        counts=num_mechanisms-1-last[viable]
+        parents=np.repeat(viable, counts)
+        added=np.repeat(last[viable]+1-np.cumsum(counts)+counts, counts)+np.arange(counts.sum())
+        set_syndromes=set_syndromes[parents]^syndromes[added]
+        set_observables=set_observables[parents]^observables[added]
+        set_log_odds=set_log_odds[parents]+log_odds[added]
+        last=added
@@ -0,0 +1,248 @@
+'''
+Heterogeneous, device-calibrated noise for the heavy-hex code
+
+A DeviceNoiseModel gives HeavyHexCode a rate per qubit (or per CNOT pair)
+for every noise channel instead of the four scalar error parameters:
+
+single_qubit_gate  DEPOLARIZE1 after the Hadamards of the X checks
+cnot               DEPOLARIZE2 after every CNOT, keyed by the (control, target)
+                   pairs of the *_cycle_pairs lists
+readout            flip before every measurement
+reset              flip after every reset
+idle               DEPOLARIZE1 on the data qubits before every round
+
+The calibration is a JSON file, keyed by the HeavyHexCode qubit labels
+(i*(2d-1)+j on the grid):
+
+    {
+        "code_distance": 5,
+        "defaults": {"cnot": 0.008, "readout": 0.02},
+        "readout": {"0": 0.013, "2": 0.021},
+        "reset": {"0": 0.002},
+        "single_qubit_gate": {"1": 0.0003},
+        "idle": {"0": 0.001},
+        "cnot": [[6, 0, 0.007], [6, 2, 0.011]]
+    }
+
+Every section is optional. code_distance is d, or [dx, dz] for a
+rectangular patch; when given, the model only builds circuits of that
+distance. Every listed qubit must be a qubit of the code and every listed
+pair one of its CNOT pairs, else building the circuit raises ValueError.
+A CNOT pair matches in either direction. A qubit
+or pair that is not listed gets the default of its channel, and a channel
+without a default falls back to the matching scalar parameter of
+HeavyHexCode (after_clifford_depolarization for single_qubit_gate and cnot,
+before_measure_flip_probability for readout, after_reset_flip_probability
+for reset, before_round_data_depolarization for idle).
+
+Files are only read when a circuit is built, and the parsed tables are
+cached on (path, modification time, size), so any number of models and
+builds share one parse of a large calibration set.
+'''
+import collections
+import hashlib
+import json
+import os
+
+import numpy as np
+
+CHANNELS=('single_qubit_gate', 'cnot', 'readout', 'reset', 'idle')
+QUBIT_CHANNELS=('single_qubit_gate', 'readout', 'reset', 'idle')
+CHARACTERIZATION_DATA_DIRECTORY=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'characterization_data')
+# number of parsed calibration files kept around
+CALIBRATION_CACHE_SIZE=16
+
+
+class Calibration:
+    '''
+    The parsed tables of a calibration: dense per-qubit rate arrays (nan for
+    qubits that are not listed) and a dict of CNOT pair rates
+    '''
+
+    def __init__(self, data):
+        unknown=set(data)-set(CHANNELS)-{'code_distance', 'defaults'}
+        if unknown:
+            raise ValueError("Unknown calibration sections "+repr(sorted(unknown)))
+        self.code_distance=data.get('code_distance')
+        if isinstance(self.code_distance, (list, tuple)):
+            self.code_distance=tuple(int(d) for d in self.code_distance)
+        elif self.code_distance is not None:
+            self.code_distance=(int(self.code_distance),)*2
+        self.defaults={}
+        for channel, p in data.get('defaults', {}).items():
+            if channel not in CHANNELS:
+                raise ValueError("Unknown noise channel "+repr(channel))
+            self.defaults[channel]=_check_probability(p)
+
+        self.qubit_rates={}
+        for channel in QUBIT_CHANNELS:
+            entries=data.get(channel, {})
+            labels=np.array([int(label) for label in entries], dtype=np.int64)
+            if len(labels) and labels.min()<0:
+                raise ValueError(f"Negative qubit label {list(entries)[int(np.argmin(labels))]!r} in {channel!r}")
+            table=np.full(labels.max()+1 if len(labels) else 0, np.nan)
+            table[labels]=[_check_probability(p) for p in entries.values()]
+            self.qubit_rates[channel]=table
+
+        self.cnot_rates={}
+        for control, target, p in data.get('cnot', []):
+            self.cnot_rates[_pair_key(control, target)]=_check_probability(p)
+
+
+class DeviceNoiseModel:
+    '''
+    Per-qubit and per-CNOT-pair error rates from a calibration file
+
+    Pass it as the noise_model of HeavyHexCode
+    '''
+
+    def __init__(self, path=None, *, calibration=None, significant_digits=None):
+        '''
+        Args:
+        path: The JSON calibration file, read lazily
+        calibration: The calibration as a dict, instead of a file
+        significant_digits: Round the rates to this many significant digits,
+        so that more qubits share a rate and an error instruction (default: exact)
+        '''
+        if (path is None)==(calibration is None):
+            raise ValueError("Give either a calibration file or a calibration dict")
+        self.path=None if path is None else os.path.abspath(path)
+        self.significant_digits=significant_digits
+        self._data=calibration
+        self._calibration=None
+        self._key=None
+
+    @classmethod
+    def from_characterization_data(cls, name):
+        '''
+        The model of a calibration file in the characterization_data directory
+        '''
+        return cls(os.path.join(CHARACTERIZATION_DATA_DIRECTORY, name))
+
+    @property
+    def calibration(self):
+        '''
+        The parsed Calibration, loaded on first use
+        '''
+        if self.path is not None:
+            return load_calibration(self.path)
+        if self._calibration is None:
+            self._calibration=Calibration(self._data)
+        return self._calibration
+
+    def cache_key(self):
+        '''
+        Identifies the rates of the model -- part of the circuit cache key of HeavyHexCode
+        '''
+        if self.path is not None:
+            return ('file',)+_file_key(self.path)+(self.significant_digits,)
+        if self._key is None:
+            self._key=('dict', hashlib.sha256(json.dumps(self._data, sort_keys=True).encode()).hexdigest(),
+                       self.significant_digits)
+        return self._key
+
+    def check_code(self, code):
+        '''
+        Raises ValueError if the calibration is for another code distance
+        than that of the HeavyHexCode, or lists a qubit or a CNOT pair that
+        the code does not have
+        '''
+        calibration=self.calibration
+        if calibration.code_distance is not None and calibration.code_distance!=(code.dx, code.dz):
+            raise ValueError(f"The calibration is for code distance {calibration.code_distance}, "
+                             f"not {(code.dx, code.dz)}")
+        for channel in QUBIT_CHANNELS:
+            labels=np.flatnonzero(~np.isnan(calibration.qubit_rates[channel]))
+            unknown=labels[(labels>=len(code.qubit_roles))|(code.qubit_roles[np.minimum(labels, len(code.qubit_roles)-1)]==0)]
+            if len(unknown):
+                raise ValueError(f"The {channel} calibration lists qubits the code does not have: {unknown.tolist()}")
+        pairs={_pair_key(*pair) for pairs in (code.second_cycle_pairs, code.third_cycle_pairs, code.fourth_cycle_pairs,
+                                              code.fifth_cycle_pairs, code.sixth_cycle_pairs, code.eighth_cycle_pairs,
+                                              code.ninth_cycle_pairs, code.tenth_cycle_pairs) for pair in pairs}
+        unknown=sorted(set(calibration.cnot_rates)-pairs)
+        if unknown:
+            raise ValueError(f"The cnot calibration lists pairs the code does not have: {unknown}")
+
+    def rates(self, channel, targets, default):
+        '''
+        Returns the error rate of every target as a float array
+
+        Args:
+        channel: One of CHANNELS
+        targets: Qubit labels, or (control, target) pairs for 'cnot'
+        default: The rate of targets that the calibration does not list,
+        if the calibration has no default for the channel
+        '''
+        calibration=self.calibration
+        default=calibration.defaults.get(channel, default)
+        if channel=='cnot':
+            get=calibration.cnot_rates.get
+            rates=np.array([get(_pair_key(*pair), default) for pair in targets], dtype=np.float64)
+        elif channel in QUBIT_CHANNELS:
+            table=calibration.qubit_rates[channel]
+            targets=np.asarray(targets, dtype=np.int64)
+            rates=np.full(len(targets), np.nan)
+            listed=targets<len(table)
+            rates[listed]=table[targets[listed]]
+            rates[np.isnan(rates)]=default
+        else:
+            raise ValueError("Unknown noise channel "+repr(channel))
+
+        if self.significant_digits is not None:
+            rates=np.array([float(f"{p:.{self.significant_digits}g}") for p in rates], dtype=np.float64)
+        return rates
+
+    def group(self, channel, targets, default):
+        '''
+        Returns [(rate, targets with that rate)], the rates in the order
+        they first appear and the targets in their original order, so that
+        one error instruction per distinct rate covers all the targets
+        '''
+        targets=list(targets)
+        if not targets:
+            return []
+        rates=self.rates(channel, targets, default)
+        values, first, inverse=np.unique(rates, return_index=True, return_inverse=True)
+        inverse=inverse.ravel()
+        order=np.argsort(inverse, kind='stable')
+        bounds=np.searchsorted(inverse[order], np.arange(len(values)+1))
+        groups=[]
+        for k in np.argsort(first, kind='stable'):
+            groups.append((float(values[k]), [targets[i] for i in order[bounds[k]:bounds[k+1]]]))
+        return groups
+
+
+_calibration_cache=collections.OrderedDict()
+
+def load_calibration(path):
+    '''
+    Returns the Calibration of a JSON file, cached on (path, modification time, size)
+    '''
+    key=_file_key(path)
+    calibration=_calibration_cache.get(key)
+    if calibration is not None:
+        _calibration_cache.move_to_end(key)
+        return calibration
+    with open(path) as f:
+        calibration=Calibration(json.load(f))
+    _calibration_cache[key]=calibration
+    while len(_calibration_cache)>CALIBRATION_CACHE_SIZE:
+        _calibration_cache.popitem(last=False)
+    return calibration
+
+
+def _file_key(path):
+    stat=os.stat(path)
+    return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+
+def _pair_key(control, target):
+    control, target=int(control), int(target)
+    return (control, target) if control<target else (target, control)
+
+
+def _check_probability(p):
+    p=float(p)
+    if not 0.0<=p<=1.0:
+        raise ValueError("Invalid error probability "+repr(p))
+    return p
@@ -0,0 +1,364 @@
+'''
+Logical error rates at low p by stratified sampling over the number of faults
+
+At p=1e-4 almost every shot of a heavy-hex circuit has no fault, or a single
+one the decoder corrects, so direct sampling decodes millions of shots per
+logical error. The faults of the detector error model are independent, so
+the logical error rate splits over the number of faults k:
+
+    P_L = sum over k of P(k faults)*P(logical error | k faults)
+
+P(k faults) is computed exactly from the error probabilities, and
+P(logical error | k faults) is estimated by sampling shots with exactly k
+faults. Those shots fail far more often than unconditioned ones, and the
+shots are spread over the strata (Neyman allocation) to minimize the
+variance of P_L. The probability of more faults than the largest stratum
+is added to the upper end of the confidence interval.
+
+Example:
+
+    from heavy_hex_code import HeavyHexCode
+    from rare_events import estimate_logical_error_rate
+
+    circuit=HeavyHexCode(code_distance=5, num_rounds=5, basis='Z', ...).create_heavy_hex_code(backend='stim')
+    estimate=estimate_logical_error_rate(circuit, shots=10**5)
+    print(estimate.logical_error_rate, estimate.confidence_interval())
+'''
+import math
+import time
+
+import numpy as np
+import stim
+
+from decoders import compile_matching, count_mistakes
+from dem_cache import build_detector_error_model
+
+DEFAULT_MAX_TAIL=1e-15
+DEFAULT_PILOT_SHOTS=256
+DEFAULT_ALLOCATION_ROUNDS=4
+
+
+class FaultStrata:
+    '''
+    The error mechanisms of a detector error model, sampled with a fixed
+    number of faults
+    '''
+
+    def __init__(self, dem):
+        '''
+        Args:
+        dem: The stim.DetectorErrorModel, decomposed or not
+        '''
+        probabilities=[]
+        detectors=[]
+        observables=[]
+        for instruction in dem.flattened():
+            if instruction.type!='error':
+                continue
+            probability=instruction.args_copy()[0]
+            if probability==0:
+                continue
+            if probability>=0.5:
+                raise ValueError("Error probabilities must be below 0.5")
+            targets=instruction.targets_copy()
+            probabilities.append(probability)
+            # the pieces of a decomposed error flip the XOR of their targets, repeats cancel when sampling
+            detectors.append([target.val for target in targets if target.is_relative_detector_id()])
+            observables.append([target.val for target in targets if target.is_logical_observable_id()])
+        self.probabilities=np.array(probabilities, dtype=np.float64)
+        self.num_detectors=dem.num_detectors
+        self.num_observables=dem.num_observables
+        self._detector_ptr, self._detector_ids=_csr(detectors)
+        self._observable_ptr, self._observable_ids=_csr(observables)
+
+        # a set of k faults has probability proportional to the product of p/(1-p) of its faults
+        weights=self.probabilities/(1-self.probabilities)
+        self._cumulative_weights=np.cumsum(weights)/weights.sum() if len(weights) else weights
+
+    @classmethod
+    def from_circuit(cls, circuit, dem_cache=None):
+        '''
+        The error mechanisms of the decomposed detector error model of a circuit
+        '''
+        if not isinstance(circuit, stim.Circuit):
+            circuit=stim.Circuit(circuit)
+        if dem_cache is not None:
+            return cls(dem_cache.detector_error_model(circuit))
+        return cls(build_detector_error_model(circuit))
+
+    @property
+    def num_mechanisms(self):
+        return len(self.probabilities)
+
+    @property
+    def mean_faults(self):
+        return float(self.probabilities.sum())
+
+    def fault_count_distribution(self, max_faults):
+        '''
+        Returns the probabilities of 0..max_faults faults, and the
+        probability of more than max_faults faults
+        '''
+        # the mass beyond this many faults is far below double precision
+        num_computed=max(max_faults, int(self.mean_faults+12*math.sqrt(self.mean_faults))+40)
+        probabilities=_poisson_binomial(self.probabilities, num_computed)
+        return probabilities[:max_faults+1], float(probabilities[max_faults+1:].sum())
+
+    def default_max_faults(self, max_tail=DEFAULT_MAX_TAIL):
+        '''
+        The smallest number of faults (at least 1) that more faults are less
+        likely than max_tail
+        '''
+        num_computed=int(self.mean_faults+12*math.sqrt(self.mean_faults))+40
+        probabilities=_poisson_binomial(self.probabilities, num_computed)
+        # tails[k] is the probability of more than k faults
+        tails=np.concatenate([np.cumsum(probabilities[::-1])[::-1][1:], [0.0]])
+        return max(1, int(np.argmax(tails<=max_tail)))
+
+    def sample(self, num_faults, shots, rng):
+        '''
+        Samples shots with exactly num_faults faults
+
+        Returns the bit-packed detection events and observable flips, as
+        from stim's detector sampler with separate_observables
+
+        Args:
+        num_faults: The number of faults of every shot
+        shots: Number of shots
+        rng: The numpy.random.Generator to draw the faults with
+        '''
+        if num_faults>self.num_mechanisms:
+            raise ValueError("More faults than error mechanisms")
+        faults=np.empty((shots, num_faults), dtype=np.int64)
+        # drawing with replacement in proportion to p/(1-p) and redrawing the
+        # shots with a repeated fault draws every set of faults with its
+        # probability conditioned on the number of faults
+        pending=np.arange(shots)
+        while len(pending):
+            draws=np.searchsorted(self._cumulative_weights, rng.random((len(pending), num_faults)), side='right')
+            draws=np.minimum(draws, self.num_mechanisms-1)
+            distinct=np.all(np.diff(np.sort(draws, axis=1), axis=1)>0, axis=1)
+            faults[pending[distinct]]=draws[distinct]
+            pending=pending[~distinct]
+        detection_events=_flip_bits(faults, self._detector_ptr, self._detector_ids, self.num_detectors)
+        observables=_flip_bits(faults, self._observable_ptr, self._observable_ids, self.num_observables)
+        return detection_events, observables
+
+
+class StratifiedEstimate:
+    '''
+    A logical error rate estimated from shots with a fixed number of faults
+    '''
+
+    def __init__(self, *, fault_counts, probabilities, tail, shots, errors, observable_errors,
+                 sample_seconds, decode_seconds):
+        self.fault_counts=fault_counts # the number of faults of every stratum
+        self.probabilities=probabilities # the probability of every stratum
+        self.tail=tail # the probability of more faults than the last stratum
+        self.shots=shots # decoded shots per stratum
+        self.errors=errors # logical errors per stratum
+        self.observable_errors=observable_errors # (strata, observables) mispredictions
+        self.sample_seconds=sample_seconds
+        self.decode_seconds=decode_seconds
+
+    @property
+    def total_shots(self):
+        return int(self.shots.sum())
+
+    @property
+    def stratum_error_rates(self):
+        '''
+        The logical error rate of the shots of every stratum
+        '''
+        return self.errors/np.maximum(self.shots, 1)
+
+    @property
+    def logical_error_rate(self):
+        return float(self.probabilities@self.stratum_error_rates)
+
+    @property
+    def observable_error_rates(self):
+        '''
+        The error rate of every observable -- of the X and the Z memory of an 'XZ' circuit
+        '''
+        return self.probabilities@(self.observable_errors/np.maximum(self.shots, 1)[:, None])
+
+    @property
+    def standard_error(self):
+        '''
+        The standard error of the logical error rate. The rates of the strata
+        are smoothed to (errors+0.5)/(shots+1) in the variance, so that strata
+        without errors still count
+        '''
+        rates=_smoothed_rates(self.errors, self.shots)
+        return math.sqrt(float(np.sum(self.probabilities**2*rates*(1-rates)/np.maximum(self.shots, 1))))
+
+    def confidence_interval(self, z=1.96):
+        '''
+        The normal interval of the logical error rate, widened by the
+        probability of more faults than the last stratum
+        '''
+        rate=self.logical_error_rate
+        half_width=z*self.standard_error
+        return max(0.0, rate-half_width), min(1.0, rate+half_width+self.tail)
+
+    def __repr__(self):
+        low, high=self.confidence_interval()
+        return (f"StratifiedEstimate(shots={self.total_shots}, errors={int(self.errors.sum())}, "
+                f"rate={self.logical_error_rate:.3g} [{low:.3g}, {high:.3g}], "
+                f"faults=1..{self.fault_counts[-1]}, tail={self.tail:.2g})")
+
+
+def estimate_logical_error_rate(circuit, *, shots, matching=None, max_faults=None, max_tail=DEFAULT_MAX_TAIL,
+                                pilot_shots=DEFAULT_PILOT_SHOTS, allocation_rounds=DEFAULT_ALLOCATION_ROUNDS,
+                                batch_size=2**14, seed=None, dem_cache=None, decode_kwargs=None):
+    '''
+    Estimates the logical error rate of a circuit by sampling shots with
+    1..max_faults faults, see the module docstring
+
+    Every stratum first gets pilot_shots shots, the rest of the shots are
+    spread over allocation_rounds rounds, in proportion to the probability of
+    the stratum times the standard deviation of its error rate so far.
+
+    Args:
+    circuit: The stim.Circuit (e.g. from HeavyHexCode.create_heavy_hex_code(backend='stim'))
+    shots: Total number of decoded shots
+    matching: The pymatching.Matching to decode with (default: built from the circuit)
+    max_faults: The largest number of faults sampled (default: the smallest
+    that more faults are less likely than max_tail)
+    max_tail: See max_faults
+    pilot_shots: Shots of every stratum before the allocation
+    allocation_rounds: Number of times the remaining shots are reallocated
+    batch_size: Shots sampled and decoded at once
+    seed: Seed of the numpy generator the faults are drawn with
+    dem_cache: A dem_cache.DemCache to take the detector error model and the matching graph from
+    decode_kwargs: Extra keyword arguments for Matching.decode_batch
+    '''
+    if not isinstance(circuit, stim.Circuit):
+        circuit=stim.Circuit(circuit)
+    if matching is None:
+        matching=compile_matching(circuit, dem_cache)
+    decode_kwargs=decode_kwargs or {}
+    strata=FaultStrata.from_circuit(circuit, dem_cache)
+    if max_faults is None:
+        max_faults=strata.default_max_faults(max_tail)
+    max_faults=min(max_faults, strata.num_mechanisms)
+    probabilities, tail=strata.fault_count_distribution(max_faults)
+    # no fault, no detection event and no logical error
+    fault_counts=np.arange(1, max_faults+1)
+    probabilities=probabilities[1:]
+
+    rng=np.random.default_rng(seed)
+    num_observables=circuit.num_observables
+    num_strata=len(fault_counts)
+    stratum_shots=np.zeros(num_strata, dtype=np.int64)
+    errors=np.zeros(num_strata, dtype=np.int64)
+    observable_errors=np.zeros((num_strata, num_observables), dtype=np.int64)
+    seconds=[0.0, 0.0]
+
+    def run(stratum, count):
+        while count>0:
+            batch=min(count, batch_size)
+            t0=time.perf_counter()
+            detection_events, observables=strata.sample(int(fault_counts[stratum]), batch, rng)
+            t1=time.perf_counter()
+            predictions=matching.decode_batch(detection_events, bit_packed_shots=True,
+                                              bit_packed_predictions=True, **decode_kwargs)
+            t2=time.perf_counter()
+            batch_errors, per_observable=count_mistakes(predictions, observables, num_observables)
+            stratum_shots[stratum]+=batch
+            errors[stratum]+=batch_errors
+            observable_errors[stratum]+=per_observable
+            seconds[0]+=t1-t0
+            seconds[1]+=t2-t1
+            count-=batch
+
+    pilot_shots=min(pilot_shots, max(shots//(2*num_strata), 1))
+    for stratum in range(num_strata):
+        run(stratum, pilot_shots)
+    for allocation_round in range(allocation_rounds):
+        remaining=shots-int(stratum_shots.sum())
+        if remaining<=0:
+            break
+        budget=remaining//(allocation_rounds-allocation_round)
+        rates=_smoothed_rates(errors, stratum_shots)
+        weights=probabilities*np.sqrt(rates*(1-rates))
+        if not weights.sum()>0:
+            break
+        for stratum, count in enumerate(np.floor(budget*weights/weights.sum()).astype(np.int64)):
+            run(stratum, int(count))
+
+    return StratifiedEstimate(
+        fault_counts=fault_counts,
+        probabilities=probabilities,
+        tail=tail,
+        shots=stratum_shots,
+        errors=errors,
+        observable_errors=observable_errors,
+        sample_seconds=seconds[0],
+        decode_seconds=seconds[1],
+    )
+
+
+def _smoothed_rates(errors, shots):
+    '''
+    The error rates of the strata, pulled away from 0 and 1
+    '''
+    return (errors+0.5)/(shots+1)
+
+
+def _poisson_binomial(probabilities, max_count):
+    '''
+    The probabilities of 0..max_count successes of independent Bernoulli
+    trials: the coefficients of the product of (1-p+p*x), multiplied in pairs
+    '''
+    polynomials=np.zeros((max(len(probabilities), 1), max_count+1), dtype=np.float64)
+    polynomials[:, 0]=1
+    if len(probabilities):
+        polynomials[:, 0]=1-probabilities
+        if max_count>=1:
+            polynomials[:, 1]=probabilities
+    # every row is rescaled to a maximum of 1, so that long products do not underflow
+    log_scales=np.zeros(len(polynomials), dtype=np.float64)
+    while len(polynomials)>1:
+        if len(polynomials)%2:
+            polynomials=np.vstack([polynomials, np.eye(1, max_count+1)])
+            log_scales=np.append(log_scales, 0.0)
+        first=polynomials[0::2]
+        second=polynomials[1::2]
+        product=np.zeros_like(first)
+        for degree in range(max_count+1):
+            product[:, degree:]+=first[:, degree:degree+1]*second[:, :max_count+1-degree]
+        scales=product.max(axis=1)
+        polynomials=product/scales[:, None]
+        log_scales=log_scales[0::2]+log_scales[1::2]+np.log(scales)
+    return polynomials[0]*np.exp(log_scales[0])
+
+
+def _csr(rows):
+    '''
+    The (pointers, values) of a list of lists of ints
+    '''
+    pointers=np.zeros(len(rows)+1, dtype=np.int64)
+    pointers[1:]=np.cumsum([len(row) for row in rows])
+    values=np.fromiter((value for row in rows for value in row), dtype=np.int64, count=int(pointers[-1]))
+    return pointers, values
+
+
+def _flip_bits(faults, pointers, ids, num_bits):
+    '''
+    The bit-packed XOR of the ids of the faults of every shot
+    '''
+    shots=len(faults)
+    packed=np.zeros((shots, (num_bits+7)//8), dtype=np.uint8)
+    starts=pointers[faults].ravel()
+    lengths=pointers[faults+1].ravel()-starts
+    total=int(lengths.sum())
+    if total==0:
+        return packed
+    # the ids of the faults, concatenated, with the shot of every id
+    offsets=np.repeat(starts-np.cumsum(lengths)+lengths, lengths)
+    flipped=ids[offsets+np.arange(total)]
+    rows=np.repeat(np.repeat(np.arange(shots), faults.shape[1]), lengths)
+    np.bitwise_xor.at(packed, (rows, flipped>>3), (1<<(flipped&7)).astype(np.uint8))
+    return packed
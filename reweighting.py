@@ -0,0 +1,233 @@
+'''
+Matching graphs of noise sweeps without rebuilding the detector error model
+
+In a sweep over p the circuit of a (distance, rounds, basis) point has the
+same structure at every p, only the error probabilities change. stim turns
+every error channel into independent Pauli terms and merges the terms of an
+error mechanism exactly, so every error of the decomposed detector error
+model satisfies
+
+    log(1-2p_error) = sum over terms t of coefficients[error, t]*t(p)
+
+over five terms of the four error parameters of HeavyHexCode:
+
+    log(1-4p/3)     DEPOLARIZE1 of after_clifford_depolarization
+    log(1-16p/15)   DEPOLARIZE2 of after_clifford_depolarization
+    log(1-2p)       after_reset_flip_probability
+    log(1-2p)       before_measure_flip_probability
+    log(1-4p/3)     before_round_data_depolarization
+
+and so does every edge of the matching graph, pymatching merges the
+decomposed pieces of the errors on an edge the same way. The coefficients
+(multiples of 1/8) are fitted once from a few detector error models at
+distinct error parameters, then the edge weights at any error parameters
+are one small matrix-vector product, and the pymatching graph is rebuilt
+from the check matrix, which is kept, instead of from a new detector error
+model.
+
+Example:
+
+    from reweighting import ReweightableMatching
+    from sweep import uniform_noise
+
+    reweightable=ReweightableMatching(code_distance=7, num_rounds=7, basis='Z')
+    for p in np.geomspace(1e-4, 1e-2, 50):
+        matching=reweightable.matching(**uniform_noise(p))
+'''
+import functools
+
+import numpy as np
+import pymatching
+import scipy.sparse
+
+from dem_cache import build_detector_error_model, check_matrices
+from heavy_hex_code import HeavyHexCode
+
+NOISE_PARAMETERS=(
+    'after_clifford_depolarization',
+    'after_reset_flip_probability',
+    'before_measure_flip_probability',
+    'before_round_data_depolarization',
+)
+# (error parameter, the probability of the channel is 1-exp(term)/2 of it)
+TERMS=(
+    ('after_clifford_depolarization', 4/3),
+    ('after_clifford_depolarization', 16/15),
+    ('after_reset_flip_probability', 2.0),
+    ('before_measure_flip_probability', 2.0),
+    ('before_round_data_depolarization', 4/3),
+)
+# the error parameters the coefficients are fitted at, one more than the
+# number of terms so that the fit is checked
+FIT_SEED=0
+NUM_FIT_POINTS=len(TERMS)+1
+FIT_RANGE=(0.01, 0.1)
+# the coefficients are multiples of 1/COEFFICIENT_DENOMINATOR
+COEFFICIENT_DENOMINATOR=8
+FIT_TOLERANCE=1e-6
+# number of (distance, rounds, basis) structures kept around
+STRUCTURE_CACHE_SIZE=32
+
+
+class ReweightableMatching:
+    '''
+    The matching graph of a (distance, rounds, basis) point, at any error parameters
+    '''
+
+    def __init__(self, code_distance, num_rounds, basis):
+        self.code_distance=code_distance
+        self.num_rounds=num_rounds
+        self.basis=basis
+        structure=_structure(code_distance, num_rounds, basis)
+        self.coefficients=structure['coefficients'] # (edges, TERMS)
+        self.num_detectors=structure['num_detectors']
+        self.num_observables=structure['num_observables']
+        self._check_matrix=structure['check_matrix']
+        self._faults_matrix=structure['faults_matrix']
+
+        parameter_index={name: i for i, name in enumerate(NOISE_PARAMETERS)}
+        self._term_parameter=np.array([parameter_index[name] for name, _ in TERMS], dtype=np.int64)
+        self._term_scale=np.array([scale for _, scale in TERMS], dtype=np.float64)
+
+    @property
+    def num_edges(self):
+        return self.coefficients.shape[0]
+
+    def edge_probabilities(self, **noise):
+        '''
+        Returns the error probability of every edge
+
+        Args:
+        noise: The four error parameters of HeavyHexCode
+        '''
+        missing=set(NOISE_PARAMETERS)-set(noise)
+        unknown=set(noise)-set(NOISE_PARAMETERS)
+        if missing or unknown:
+            raise ValueError("Give exactly the error parameters "+", ".join(NOISE_PARAMETERS))
+        return -np.expm1(self.coefficients@_terms(noise, self._term_parameter, self._term_scale))/2
+
+    def matching(self, **noise):
+        '''
+        Returns the pymatching.Matching at the given error parameters, the
+        same graph as pymatching.Matching.from_detector_error_model of the
+        circuit at those parameters
+
+        Args:
+        noise: The four error parameters of HeavyHexCode
+        '''
+        probabilities=self.edge_probabilities(**noise)
+        check_matrix=self._check_matrix
+        faults_matrix=self._faults_matrix
+        if not np.all(probabilities>0):
+            # the edges of the error parameters that are 0 do not exist
+            keep=np.flatnonzero(probabilities>0)
+            probabilities=probabilities[keep]
+            check_matrix=check_matrix[:, keep]
+            faults_matrix=faults_matrix[:, keep]
+        if len(probabilities)==0:
+            return pymatching.Matching()
+        return pymatching.Matching.from_check_matrix(
+            check_matrix,
+            weights=np.log((1-probabilities)/probabilities),
+            error_probabilities=probabilities,
+            faults_matrix=faults_matrix,
+            use_virtual_boundary_node=True,
+        )
+
+
+def _terms(noise, term_parameter, term_scale):
+    parameters=np.array([noise[name] for name in NOISE_PARAMETERS], dtype=np.float64)
+    return np.log1p(-term_scale*parameters[term_parameter])
+
+
+@functools.lru_cache(maxsize=STRUCTURE_CACHE_SIZE)
+def _structure(code_distance, num_rounds, basis):
+    '''
+    Fits the coefficients of the errors of a (distance, rounds, basis) point
+    and sums them onto the edges of its matching graph
+    '''
+    parameter_index={name: i for i, name in enumerate(NOISE_PARAMETERS)}
+    term_parameter=np.array([parameter_index[name] for name, _ in TERMS], dtype=np.int64)
+    term_scale=np.array([scale for _, scale in TERMS], dtype=np.float64)
+
+    # the errors are in the same order with the same decompositions at all
+    # nonzero error parameters, only their probabilities change
+    rng=np.random.default_rng(FIT_SEED)
+    targets=None
+    terms=[]
+    log_biases=[]
+    for point in rng.uniform(*FIT_RANGE, size=(NUM_FIT_POINTS, len(NOISE_PARAMETERS))):
+        noise=dict(zip(NOISE_PARAMETERS, point))
+        circuit=HeavyHexCode(
+            code_distance=code_distance,
+            num_rounds=num_rounds,
+            basis=basis,
+            **noise,
+        ).create_heavy_hex_code(backend='stim')
+        errors=[instruction for instruction in build_detector_error_model(circuit).flattened() if instruction.type=='error']
+        if targets is None:
+            targets=[instruction.targets_copy() for instruction in errors]
+        elif len(errors)!=len(targets) or any(instruction.targets_copy()!=t for instruction, t in zip(errors, targets)):
+            raise ValueError("The detector error model changes with the error parameters")
+        terms.append(_terms(noise, term_parameter, term_scale))
+        log_biases.append(np.log1p(-2*np.array([instruction.args_copy()[0] for instruction in errors])))
+    terms=np.array(terms)
+    log_biases=np.array(log_biases)
+    coefficients=np.linalg.lstsq(terms, log_biases, rcond=None)[0]
+    coefficients=np.round(coefficients*COEFFICIENT_DENOMINATOR)/COEFFICIENT_DENOMINATOR
+    if np.any(np.abs(terms@coefficients-log_biases)>FIT_TOLERANCE*np.abs(log_biases)):
+        raise ValueError("The error probabilities do not fit the error terms of HeavyHexCode")
+
+    # every graphlike piece of an error adds its coefficients to an edge
+    edge_index={}
+    rows=[]
+    cols=[]
+    for i, error_targets in enumerate(targets):
+        components=[[]]
+        for target in error_targets:
+            if target.is_separator():
+                components.append([])
+            else:
+                components[-1].append(target)
+        for component in components:
+            edge=_edge_key(component)
+            if edge is not None:
+                rows.append(edge_index.setdefault(edge, len(edge_index)))
+                cols.append(i)
+    incidence=scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(edge_index), len(targets)))
+
+    edges=np.array(list(edge_index), dtype=np.int64).reshape(-1, 3)
+    num_observables=circuit.num_observables
+    observable_bits=(edges[:, 2:3]>>np.arange(num_observables))&1
+    check_matrix, faults_matrix=check_matrices({
+        'u': edges[:, 0],
+        'v': edges[:, 1],
+        'fault_ptr': np.concatenate([[0], np.cumsum(observable_bits.sum(axis=1))]).astype(np.int64),
+        'fault_ids': np.nonzero(observable_bits)[1].astype(np.int64),
+        'num_detectors': circuit.num_detectors,
+        'num_fault_ids': num_observables,
+    })
+    return {
+        'coefficients': np.asarray(incidence@coefficients.T),
+        'num_detectors': circuit.num_detectors,
+        'num_observables': num_observables,
+        'check_matrix': check_matrix,
+        'faults_matrix': faults_matrix,
+    }
+
+
+def _edge_key(component):
+    '''
+    The (u, v, observable mask) of a graphlike piece, v=-1 for the boundary.
+    None for pieces that are not edges
+    '''
+    detectors=sorted(target.val for target in component if target.is_relative_detector_id())
+    mask=0
+    for target in component:
+        if target.is_logical_observable_id():
+            mask^=1<<target.val
+    if len(detectors)==1:
+        return detectors[0], -1, mask
+    if len(detectors)==2:
+        return detectors[0], detectors[1], mask
+    return None
@@ -0,0 +1,221 @@
+'''
+Streaming shot sampling of heavy-hex circuits with bounded memory
+
+The detector sampler of a circuit is compiled once and the shots are drawn in
+bit-packed chunks, so sampling 10^7 shots of a large circuit never holds more
+than one chunk in memory. The chunks can be decoded as they come (see
+decoders.decode_chunks), or written to disk in stim's b8 or r8 shot data
+formats and read back chunk by chunk later, through a memory map.
+
+Example:
+
+    from heavy_hex_code import HeavyHexCode
+    import sampling
+
+    circuit=HeavyHexCode(code_distance=15, num_rounds=15, basis='Z', ...).create_heavy_hex_code(backend='stim')
+    for detection_events, observables in sampling.iter_shot_chunks(circuit, 10**7, seed=1):
+        ...
+
+    sampling.write_shot_files(circuit, 10**7, 'dets.b8', 'obs.b8', seed=1)
+    for detection_events, observables in sampling.iter_shot_file_chunks(
+            'dets.b8', circuit.num_detectors, 'obs.b8', circuit.num_observables):
+        ...
+'''
+import os
+
+import numpy as np
+import stim
+
+DEFAULT_CHUNK_SIZE=2**16
+SHOT_FILE_FORMATS=('b8', 'r8')
+
+
+def packed_width(num_bits):
+    '''
+    Bytes per shot of num_bits bit-packed bits
+    '''
+    return (num_bits+7)//8
+
+
+def iter_shot_chunks(circuit, num_shots, *, chunk_size=DEFAULT_CHUNK_SIZE, seed=None):
+    '''
+    Yields the (detection_events, observables) of num_shots shots, in chunks
+
+    Both arrays are bit-packed uint8, little endian within each byte like
+    stim's bit_packed=True, with chunk_size rows except for the last chunk.
+    The shots are reproducible for a given seed and chunk_size.
+
+    Args:
+    circuit: The stim.Circuit (e.g. from HeavyHexCode.create_heavy_hex_code(backend='stim'))
+    num_shots: Total number of shots
+    chunk_size: Shots per chunk
+    seed: Seed of the stim detector sampler
+    '''
+    if chunk_size<=0:
+        raise ValueError("chunk_size must be positive")
+    if not isinstance(circuit, stim.Circuit):
+        circuit=stim.Circuit(circuit)
+    sampler=circuit.compile_detector_sampler(seed=seed)
+    remaining=num_shots
+    while remaining>0:
+        batch=min(chunk_size, remaining)
+        yield sampler.sample(batch, separate_observables=True, bit_packed=True)
+        remaining-=batch
+
+
+def write_shot_files(circuit, num_shots, detection_events_path, observables_path=None, *,
+                     format='b8', chunk_size=DEFAULT_CHUNK_SIZE, seed=None):
+    '''
+    Samples the circuit into shot data files, one chunk at a time
+
+    The files are in stim's b8 or r8 format (see stim's result_formats.md), so
+    stim.read_shot_data_file reads them too. Returns the number of shots written.
+
+    Args:
+    circuit: The stim.Circuit
+    num_shots: Total number of shots
+    detection_events_path: File the detection events are written to
+    observables_path: File the observable flips are written to, if given
+    format: 'b8' or 'r8'
+    chunk_size: Shots sampled at once
+    seed: Seed of the stim detector sampler
+    '''
+    if format not in SHOT_FILE_FORMATS:
+        raise ValueError("Invalid shot data format "+repr(format))
+    if not isinstance(circuit, stim.Circuit):
+        circuit=stim.Circuit(circuit)
+    num_detectors=circuit.num_detectors
+    num_observables=circuit.num_observables
+
+    written=0
+    with open(detection_events_path, 'wb') as dets_file, \
+         open(observables_path if observables_path is not None else os.devnull, 'wb') as obs_file:
+        for detection_events, observables in iter_shot_chunks(circuit, num_shots, chunk_size=chunk_size, seed=seed):
+            dets_file.write(_encode(detection_events, num_detectors, format))
+            if observables_path is not None:
+                obs_file.write(_encode(observables, num_observables, format))
+            written+=len(detection_events)
+    return written
+
+
+def open_b8(path, num_bits):
+    '''
+    Memory maps a b8 shot data file as a read-only (shots, packed_width(num_bits)) uint8 array
+    '''
+    width=packed_width(num_bits)
+    size=os.path.getsize(path)
+    if width==0 or size==0:
+        return np.zeros((0, width), dtype=np.uint8)
+    if size%width:
+        raise ValueError(f"{path} is not a b8 file of {num_bits} bits per shot")
+    return np.memmap(path, dtype=np.uint8, mode='r', shape=(size//width, width))
+
+
+def iter_shot_file_chunks(detection_events_path, num_detectors, observables_path=None, num_observables=0, *,
+                          format='b8', chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Yields bit-packed (detection_events, observables) chunks of shot data files
+
+    The chunks look like those of iter_shot_chunks, observables is None
+    without an observables file. The files are memory mapped, so only the
+    current chunk is held in memory.
+
+    Args:
+    detection_events_path: The detection events file, written by write_shot_files
+    num_detectors: Detectors per shot
+    observables_path: The observable flips file, if any
+    num_observables: Observables per shot
+    format: 'b8' or 'r8'
+    chunk_size: Shots per chunk
+    '''
+    if chunk_size<=0:
+        raise ValueError("chunk_size must be positive")
+    dets_chunks=_iter_file_chunks(detection_events_path, num_detectors, format, chunk_size)
+    if observables_path is None:
+        for detection_events in dets_chunks:
+            yield detection_events, None
+        return
+
+    obs_chunks=_iter_file_chunks(observables_path, num_observables, format, chunk_size)
+    for detection_events in dets_chunks:
+        observables=next(obs_chunks, None)
+        if observables is None or len(observables)!=len(detection_events):
+            raise ValueError("The detection event and observable files hold different numbers of shots")
+        yield detection_events, observables
+    if next(obs_chunks, None) is not None:
+        raise ValueError("The detection event and observable files hold different numbers of shots")
+
+
+# internals
+def _iter_file_chunks(path, num_bits, format, chunk_size):
+    if format=='b8':
+        shots=open_b8(path, num_bits)
+        for start in range(0, len(shots), chunk_size):
+            yield np.array(shots[start:start+chunk_size])
+    elif format=='r8':
+        yield from _iter_r8_chunks(path, num_bits, chunk_size)
+    else:
+        raise ValueError("Invalid shot data format "+repr(format))
+
+
+def _encode(packed, num_bits, format):
+    '''
+    The bytes of bit-packed shots in the b8 or r8 format
+    '''
+    if format=='b8':
+        return np.ascontiguousarray(packed).tobytes()
+
+    # r8 stores the length of each run of zeros before a one, 255 meaning 255
+    # zeros and no one yet. Every shot ends with an implicit one at bit
+    # num_bits, so the shots are read as one stream of num_bits+1 bit records
+    bits=np.unpackbits(packed, axis=1, count=num_bits, bitorder='little')
+    bits=np.concatenate([bits, np.ones((len(bits), 1), dtype=np.uint8)], axis=1)
+    ones=np.flatnonzero(bits.ravel())
+    gaps=np.diff(ones, prepend=-1)-1
+    lengths=gaps//255+1
+    encoded=np.full(int(lengths.sum()), 255, dtype=np.uint8)
+    encoded[np.cumsum(lengths)-1]=gaps%255
+    return encoded.tobytes()
+
+
+def _iter_r8_chunks(path, num_bits, chunk_size):
+    stride=num_bits+1 # bits per shot, the terminating one included
+    if os.path.getsize(path)==0:
+        return
+    data=np.memmap(path, dtype=np.uint8, mode='r')
+    # a shot takes at least ceil(stride/255) bytes, so a block holds at most chunk_size shots
+    block_bytes=chunk_size*((stride+254)//255)
+
+    cursor=0 # bits read so far
+    first_shot=0 # first shot not decoded yet
+    pending=np.zeros(0, dtype=np.int64) # positions of the ones of the shots not finished yet
+    leftover=np.zeros((0, packed_width(num_bits)), dtype=np.uint8)
+    for start in range(0, len(data), block_bytes):
+        block=np.asarray(data[start:start+block_bytes], dtype=np.int64)
+        ends=cursor+np.cumsum(block+(block!=255))
+        cursor=int(ends[-1])
+        ones=np.concatenate([pending, ends[block!=255]-1])
+
+        terminators=ones[ones%stride==num_bits]
+        if len(terminators)==0:
+            pending=ones
+            continue
+        end_shot=int(terminators[-1])//stride+1
+        split=np.searchsorted(ones, end_shot*stride)
+        done, pending=ones[:split], ones[split:]
+
+        bits=np.zeros((end_shot-first_shot)*stride, dtype=np.uint8)
+        bits[done-first_shot*stride]=1
+        shots=np.packbits(bits.reshape(-1, stride)[:, :num_bits], axis=1, bitorder='little')
+        first_shot=end_shot
+
+        shots=np.concatenate([leftover, shots]) if len(leftover) else shots
+        full=len(shots)-len(shots)%chunk_size
+        for chunk_start in range(0, full, chunk_size):
+            yield shots[chunk_start:chunk_start+chunk_size]
+        leftover=shots[full:]
+
+    if len(pending) or cursor!=first_shot*stride:
+        raise ValueError(f"{path} ends in the middle of a shot")
+    if len(leftover):
+        yield leftover
@@ -0,0 +1,151 @@
+'''
+Reproducible shot streams of sweep points, derived from one master seed
+
+Every task (by default, every circuit) has its own stream of shots, cut
+into chunks of chunk_size shots. Chunk k of a stream is sampled by a stim
+sampler of its own, seeded from
+
+    numpy.random.SeedSequence(master_seed, spawn_key=(<128 bits of the task key>, k))
+
+The seed of a chunk depends on the master seed, the task and k alone, so
+
+- the chunks can be sampled in any order and by any number of processes,
+  and the shots are the same
+- shot i of a run of 10^7 shots is regenerated by sampling chunk
+  i//chunk_size on its own, see ShotStream.shots
+- different tasks, and different master seeds, get independent streams
+
+The task key defaults to the sha256 of the canonical text of the circuit
+(dem_cache.circuit_hash), so a circuit has the same stream in every sweep it
+is part of. stim only promises the same samples for the same seed with the
+same stim version on the same kind of machine, so replays should be run
+where the run was.
+
+Example:
+
+    from seeding import ShotStream, find_mistaken_shots
+    from decoders import compile_matching, decode_chunks
+
+    stream=ShotStream(circuit, master_seed=2024)
+    matching=compile_matching(circuit)
+    stats=decode_chunks(stream.iter_chunks(10**7), matching, circuit.num_observables)
+    # later: the shots that were decoded wrong in chunks 120 to 129, and their detection events
+    mistakes=find_mistaken_shots(stream, matching, 10*stream.chunk_size, first_chunk=120)
+    detection_events, observables=stream.shots(mistakes)
+'''
+import hashlib
+
+import numpy as np
+import stim
+
+from dem_cache import circuit_hash
+from sampling import DEFAULT_CHUNK_SIZE
+
+
+def task_words(task_key):
+    '''
+    The four 32-bit words of the sha256 of a task key (a string)
+    '''
+    digest=hashlib.sha256(str(task_key).encode()).digest()
+    return tuple(int.from_bytes(digest[4*k:4*k+4], 'little') for k in range(4))
+
+
+def chunk_seed(master_seed, task_key, chunk_index):
+    '''
+    The stim sampler seed of a chunk of a task, a 63-bit int
+    '''
+    sequence=np.random.SeedSequence(master_seed, spawn_key=task_words(task_key)+(int(chunk_index),))
+    return int(sequence.generate_state(1, dtype=np.uint64)[0]>>np.uint64(1))
+
+
+class ShotStream:
+    '''
+    The reproducible, chunked stream of shots of a circuit
+    '''
+
+    def __init__(self, circuit, master_seed, *, task_key=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        '''
+        Args:
+        circuit: The stim.Circuit
+        master_seed: The master seed, a non-negative int
+        task_key: A string naming the task (default: the circuit hash)
+        chunk_size: Shots per chunk. Part of the stream: the same seeds with
+        another chunk size give other shots
+        '''
+        if chunk_size<=0:
+            raise ValueError("chunk_size must be positive")
+        if not isinstance(circuit, stim.Circuit):
+            circuit=stim.Circuit(circuit)
+        self.circuit=circuit
+        self.master_seed=int(master_seed)
+        self.task_key=circuit_hash(circuit) if task_key is None else str(task_key)
+        self.chunk_size=chunk_size
+
+    def chunk_seed(self, chunk_index):
+        return chunk_seed(self.master_seed, self.task_key, chunk_index)
+
+    def chunk(self, chunk_index):
+        '''
+        Returns the bit-packed (detection_events, observables) of the chunk
+        '''
+        sampler=self.circuit.compile_detector_sampler(seed=self.chunk_seed(chunk_index))
+        return sampler.sample(self.chunk_size, separate_observables=True, bit_packed=True)
+
+    def iter_chunks(self, num_shots, *, first_chunk=0):
+        '''
+        Yields the shots from the start of chunk first_chunk on, in chunks,
+        like sampling.iter_shot_chunks. The last chunk is cut short to give
+        num_shots shots in all
+        '''
+        chunk_index=first_chunk
+        remaining=num_shots
+        while remaining>0:
+            detection_events, observables=self.chunk(chunk_index)
+            if remaining<self.chunk_size:
+                detection_events, observables=detection_events[:remaining], observables[:remaining]
+            yield detection_events, observables
+            remaining-=self.chunk_size
+            chunk_index+=1
+
+    def shots(self, shot_indices):
+        '''
+        Regenerates shots of the stream by their index, sampling every chunk
+        they are in once. Returns their bit-packed (detection_events,
+        observables), in the order of shot_indices
+        '''
+        shot_indices=np.asarray(shot_indices, dtype=np.int64)
+        detection_events=np.zeros((len(shot_indices), (self.circuit.num_detectors+7)//8), dtype=np.uint8)
+        observables=np.zeros((len(shot_indices), (self.circuit.num_observables+7)//8), dtype=np.uint8)
+        chunk_indices=shot_indices//self.chunk_size
+        for chunk_index in sorted(set(chunk_indices.tolist())):
+            rows=np.flatnonzero(chunk_indices==chunk_index)
+            chunk_detection_events, chunk_observables=self.chunk(chunk_index)
+            offsets=shot_indices[rows]-chunk_index*self.chunk_size
+            detection_events[rows]=chunk_detection_events[offsets]
+            observables[rows]=chunk_observables[offsets]
+        return detection_events, observables
+
+
+def find_mistaken_shots(stream, matching, num_shots, *, first_chunk=0, decode_kwargs=None):
+    '''
+    Returns the indices in the stream of the shots whose observables are
+    predicted wrong, among num_shots shots from the start of chunk first_chunk
+
+    Args:
+    stream: The ShotStream
+    matching: The decoder, a pymatching.Matching or any decoder with its decode_batch
+    num_shots: Number of shots to decode
+    first_chunk: The chunk to start at
+    decode_kwargs: Extra keyword arguments for decode_batch
+    '''
+    decode_kwargs=decode_kwargs or {}
+    mistakes=[]
+    start=first_chunk*stream.chunk_size
+    for detection_events, observables in stream.iter_chunks(num_shots, first_chunk=first_chunk):
+        predictions=matching.decode_batch(detection_events, bit_packed_shots=True,
+                                          bit_packed_predictions=True, **decode_kwargs)
+        if predictions.shape[1]<observables.shape[1]: # the matching graph may not know about every observable
+            predictions=np.pad(predictions, ((0, 0), (0, observables.shape[1]-predictions.shape[1])))
+        mistakes.append(start+np.flatnonzero(np.any(predictions!=observables, axis=1)))
+        start+=len(detection_events)
+    return np.concatenate(mistakes) if mistakes else np.zeros(0, dtype=np.int64)
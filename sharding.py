@@ -0,0 +1,391 @@
+'''
+Sharded sampling and decoding of sweeps, across processes and hosts
+
+The shots of every sweep point are split into shards of shots_per_shard
+shots, shard k of a point being shots k*shots_per_shard, ... of the
+seeding.ShotStream of the point under the seed of the sweep. Workers
+(processes on any host that sees the sweep directory, e.g. over NFS) claim
+shards, sample and decode them with decoders.decode_chunks and write their
+counts back. The directory is
+the whole coordinator:
+
+plan.json                 the points, their error parameters and the stopping rule
+claims/<point>-<shard>    one file per claimed shard, created exclusively
+results/<point>-<shard>.json  the counts of a finished shard, written atomically
+
+The counts of a point are merged over its shards 0, 1, 2, ... up to the first
+shard at which max_shots or max_errors is reached. Shards past that one are
+ignored, so the merged counts depend on the seed alone, not on the number
+of workers or the order in which shards finished. Every free worker takes
+the next shard of the unfinished point furthest from max_errors, counting
+the errors that the shards still in flight are expected to find, so the
+work moves to the (d, p) points that still need errors. The claim of a
+worker that died is taken over once it is lease_seconds old. Any shot of
+the sweep can be sampled again on its own, e.g. the shots that a decoder got
+wrong, from ShardCoordinator.shot_stream.
+
+Example (workers are processes, so run it under a __main__ guard):
+
+    import numpy as np
+    from sharding import sharded_sweep
+
+    if __name__=='__main__':
+        stats=sharded_sweep('/shared/heavy_hex_sweep', [3, 5, 7], np.geomspace(1e-4, 1e-2, 7), ['X', 'Z'])
+
+and on every other host, while it runs:
+
+    python -c "import sharding; sharding.run_worker('/shared/heavy_hex_sweep')"
+'''
+import concurrent.futures
+import json
+import os
+import socket
+import tempfile
+import time
+
+import numpy as np
+
+from decoders import DecodingStats, decode_chunks
+from heavy_hex_code import HeavyHexCode
+from sampling import DEFAULT_CHUNK_SIZE
+from seeding import ShotStream
+from sweep import sweep_points, uniform_noise
+
+DEFAULT_SHOTS_PER_SHARD=2**16
+DEFAULT_LEASE_SECONDS=3600.0
+DEFAULT_POLL_SECONDS=1.0
+PLAN_FILE='plan.json'
+
+
+class ShardCoordinator:
+    '''
+    The plan, claims and results of a sharded sweep in a directory
+    '''
+
+    def __init__(self, directory):
+        '''
+        Opens the sweep of a directory made by create
+        '''
+        self.directory=directory
+        with open(os.path.join(directory, PLAN_FILE)) as f:
+            self.plan=json.load(f)
+        self.points=[tuple(point) for point in self.plan['points']]
+        self._claims=os.path.join(directory, 'claims')
+        self._results=os.path.join(directory, 'results')
+
+    @classmethod
+    def create(cls, directory, points, *, noise=uniform_noise, shots_per_shard=DEFAULT_SHOTS_PER_SHARD,
+               max_shots=10**7, max_errors=1000, seed=0, decoder='pymatching', chunk_size=None):
+        '''
+        Writes the plan of a sweep, or opens the sweep already in the directory
+        if it has the same plan (to resume it)
+
+        Args:
+        directory: The sweep directory, created if needed
+        points: The (d, rounds, basis, p) points, see sweep.sweep_points
+        noise: Maps p to the error parameters of HeavyHexCode
+        shots_per_shard: Shots sampled and decoded per shard
+        max_shots: Shots per point
+        max_errors: Errors per point
+        seed: The master seed of the shot streams of the points
+        decoder: The decoder, one of batch_decoders.DECODERS
+        chunk_size: Shots per chunk of the shot streams, a divisor of
+        shots_per_shard (default: the smaller of shots_per_shard and
+        sampling.DEFAULT_CHUNK_SIZE)
+        '''
+        if chunk_size is None:
+            chunk_size=min(shots_per_shard, DEFAULT_CHUNK_SIZE)
+        if shots_per_shard%chunk_size:
+            raise ValueError(f"chunk_size {chunk_size} does not divide shots_per_shard {shots_per_shard}")
+        plan={
+            'points': [list(point) for point in points],
+            'noise': [noise(point[3]) for point in points],
+            'shots_per_shard': int(shots_per_shard),
+            'max_shots': int(max_shots),
+            'max_errors': int(max_errors),
+            'seed': int(seed),
+            'decoder': decoder,
+            'chunk_size': int(chunk_size),
+        }
+        os.makedirs(os.path.join(directory, 'claims'), exist_ok=True)
+        os.makedirs(os.path.join(directory, 'results'), exist_ok=True)
+        path=os.path.join(directory, PLAN_FILE)
+        if os.path.exists(path):
+            with open(path) as f:
+                if json.load(f)!=plan:
+                    raise ValueError(f"{directory} holds the plan of another sweep")
+        else:
+            _write_json(path, plan)
+        return cls(directory)
+
+    def circuit(self, point_index):
+        '''
+        Returns the stim.Circuit of a point
+        '''
+        d, num_rounds, basis, _=self.points[point_index]
+        return HeavyHexCode(
+            code_distance=d,
+            num_rounds=num_rounds,
+            basis=basis,
+            **self.plan['noise'][point_index],
+        ).create_heavy_hex_code(backend='stim')
+
+    def shot_stream(self, point_index, circuit=None):
+        '''
+        Returns the seeding.ShotStream of a point: shard k of the point is
+        its shots k*shots_per_shard, ..., (k+1)*shots_per_shard-1
+        '''
+        if circuit is None:
+            circuit=self.circuit(point_index)
+        return ShotStream(circuit, self.plan['seed'], chunk_size=self.plan['chunk_size'])
+
+    def point_stats(self, point_index):
+        '''
+        Returns the merged DecodingStats of a point and whether it is finished
+        '''
+        stats, finished, _, _=self._progress(point_index, self._listing())
+        return stats, finished
+
+    def merged_stats(self):
+        '''
+        Returns the merged DecodingStats of every point, by (d, rounds, basis, p)
+        '''
+        listing=self._listing()
+        return {point: self._progress(k, listing)[0] for k, point in enumerate(self.points)}
+
+    def finished(self):
+        '''
+        Whether every point has reached max_shots or max_errors
+        '''
+        listing=self._listing()
+        return all(self._progress(k, listing)[1] for k in range(len(self.points)))
+
+    def claim(self, lease_seconds=DEFAULT_LEASE_SECONDS):
+        '''
+        Claims the next shard to run
+
+        Returns (point_index, shard_index), or None when every point is
+        finished or has enough shards in flight
+        '''
+        listing=self._listing()
+        candidates=[]
+        for k in range(len(self.points)):
+            _, finished, projected_errors, shard=self._progress(k, listing, lease_seconds)
+            if not finished and shard is not None:
+                candidates.append((projected_errors, k, shard))
+        for _, k, shard in sorted(candidates):
+            if self._take(k, shard, lease_seconds):
+                return k, shard
+        return None
+
+    def complete(self, point_index, shard_index, stats):
+        '''
+        Records the DecodingStats of a finished shard
+        '''
+        _write_json(os.path.join(self._results, _shard_name(point_index, shard_index)+'.json'), {
+            'shots': int(stats.shots),
+            'errors': int(stats.errors),
+            'observable_errors': [int(count) for count in stats.observable_errors],
+            'sample_seconds': stats.sample_seconds,
+            'decode_seconds': stats.decode_seconds,
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+        })
+
+    # internals
+    def _listing(self):
+        '''
+        The claimed shards with their claim times, and the finished shards
+        '''
+        claims={}
+        for name in os.listdir(self._claims):
+            try:
+                claims[_parse_shard_name(name)]=os.stat(os.path.join(self._claims, name)).st_mtime
+            except (FileNotFoundError, ValueError):
+                continue
+        results=set()
+        for name in os.listdir(self._results):
+            if name.endswith('.json'):
+                results.add(_parse_shard_name(name[:-len('.json')]))
+        return claims, results
+
+    def _progress(self, point_index, listing, lease_seconds=DEFAULT_LEASE_SECONDS):
+        '''
+        Returns the merged stats of a point, whether it is finished, the
+        fraction of max_errors expected once its shards in flight are done,
+        and the next shard to claim (None if the shards in flight are
+        expected to finish the point)
+        '''
+        claims, results=listing
+        max_shots=self.plan['max_shots']
+        max_errors=self.plan['max_errors']
+        num_observables=2 if self.points[point_index][2]=='XZ' else 1
+        stats=DecodingStats(shots=0, errors=0, observable_errors=np.zeros(num_observables, dtype=np.int64),
+                            sample_seconds=0.0, decode_seconds=0.0)
+        shard=0
+        while (point_index, shard) in results and stats.shots<max_shots and stats.errors<max_errors:
+            stats+=self._read(point_index, shard)
+            shard+=1
+        if stats.shots>=max_shots or stats.errors>=max_errors:
+            return stats, True, 1.0, None
+
+        # the shards after the merged ones are in flight, finished out of order, or free
+        rate=(stats.errors+1)/(stats.shots+1)
+        shots=stats.shots
+        errors=stats.errors
+        now=time.time()
+        while True:
+            claimed=claims.get((point_index, shard))
+            if (point_index, shard) not in results and (claimed is None or now-claimed>lease_seconds):
+                break
+            shots+=self.plan['shots_per_shard']
+            errors+=rate*self.plan['shots_per_shard']
+            shard+=1
+        if shots>=max_shots or errors>=max_errors:
+            return stats, False, errors/max_errors, None
+        return stats, False, errors/max_errors, shard
+
+    def _read(self, point_index, shard_index):
+        with open(os.path.join(self._results, _shard_name(point_index, shard_index)+'.json')) as f:
+            counts=json.load(f)
+        return DecodingStats(
+            shots=counts['shots'],
+            errors=counts['errors'],
+            observable_errors=np.array(counts['observable_errors'], dtype=np.int64),
+            sample_seconds=counts['sample_seconds'],
+            decode_seconds=counts['decode_seconds'],
+        )
+
+    def _take(self, point_index, shard_index, lease_seconds):
+        '''
+        Creates the claim file of a shard, or takes over a claim older than lease_seconds
+        '''
+        path=os.path.join(self._claims, _shard_name(point_index, shard_index))
+        owner=f"{socket.gethostname()} {os.getpid()}\n".encode()
+        try:
+            fd=os.open(path, os.O_CREAT|os.O_EXCL|os.O_WRONLY)
+        except FileExistsError:
+            try:
+                if time.time()-os.stat(path).st_mtime<=lease_seconds:
+                    return False
+            except FileNotFoundError:
+                return False
+            # the shard is deterministic, so two workers taking over the same stale claim only repeat work
+            _write_bytes(path, owner)
+            return True
+        with os.fdopen(fd, 'wb') as f:
+            f.write(owner)
+        return True
+
+
+def run_worker(directory, *, dem_cache=None, max_shards=None, lease_seconds=DEFAULT_LEASE_SECONDS,
+               poll_seconds=DEFAULT_POLL_SECONDS):
+    '''
+    Runs shards of the sweep in the directory until every point is finished
+
+    Returns the number of shards run
+
+    Args:
+    directory: The sweep directory, see ShardCoordinator.create
+    dem_cache: A dem_cache.DemCache to take the decoders from
+    max_shards: Stop after this many shards
+    lease_seconds: Age after which the claim of another worker is taken over
+    poll_seconds: Wait between looks at the directory when all the work is in flight
+    '''
+    coordinator=ShardCoordinator(directory)
+    plan=coordinator.plan
+    streams={}
+    decoders={}
+    shards=0
+    while max_shards is None or shards<max_shards:
+        claimed=coordinator.claim(lease_seconds)
+        if claimed is None:
+            if coordinator.finished():
+                break
+            time.sleep(poll_seconds)
+            continue
+        point_index, shard_index=claimed
+        if point_index not in streams:
+            streams[point_index]=coordinator.shot_stream(point_index)
+        stream=streams[point_index]
+        circuit=stream.circuit
+        if point_index not in decoders:
+            # batch_decoders imports decoders, which this module imports
+            from batch_decoders import compile_decoder
+            decoders[point_index]=compile_decoder(circuit, plan['decoder'], dem_cache=dem_cache)
+
+        shots_per_shard=plan['shots_per_shard']
+        chunks=stream.iter_chunks(shots_per_shard, first_chunk=shard_index*shots_per_shard//stream.chunk_size)
+        stats=decode_chunks(chunks, decoders[point_index], circuit.num_observables)
+        coordinator.complete(point_index, shard_index, stats)
+        shards+=1
+    return shards
+
+
+def sharded_sweep(directory, distances, ps, bases=('X', 'Z'), *,
+                  rounds=None,
+                  noise=uniform_noise,
+                  num_workers=None,
+                  shots_per_shard=DEFAULT_SHOTS_PER_SHARD,
+                  max_shots=10**7,
+                  max_errors=1000,
+                  seed=0,
+                  decoder='pymatching',
+                  dem_cache=None):
+    '''
+    Runs a sharded sweep with workers on this host, and returns the merged
+    DecodingStats by (d, rounds, basis, p)
+
+    Workers on other hosts can join at any time with run_worker. Running the
+    same sweep again resumes it from the directory.
+
+    Args:
+    directory: The sweep directory, shared with the other hosts
+    distances, ps, bases, rounds: The points, see sweep.sweep_points
+    noise: Maps p to the error parameters of HeavyHexCode
+    num_workers: Worker processes on this host (default: one per CPU)
+    shots_per_shard, max_shots, max_errors, seed, decoder: See ShardCoordinator.create
+    dem_cache: A dem_cache.DemCache to take the decoders from
+    '''
+    points=sweep_points(distances, ps, bases, rounds)
+    coordinator=ShardCoordinator.create(directory, points, noise=noise, shots_per_shard=shots_per_shard,
+                                        max_shots=max_shots, max_errors=max_errors, seed=seed, decoder=decoder)
+    if num_workers is None:
+        num_workers=os.cpu_count() or 1
+    if num_workers<=1:
+        run_worker(directory, dem_cache=dem_cache)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as pool:
+            for future in [pool.submit(run_worker, directory, dem_cache=dem_cache) for _ in range(num_workers)]:
+                future.result()
+    return coordinator.merged_stats()
+
+
+def _shard_name(point_index, shard_index):
+    return f'{point_index:05d}-{shard_index:07d}'
+
+
+def _parse_shard_name(name):
+    point, shard=name.split('-')
+    return int(point), int(shard)
+
+
+def _write_bytes(path, data):
+    '''
+    Writes a file atomically (temporary file + os.replace)
+    '''
+    fd, tmp_path=tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def _write_json(path, data):
+    _write_bytes(path, json.dumps(data, indent=1).encode())
@@ -0,0 +1,441 @@
+'''
+Sliding-window decoding of many-round memory experiments
+
+Instead of matching the detectors of all the rounds at once, the rounds are
+decoded in overlapping windows of commit_rounds+buffer_rounds rounds, one
+after the other (Dennis et al. - arxiv quant-ph/0110143, Sec. IV D):
+
+- the matching graph of a window has the detectors of its rounds; edges to
+  the rounds after the window end on the boundary, edges to the rounds
+  before it (already committed) are left out
+- the matching is computed over the whole window, but only the edges that
+  touch its first commit_rounds rounds are committed: their observables are
+  added to the prediction, and the detectors they end on in later rounds are
+  flipped, so the next window sees the committed correction
+- the next window starts right after the committed rounds, and the last one
+  commits everything that is left
+
+A window only needs the detection events of its own rounds, so the decoding
+latency and the size of the matching graphs stay bounded however many rounds
+the experiment has. The windows of the REPEAT block all have the same graph,
+which is built once. from_circuit and from_heavy_hex_code build the graphs
+from the detector error model of a shorter run of the circuit (its REPEAT
+block cut down to a few windows' worth of rounds) and lay them over the
+rounds of the full experiment, so building the decoder takes the same time
+and memory for 100 or 10^5 rounds. The constructor cuts up the matching
+graph of the whole experiment instead. The time every window takes is
+recorded, see window_stats and latency_summary.
+
+Example:
+
+    from heavy_hex_code import HeavyHexCode
+    from sliding_window import SlidingWindowDecoder
+    from decoders import sample_and_decode
+
+    code=HeavyHexCode(code_distance=5, num_rounds=1000, basis='Z', ...)
+    decoder=SlidingWindowDecoder.from_heavy_hex_code(code)
+    stats=sample_and_decode(code.create_heavy_hex_code(backend='stim'), shots=10**4, matching=decoder)
+    print(decoder.latency_summary())
+'''
+import collections
+import time
+
+import numpy as np
+import pymatching
+import stim
+
+from dem_cache import check_matrices, matching_to_arrays
+from decoders import compile_matching
+from detector_index import DetectorIndex
+from sampling import packed_width
+
+# the periods (in windows) of the window graphs of a REPEAT block that from_circuit recognizes
+_WINDOW_PERIODS=(1, 2)
+
+WindowStats=collections.namedtuple('WindowStats', [
+    'window', # position of the window
+    'first_round', # first round of the window
+    'num_rounds', # rounds in the window
+    'committed_rounds', # rounds committed by the window
+    'detectors', # detectors in the window
+    'edges', # edges of the matching graph of the window
+    'shots', # shots decoded
+    'seconds', # time spent decoding the window, over all the shots
+])
+
+
+class SlidingWindowDecoder:
+    '''
+    Matching in overlapping windows of rounds
+
+    decode_batch has the signature of pymatching.Matching.decode_batch, so
+    the decoder can be passed as the matching of decoders.sample_and_decode
+    and decoders.decode_chunks
+    '''
+    # the timings, left out of syndrome_store.decoder_fingerprint
+    _fingerprint_skip=('_seconds', '_shots')
+
+    def __init__(self, matching, detector_rounds, *, commit_rounds, buffer_rounds):
+        '''
+        Args:
+        matching: The pymatching.Matching of the whole experiment
+        detector_rounds: The round of every detector, non-decreasing in detector order
+        commit_rounds: Rounds committed by every window
+        buffer_rounds: Rounds after the committed ones that a window looks
+        ahead, and decodes again in the next window
+        '''
+        self.detector_rounds=np.asarray(detector_rounds, dtype=np.int64)
+        self.num_detectors=len(self.detector_rounds)
+        self.num_observables=matching.num_fault_ids
+        if matching.num_detectors>self.num_detectors:
+            raise ValueError("detector_rounds has fewer detectors than the matching graph")
+        if np.any(np.diff(self.detector_rounds)<0):
+            raise ValueError("detector_rounds must be non-decreasing")
+        if commit_rounds<1 or buffer_rounds<0:
+            raise ValueError("A window must commit at least one round and cannot have a negative buffer")
+        self.commit_rounds=commit_rounds
+        self.buffer_rounds=buffer_rounds
+
+        self._windows=[]
+        self._matchings={}
+        self._build_windows(matching_to_arrays(matching))
+        self._seconds=np.zeros(len(self._windows), dtype=np.float64)
+        self._shots=0
+
+    @classmethod
+    def from_circuit(cls, circuit, detector_rounds=None, *, dem_cache=None, **kwargs):
+        '''
+        Builds the decoder of a stim.Circuit
+
+        Args:
+        circuit: The stim.Circuit
+        detector_rounds: The round of every detector (default: the third
+        DETECTOR coordinate, shifts applied)
+        dem_cache: A dem_cache.DemCache to take the matching graph from
+        kwargs: Passed on to the constructor
+
+        A circuit with a long REPEAT block is decoded with the window graphs
+        of a shorter run of it, with as many rounds modulo commit_rounds;
+        only if its windows do not line up with those of the full circuit is
+        the matching graph of the whole circuit built
+        '''
+        if not isinstance(circuit, stim.Circuit):
+            circuit=stim.Circuit(circuit)
+        if detector_rounds is None:
+            detector_rounds=DetectorIndex.from_circuit(circuit).rounds
+        template=_shortened_circuit(circuit, kwargs['commit_rounds'], kwargs['buffer_rounds'])
+        if template is not None:
+            decoder=cls(compile_matching(template, dem_cache), DetectorIndex.from_circuit(template).rounds, **kwargs)
+            if decoder._stretch(detector_rounds):
+                return decoder
+        return cls(compile_matching(circuit, dem_cache), detector_rounds, **kwargs)
+
+    @classmethod
+    def from_heavy_hex_code(cls, code, *, dem_cache=None, commit_rounds=None, buffer_rounds=None):
+        '''
+        Builds the decoder of the circuit of a HeavyHexCode, whose detector
+        rounds are known from HeavyHexCode.detector_rounds
+
+        commit_rounds and buffer_rounds default to the code distance
+        '''
+        circuit=code.create_heavy_hex_code(backend='stim')
+        return cls.from_circuit(
+            circuit,
+            code.detector_rounds(),
+            dem_cache=dem_cache,
+            commit_rounds=code.cd if commit_rounds is None else commit_rounds,
+            buffer_rounds=code.cd if buffer_rounds is None else buffer_rounds,
+        )
+
+    @property
+    def num_windows(self):
+        return len(self._windows)
+
+    @property
+    def num_matchings_built(self):
+        '''
+        Number of distinct window graphs -- windows with the same graph share a matching
+        '''
+        return len(self._matchings)
+
+    def decode_batch(self, shots, *, bit_packed_shots=False, bit_packed_predictions=False):
+        '''
+        Decodes a batch of shots window by window, like pymatching.Matching.decode_batch
+
+        Args:
+        shots: The detection events, (shots, num_detectors) booleans or, with
+        bit_packed_shots, (shots, ceil(num_detectors/8)) bit-packed uint8
+        bit_packed_shots: Whether the shots are bit-packed (little endian)
+        bit_packed_predictions: Return the predicted observables bit-packed
+        '''
+        shots=np.asarray(shots)
+        if bit_packed_shots:
+            shots=shots.astype(np.uint8, copy=False)
+        else:
+            shots=np.packbits(shots.astype(bool), axis=1, bitorder='little')
+
+        observables=np.zeros((len(shots), self.num_observables), dtype=bool)
+        # flips of the committed corrections, over detectors carry_start onwards
+        carry_start=0
+        carry=np.zeros((len(shots), 0), dtype=bool)
+        for k, window in enumerate(self._windows):
+            start, stop=window['detectors']
+            t0=time.perf_counter()
+            syndrome=_unpack_range(shots, start, stop)
+            overlap=min(carry.shape[1], stop-carry_start)
+            syndrome[:, carry_start-start:carry_start-start+overlap]^=carry[:, :overlap]
+
+            prediction=self._matchings[window['key']].decode_batch(
+                np.packbits(syndrome, axis=1, bitorder='little'), bit_packed_shots=True, bit_packed_predictions=True)
+            prediction=np.unpackbits(prediction, axis=1, count=self.num_observables+len(window['flips']),
+                                     bitorder='little').astype(bool)
+            observables^=prediction[:, :self.num_observables]
+
+            # the flips still to be applied start at the first detector of the next window
+            next_start=window['committed']
+            flips=window['flips']
+            next_stop=max(carry_start+carry.shape[1], int(flips[-1])+1 if len(flips) else next_start)
+            next_carry=np.zeros((len(shots), max(0, next_stop-next_start)), dtype=bool)
+            kept=carry[:, max(0, next_start-carry_start):]
+            next_carry[:, max(0, carry_start-next_start):max(0, carry_start-next_start)+kept.shape[1]]=kept
+            next_carry[:, flips-next_start]^=prediction[:, self.num_observables:]
+            carry_start, carry=next_start, next_carry
+            self._seconds[k]+=time.perf_counter()-t0
+        self._shots+=len(shots)
+
+        if bit_packed_predictions:
+            return np.packbits(observables, axis=1, bitorder='little')
+        return observables.astype(np.uint8)
+
+    def window_stats(self):
+        '''
+        Returns a WindowStats for every window, with the time spent decoding
+        it over all the shots decoded so far
+        '''
+        return [
+            WindowStats(
+                window=k,
+                first_round=window['first_round'],
+                num_rounds=window['num_rounds'],
+                committed_rounds=window['committed_rounds'],
+                detectors=window['detectors'][1]-window['detectors'][0],
+                edges=window['edges'],
+                shots=self._shots,
+                seconds=float(self._seconds[k]),
+            )
+            for k, window in enumerate(self._windows)
+        ]
+
+    def latency_summary(self):
+        '''
+        Returns a dict with the mean and the worst decoding time of a window,
+        per shot and in microseconds, and the time per committed round
+        '''
+        if self._shots==0:
+            return {'shots': 0, 'windows': self.num_windows, 'mean_window_us': 0.0,
+                    'max_window_us': 0.0, 'us_per_round': 0.0}
+        per_shot=1e6*self._seconds/self._shots
+        committed=sum(window['committed_rounds'] for window in self._windows)
+        return {
+            'shots': self._shots,
+            'windows': self.num_windows,
+            'mean_window_us': float(per_shot.mean()),
+            'max_window_us': float(per_shot.max()),
+            'us_per_round': float(per_shot.sum()/committed),
+        }
+
+    def reset_stats(self):
+        self._seconds[:]=0.0
+        self._shots=0
+
+    # internals
+    def _schedule(self, rounds):
+        '''
+        Yields the (first_round, end_round, commit_end, start, stop, committed)
+        of every window over detectors of the given rounds: its rounds, the
+        end of its committed rounds and the detector indices they start at
+        '''
+        last_round=int(rounds[-1]) if len(rounds) else 0
+        first_round=int(rounds[0]) if len(rounds) else 0
+        while True:
+            end_round=first_round+self.commit_rounds+self.buffer_rounds
+            last=end_round>last_round
+            commit_end=last_round+1 if last else first_round+self.commit_rounds
+            end_round=min(end_round, last_round+1)
+            start, stop, committed=np.searchsorted(rounds, [first_round, end_round, commit_end])
+            yield first_round, end_round, commit_end, int(start), int(stop), int(committed)
+            if last:
+                break
+            first_round=commit_end
+
+    def _build_windows(self, arrays):
+        '''
+        Cuts the matching graph into the graphs of the windows
+        '''
+        rounds=self.detector_rounds
+        u=arrays['u']
+        v=arrays['v']
+        probabilities=arrays['error_probabilities']
+        fault_ptr=arrays['fault_ptr']
+        fault_ids=arrays['fault_ids']
+        v_rounds=np.where(v>=0, rounds[np.maximum(v, 0)], -1)
+
+        for first_round, end_round, commit_end, start, stop, committed in self._schedule(rounds):
+            u_in=(rounds[u]>=first_round)&(rounds[u]<end_round)
+            v_in=(v_rounds>=first_round)&(v_rounds<end_round)
+            past=(rounds[u]<first_round)|((v>=0)&(v_rounds<first_round))
+            selected=np.flatnonzero((u_in|v_in)&~past)
+
+            # (a, b) in window-local labels, b=-1 for the boundary
+            pieces={}
+            flip_targets=set()
+            for e in selected:
+                ends=[int(x) for x in (u[e], v[e]) if x>=0]
+                inside=[x for x in ends if start<=x<stop]
+                a=inside[0]-start
+                b=inside[1]-start if len(inside)==2 else -1
+                key=(min(a, b), max(a, b)) if b>=0 else (a, -1)
+                is_committed=any(x<committed for x in inside)
+                if is_committed:
+                    flips=tuple(x for x in ends if x>=committed)
+                    faults=tuple(fault_ids[fault_ptr[e]:fault_ptr[e+1]])
+                    flip_targets.update(flips)
+                else:
+                    flips=()
+                    faults=()
+                log_bias=np.log1p(-2*probabilities[e])
+                best=pieces.get(key)
+                if best is None:
+                    pieces[key]=[log_bias, probabilities[e], faults, flips]
+                else:
+                    # parallel edges merge like independent errors, the likeliest keeps its corrections
+                    best[0]+=log_bias
+                    if probabilities[e]>best[1]:
+                        best[1:]=[probabilities[e], faults, flips]
+
+            flips=np.array(sorted(flip_targets), dtype=np.int64)
+            flip_index={int(x): self.num_observables+i for i, x in enumerate(flips)}
+            keys=list(pieces)
+            edge_faults=[list(pieces[key][2])+[flip_index[x] for x in pieces[key][3]] for key in keys]
+            edge_probabilities=-np.expm1(np.array([pieces[key][0] for key in keys], dtype=np.float64))/2
+            window_arrays={
+                'u': np.array([a for a, _ in keys], dtype=np.int64),
+                'v': np.array([b for _, b in keys], dtype=np.int64),
+                'fault_ptr': np.cumsum([0]+[len(f) for f in edge_faults]).astype(np.int64),
+                'fault_ids': np.array([x for f in edge_faults for x in f], dtype=np.int64),
+                'num_detectors': stop-start,
+                'num_fault_ids': self.num_observables+len(flips),
+            }
+            # windows of the REPEAT block have the same graph, up to the detector offset
+            graph_key=b''.join(np.ascontiguousarray(window_arrays[name]).tobytes()
+                               for name in ('u', 'v', 'fault_ptr', 'fault_ids'))
+            graph_key+=edge_probabilities.tobytes()+(flips-start).tobytes()+np.int64(stop-start).tobytes()
+            if graph_key not in self._matchings:
+                self._matchings[graph_key]=_window_matching(window_arrays, edge_probabilities)
+
+            self._windows.append({
+                'first_round': first_round,
+                'num_rounds': end_round-first_round,
+                'committed_rounds': commit_end-first_round,
+                'detectors': (int(start), int(stop)),
+                'committed': int(committed),
+                'flips': flips,
+                'edges': len(keys),
+                'key': graph_key,
+            })
+
+    def _stretch(self, detector_rounds):
+        '''
+        Lays the windows, built on a shorter run of the circuit, over the
+        detectors of the full experiment: the first and the last windows are
+        kept as they are, the middle ones repeat the graphs of the windows of
+        the REPEAT block, which come back every period windows (the heavy-hex
+        rounds alternate, so windows of an odd number of rounds alternate
+        too). Returns False (and changes nothing) if the windows do not line up
+        '''
+        keys=[window['key'] for window in self._windows]
+        middle=len(keys)//2
+        for period in _WINDOW_PERIODS:
+            if middle+period>=len(keys) or keys[middle]!=keys[middle+period]:
+                continue
+            first=middle
+            while first>0 and keys[first-1]==keys[first-1+period]:
+                first-=1
+            end=middle+period+1
+            while end<len(keys) and keys[end]==keys[end-period]:
+                end+=1
+            if end-first>=2*period:
+                break
+        else: # no repeating windows to reuse
+            return False
+
+        detector_rounds=np.asarray(detector_rounds, dtype=np.int64)
+        schedule=list(self._schedule(detector_rounds))
+        tail=len(keys)-end
+        if len(schedule)<len(keys) or (len(schedule)-len(keys))%period:
+            return False
+        windows=[]
+        for k, (first_round, end_round, commit_end, start, stop, committed) in enumerate(schedule):
+            if k<first:
+                template=self._windows[k]
+            elif k>=len(schedule)-tail:
+                template=self._windows[k-len(schedule)+len(keys)]
+            else:
+                template=self._windows[first+(k-first)%period]
+            offset=start-template['detectors'][0]
+            if (stop-start!=template['detectors'][1]-template['detectors'][0] or committed-offset!=template['committed']
+                    or end_round-first_round!=template['num_rounds'] or commit_end-first_round!=template['committed_rounds']):
+                return False
+            windows.append({**template, 'first_round': first_round, 'detectors': (start, stop),
+                            'committed': committed, 'flips': template['flips']+offset})
+
+        self.detector_rounds=detector_rounds
+        self.num_detectors=len(detector_rounds)
+        self._windows=windows
+        self._seconds=np.zeros(len(windows), dtype=np.float64)
+        return True
+
+
+def _shortened_circuit(circuit, commit_rounds, buffer_rounds):
+    '''
+    The circuit with its REPEAT block cut down to a few windows' worth of
+    repetitions, by a multiple of every window period times commit_rounds, or None if it has no single
+    top-level REPEAT block long enough to be worth it
+    '''
+    repeats=[k for k, op in enumerate(circuit) if isinstance(op, stim.CircuitRepeatBlock)]
+    if len(repeats)!=1:
+        return None
+    block=circuit[repeats[0]]
+    # room for the first windows, a few windows of the REPEAT block and the last windows
+    step=commit_rounds*max(_WINDOW_PERIODS)
+    kept=2*max(_WINDOW_PERIODS)*(commit_rounds+buffer_rounds)+step
+    cut=step*((block.repeat_count-kept)//step)
+    if cut<=0:
+        return None
+    shortened=stim.Circuit()
+    for k, op in enumerate(circuit):
+        shortened.append(stim.CircuitRepeatBlock(block.repeat_count-cut, block.body_copy()) if k==repeats[0] else op)
+    return shortened
+
+
+def _window_matching(arrays, edge_probabilities):
+    check_matrix, faults_matrix=check_matrices(arrays)
+    edge_probabilities=np.clip(edge_probabilities, 1e-300, 0.5)
+    return pymatching.Matching.from_check_matrix(
+        check_matrix,
+        weights=np.log((1-edge_probabilities)/edge_probabilities),
+        error_probabilities=edge_probabilities,
+        faults_matrix=faults_matrix,
+        use_virtual_boundary_node=True,
+    )
+
+
+def _unpack_range(shots, start, stop):
+    '''
+    The detection events of detectors start..stop-1 of bit-packed shots, as booleans
+    '''
+    first_byte=start>>3
+    last_byte=packed_width(stop)
+    bits=np.unpackbits(shots[:, first_byte:last_byte], axis=1, bitorder='little')
+    offset=start-8*first_byte
+    return bits[:, offset:offset+stop-start].astype(bool)
@@ -0,0 +1,216 @@
+'''
+Threshold sweeps of the heavy-hex code
+
+The circuits of the sweep points are built in a process pool and streamed into
+sinter.collect as they finish. The statistics are appended to a resumable CSV
+file, so a sweep that is interrupted can be started again with the same
+arguments and only the missing shots are taken.
+
+The basis 'XZ' runs the X and the Z memory experiment of a point as one
+circuit (see HeavyHexCode), so a sweep over both bases has half the tasks --
+one detector error model, one sampler and one matching graph per point. The
+statistics of an 'XZ' task are split into an 'X' and a 'Z' one by
+split_dual_basis, which sweep does before returning them.
+
+Example (sinter uses multiprocessing, so run it under a __main__ guard):
+
+    import numpy as np
+    import heavy_hex_code
+
+    if __name__=='__main__':
+        stats=heavy_hex_code.sweep([3, 5, 7], np.geomspace(1e-4, 1e-2, 7), ['XZ'],
+                                   save_resume_filepath='heavy_hex_stats.csv')
+'''
+import collections
+import concurrent.futures
+import os
+
+import sinter
+
+from heavy_hex_code import HeavyHexCode
+
+BASES=('X', 'Z', 'XZ')
+# the observable of every basis of an 'XZ' circuit
+DUAL_BASIS_OBSERVABLES=(('X', 0), ('Z', 1))
+
+
+def uniform_noise(p):
+    '''
+    The noise of the threshold plots -- every error parameter set to p
+    '''
+    return {
+        'after_clifford_depolarization': p,
+        'after_reset_flip_probability': p,
+        'before_measure_flip_probability': p,
+        'before_round_data_depolarization': p,
+    }
+
+
+def sweep_points(distances, ps, bases, rounds=None):
+    '''
+    Returns the (d, rounds, basis, p) points of a sweep, in a fixed order
+
+    Args:
+    distances: The code distances
+    ps: The physical error rates
+    bases: The memory bases, 'X', 'Z' or 'XZ' for both in one circuit
+    rounds: The number of rounds -- None for d rounds, an int, or a function of d
+    '''
+    points=[]
+    for d in distances:
+        if rounds is None:
+            num_rounds=d
+        elif callable(rounds):
+            num_rounds=rounds(d)
+        else:
+            num_rounds=rounds
+        for basis in bases:
+            if basis not in BASES:
+                raise ValueError("Invalid basis")
+            for p in ps:
+                points.append((int(d), int(num_rounds), basis, float(p)))
+    return points
+
+
+def build_task(point, noise=uniform_noise, dem_cache=None):
+    '''
+    Builds the sinter task of one sweep point
+
+    Args:
+    point: A (d, rounds, basis, p) tuple
+    noise: Maps p to the error parameters of HeavyHexCode
+    dem_cache: A dem_cache.DemCache to take the detector error model from, or
+    None to let the sinter workers build it
+    '''
+    d, num_rounds, basis, p=point
+    circuit=HeavyHexCode(
+        code_distance=d,
+        num_rounds=num_rounds,
+        basis=basis,
+        **noise(p),
+    ).create_heavy_hex_code(backend='stim')
+    dem=None
+    if dem_cache is not None:
+        dem=dem_cache.detector_error_model(circuit)
+    return sinter.Task(
+        circuit=circuit,
+        detector_error_model=dem,
+        json_metadata={'d': d, 'r': num_rounds, 'b': basis, 'p': p, 'name': f'heavy hex d={d}'},
+    )
+
+
+def _build_task_star(args):
+    return build_task(*args)
+
+
+def iter_tasks(points, noise=uniform_noise, build_workers=None, dem_cache=None):
+    '''
+    Yields the sinter tasks of the points, in order, building them in a process pool
+
+    Args:
+    points: The (d, rounds, basis, p) points, see sweep_points
+    noise: Maps p to the error parameters of HeavyHexCode. Must be picklable
+    when build_workers is not 1
+    build_workers: Size of the process pool -- None for one per CPU, 1 builds in this process
+    dem_cache: A dem_cache.DemCache to take the detector error models from
+    '''
+    if build_workers is None:
+        build_workers=os.cpu_count() or 1
+    build_workers=min(build_workers, len(points))
+
+    if build_workers<=1:
+        for point in points:
+            yield build_task(point, noise, dem_cache)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=build_workers) as pool:
+        yield from pool.map(_build_task_star, [(point, noise, dem_cache) for point in points])
+
+
+def split_dual_basis(stats):
+    '''
+    Returns the sinter.TaskStats with every 'XZ' task split into an 'X' and a
+    'Z' one, whose errors are the shots where that basis' observable was
+    wrong. The shots, discards and seconds of the task are the same for both,
+    and their json_metadata is that of the task with 'b' set to the basis and
+    'source': 'XZ', to tell them from the stats of single-basis tasks.
+    Needs the observable error combinations, see count_observable_error_combos
+    of sinter.collect
+    '''
+    split=[]
+    for stat in stats:
+        if stat.json_metadata.get('b')!='XZ':
+            split.append(stat)
+            continue
+        masks={key[len('obs_mistake_mask='):]: count for key, count in stat.custom_counts.items()
+               if key.startswith('obs_mistake_mask=')}
+        if stat.errors and not masks:
+            raise ValueError("The 'XZ' statistics have no observable error combinations")
+        others=collections.Counter({key: count for key, count in stat.custom_counts.items()
+                                    if not key.startswith('obs_mistake_mask=')})
+        for basis, observable in DUAL_BASIS_OBSERVABLES:
+            split.append(sinter.TaskStats(
+                strong_id=stat.strong_id+':'+basis,
+                decoder=stat.decoder,
+                json_metadata={**stat.json_metadata, 'b': basis, 'source': 'XZ'},
+                shots=stat.shots,
+                errors=sum(count for mask, count in masks.items() if mask[observable]=='E'),
+                discards=stat.discards,
+                seconds=stat.seconds,
+                custom_counts=others,
+            ))
+    return split
+
+
+def sweep(distances, ps, bases=('X', 'Z'), *,
+          rounds=None,
+          noise=uniform_noise,
+          num_workers=None,
+          build_workers=None,
+          dem_cache=None,
+          max_shots=10**7,
+          max_errors=1000,
+          decoders=('pymatching',),
+          save_resume_filepath='heavy_hex_stats.csv',
+          print_progress=False,
+          **collect_kwargs):
+    '''
+    Runs a threshold sweep of the heavy-hex code and returns the sinter.TaskStats
+
+    Args:
+    distances: The code distances
+    ps: The physical error rates
+    bases: The memory bases, 'X', 'Z' or 'XZ' for both in one circuit. The
+    stats of 'XZ' points are returned split into 'X' and 'Z' ones
+    rounds: The number of rounds -- None for d rounds, an int, or a function of d
+    noise: Maps p to the error parameters of HeavyHexCode (default: all equal to p)
+    num_workers: Number of sinter sampling workers (default: all CPUs but two)
+    build_workers: Size of the circuit building pool (default: one per CPU)
+    dem_cache: A dem_cache.DemCache -- the detector error models of points seen
+    before are then loaded instead of rebuilt by every sinter worker
+    max_shots: Shots per point
+    max_errors: Errors per point
+    decoders: The sinter decoders
+    save_resume_filepath: The CSV file the statistics are appended to as they
+    come in. Running the same sweep again resumes from it. None disables it
+    print_progress: Print sinter's progress to stderr
+    collect_kwargs: Passed on to sinter.collect
+    '''
+    points=sweep_points(distances, ps, bases, rounds)
+    if num_workers is None:
+        num_workers=max(1, (os.cpu_count() or 1)-2)
+    if 'XZ' in bases:
+        collect_kwargs.setdefault('count_observable_error_combos', True)
+
+    stats=sinter.collect(
+        num_workers=num_workers,
+        tasks=iter_tasks(points, noise, build_workers, dem_cache),
+        hint_num_tasks=len(points),
+        max_shots=max_shots,
+        max_errors=max_errors,
+        decoders=list(decoders),
+        save_resume_filepath=save_resume_filepath,
+        print_progress=print_progress,
+        **collect_kwargs,
+    )
+    return split_dual_basis(stats)
@@ -0,0 +1,377 @@
+'''
+On-disk store of sampled shots and decoder predictions, for paired decoder comparisons
+
+The shots of a seeding.ShotStream are sampled once, kept on disk chunk by
+chunk, and read back memory-mapped, so every decoder run over the stream
+sees exactly the same detection events. The predictions of every decoder
+are kept next to them under a name of your choice, and compare counts the
+shots that one decoder got wrong and the other did not. With paired shots
+the difference of two logical error rates is resolved with far fewer shots
+than from two independent samples, and sampling is paid for only once.
+
+The store is keyed by the circuit hash and the seed range of the stream:
+
+<circuit hash>/seed-<master seed>-chunk-<chunk size>/
+    <k>.detection_events.npy       chunk k of the stream, bit-packed
+    <k>.observables.npy
+    <k>.<name>.<fingerprint>.predictions.npy
+                                   the bit-packed predictions of a decoder on chunk k
+
+The fingerprint (decoder_fingerprint, cut to 16 hex digits) is the hash of
+the class of the decoder and of the matching graphs, arrays and options it
+holds. Predictions are reused only by a decoder with the same fingerprint:
+after a change to the detector error model or the options of a decoder the
+chunks are decoded again, and the stale predictions replaced. compare
+raises ValueError on predictions of one name made by different decoders.
+
+Chunks are kept whole, chunk_size shots each, whatever the number of shots
+asked for. Files are written atomically (temporary file + os.replace), so
+the worker processes of a sweep can share a store.
+
+Example:
+
+    from seeding import ShotStream
+    from batch_decoders import compile_decoder
+
+    store=SyndromeStore()
+    stream=ShotStream(circuit, master_seed=0)
+    store.decode(stream, 10**6, compile_decoder(circuit, 'pymatching'), 'pymatching')
+    store.decode(stream, 10**6, compile_decoder(circuit, 'union_find'), 'union_find')
+    print(store.compare(stream, 10**6, 'pymatching', 'union_find'))
+'''
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pymatching
+import scipy.sparse
+import scipy.stats
+import stim
+
+from decoders import DecodingStats, count_mistakes, wilson_interval
+from dem_cache import circuit_hash, matching_to_arrays
+
+DEFAULT_STORE_DIRECTORY=os.path.join(os.path.expanduser('~'), '.cache', 'heavy_hex_code', 'syndromes')
+
+
+class PairedComparison:
+    '''
+    Logical errors of decoders a and b on the same shots
+    '''
+
+    def __init__(self, *, shots, errors_a, errors_b, only_a, only_b):
+        self.shots=shots
+        self.errors_a=errors_a
+        self.errors_b=errors_b
+        self.only_a=only_a # shots that a got wrong and b got right
+        self.only_b=only_b
+
+    @property
+    def difference(self):
+        '''
+        The logical error rate of a minus that of b
+        '''
+        return (self.errors_a-self.errors_b)/self.shots if self.shots else 0.0
+
+    @property
+    def p_value(self):
+        '''
+        The two-sided exact McNemar p-value of a and b having the same
+        logical error rate
+        '''
+        discordant=self.only_a+self.only_b
+        if discordant==0:
+            return 1.0
+        return float(scipy.stats.binomtest(self.only_a, discordant, 0.5).pvalue)
+
+    def rate_intervals(self, z=1.96):
+        '''
+        The Wilson score intervals of the logical error rates of a and b
+        '''
+        return wilson_interval(self.errors_a, self.shots, z), wilson_interval(self.errors_b, self.shots, z)
+
+    def __add__(self, other):
+        return PairedComparison(
+            shots=self.shots+other.shots,
+            errors_a=self.errors_a+other.errors_a,
+            errors_b=self.errors_b+other.errors_b,
+            only_a=self.only_a+other.only_a,
+            only_b=self.only_b+other.only_b,
+        )
+
+    def __repr__(self):
+        return (f"PairedComparison(shots={self.shots}, errors_a={self.errors_a}, errors_b={self.errors_b}, "
+                f"only_a={self.only_a}, only_b={self.only_b}, p_value={self.p_value:.3g})")
+
+
+class SyndromeStore:
+    '''
+    Shots of shot streams and the predictions of decoders on them, on disk
+    '''
+
+    def __init__(self, directory=None):
+        '''
+        Args:
+        directory: Where the store is kept (default: $HEAVY_HEX_SYNDROME_STORE
+        or ~/.cache/heavy_hex_code/syndromes)
+        '''
+        if directory is None:
+            directory=os.environ.get('HEAVY_HEX_SYNDROME_STORE', DEFAULT_STORE_DIRECTORY)
+        self.directory=directory
+        os.makedirs(self.directory, exist_ok=True)
+
+    def stream_directory(self, stream):
+        '''
+        The directory of the chunks of a seeding.ShotStream
+        '''
+        key=circuit_hash(stream.circuit)
+        name=f'seed-{stream.master_seed}-chunk-{stream.chunk_size}'
+        if stream.task_key!=key: # a stream with a task key of its own
+            name+='-task-'+re.sub(r'[^A-Za-z0-9_.+-]', '_', stream.task_key)
+        return os.path.join(self.directory, key, name)
+
+    def iter_chunks(self, stream, num_shots, *, first_chunk=0):
+        '''
+        Yields the memory-mapped, bit-packed (detection_events, observables)
+        chunks of the stream, like ShotStream.iter_chunks. Chunks not in the
+        store yet are sampled and written first
+        '''
+        directory=self.stream_directory(stream)
+        for chunk_index, count in _chunk_counts(stream, num_shots, first_chunk):
+            detection_events, observables=self._chunk(stream, directory, chunk_index)
+            yield detection_events[:count], observables[:count]
+
+    def decode(self, stream, num_shots, decoder, name, *, first_chunk=0, decode_kwargs=None, fingerprint=None):
+        '''
+        Decodes shots of the stream and keeps the predictions under name
+
+        Predictions already in the store are reused, not decoded again, if
+        they were made by a decoder with the same fingerprint; those of another
+        decoder are replaced. Returns the DecodingStats; their decode_seconds
+        count the decoding done by this call only, and sample_seconds the
+        sampling and reading
+
+        Args:
+        stream: The seeding.ShotStream
+        num_shots: Number of shots to decode
+        decoder: A pymatching.Matching or any decoder with its decode_batch
+        name: The name the predictions are kept under, e.g. 'union_find'
+        first_chunk: The chunk to start at
+        decode_kwargs: Extra keyword arguments for decode_batch
+        fingerprint: A string identifying the decoder (default: decoder_fingerprint(decoder))
+        '''
+        _check_name(name)
+        decode_kwargs=decode_kwargs or {}
+        if fingerprint is None:
+            fingerprint=decoder_fingerprint(decoder)
+        fingerprint=_short_fingerprint(fingerprint)
+        directory=self.stream_directory(stream)
+        num_observables=stream.circuit.num_observables
+        stats=DecodingStats(shots=0, errors=0, observable_errors=np.zeros(num_observables, dtype=np.int64),
+                            sample_seconds=0.0, decode_seconds=0.0)
+        for chunk_index, count in _chunk_counts(stream, num_shots, first_chunk):
+            t0=time.perf_counter()
+            detection_events, observables=self._chunk(stream, directory, chunk_index)
+            path=_predictions_path(directory, chunk_index, name, fingerprint)
+            predictions=np.load(path, mmap_mode='r') if os.path.exists(path) else None
+            t1=time.perf_counter()
+            if predictions is None:
+                predictions=decoder.decode_batch(np.asarray(detection_events), bit_packed_shots=True,
+                                                 bit_packed_predictions=True, **decode_kwargs)
+                t2=time.perf_counter()
+                _save(path, predictions)
+                for stale in _predictions_paths(directory, chunk_index, name):
+                    if stale!=path:
+                        _remove(stale)
+            else:
+                t2=t1
+
+            errors, per_observable=count_mistakes(predictions[:count], observables[:count], num_observables)
+            stats+=DecodingStats(shots=count, errors=errors, observable_errors=per_observable,
+                                 sample_seconds=t1-t0, decode_seconds=t2-t1)
+        return stats
+
+    def compare(self, stream, num_shots, name_a, name_b, *, first_chunk=0):
+        '''
+        Returns the PairedComparison of the predictions kept under name_a and
+        name_b (see decode) on shots of the stream
+
+        Raises ValueError if the predictions of a name were not all made by
+        the same decoder, e.g. when decode was interrupted after a change to
+        the decoder
+        '''
+        directory=self.stream_directory(stream)
+        comparison=PairedComparison(shots=0, errors_a=0, errors_b=0, only_a=0, only_b=0)
+        fingerprints={}
+        for chunk_index, count in _chunk_counts(stream, num_shots, first_chunk):
+            observables=self._chunk(stream, directory, chunk_index)[1][:count]
+            wrong=[]
+            for name in (name_a, name_b):
+                paths=_predictions_paths(directory, chunk_index, name)
+                if not paths:
+                    raise FileNotFoundError(f"no predictions of {name!r} for chunk {chunk_index}, run decode first")
+                found={_path_fingerprint(path) for path in paths}|fingerprints.setdefault(name, set())
+                if len(found)>1:
+                    raise ValueError(f"the predictions of {name!r} were made by different decoders "
+                                     f"({', '.join(sorted(found))}), run decode again")
+                fingerprints[name]=found
+                wrong.append(_mistaken(np.load(paths[0], mmap_mode='r')[:count], observables))
+            wrong_a, wrong_b=wrong
+            comparison+=PairedComparison(
+                shots=count,
+                errors_a=int(np.count_nonzero(wrong_a)),
+                errors_b=int(np.count_nonzero(wrong_b)),
+                only_a=int(np.count_nonzero(wrong_a&~wrong_b)),
+                only_b=int(np.count_nonzero(wrong_b&~wrong_a)),
+            )
+        return comparison
+
+    def size_bytes(self):
+        '''
+        Total size of the files in the store
+        '''
+        return sum(os.path.getsize(os.path.join(root, name))
+                   for root, _, names in os.walk(self.directory) for name in names)
+
+    def clear(self, stream=None):
+        '''
+        Removes the chunks and predictions of a stream, or of every stream
+        '''
+        directory=self.directory if stream is None else self.stream_directory(stream)
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
+
+    # internals
+    def _chunk(self, stream, directory, chunk_index):
+        paths=[os.path.join(directory, f'{chunk_index:07d}.{part}.npy') for part in ('detection_events', 'observables')]
+        if not all(os.path.exists(path) for path in paths):
+            os.makedirs(directory, exist_ok=True)
+            for path, array in zip(paths, stream.chunk(chunk_index)):
+                _save(path, array)
+        return tuple(np.load(path, mmap_mode='r') for path in paths)
+
+
+def decoder_fingerprint(decoder):
+    '''
+    The sha256 hex digest of what the predictions of a decoder depend on: its
+    class and the matching graphs, arrays, detector error models and options
+    it holds, nested objects included
+
+    The attributes named in the _fingerprint_skip of a class (counters of the
+    shots decoded, caches filled while decoding) are left out, and so is the
+    state of objects that keep none in Python attributes (e.g. the decoders of
+    the ldpc package), of which only the class counts
+
+    Args:
+    decoder: A pymatching.Matching or any decoder with its decode_batch
+    '''
+    digest=hashlib.sha256()
+    _update_fingerprint(digest, decoder)
+    return digest.hexdigest()
+
+
+def _update_fingerprint(digest, value):
+    if value is None or isinstance(value, (bool, int, float, complex, str, bytes)):
+        digest.update(f'{type(value).__name__}:{value!r};'.encode())
+    elif isinstance(value, (np.ndarray, np.generic)):
+        array=np.ascontiguousarray(value)
+        digest.update(f'array:{array.dtype.str}:{array.shape};'.encode())
+        digest.update(array.tobytes())
+    elif isinstance(value, (list, tuple)):
+        digest.update(f'{type(value).__name__}:{len(value)};'.encode())
+        for item in value:
+            _update_fingerprint(digest, item)
+    elif isinstance(value, dict):
+        digest.update(f'dict:{len(value)};'.encode())
+        for key in sorted(value, key=repr):
+            _update_fingerprint(digest, key)
+            _update_fingerprint(digest, value[key])
+    elif isinstance(value, pymatching.Matching):
+        digest.update(b'pymatching.Matching;')
+        _update_fingerprint(digest, matching_to_arrays(value))
+    elif isinstance(value, (stim.DetectorErrorModel, stim.Circuit)):
+        digest.update(f'{type(value).__name__}:{value};'.encode())
+    elif scipy.sparse.issparse(value):
+        matrix=scipy.sparse.csr_matrix(value)
+        _update_fingerprint(digest, ('csr', matrix.shape, matrix.data, matrix.indices, matrix.indptr))
+    else:
+        cls=type(value)
+        digest.update(f'{cls.__module__}.{cls.__qualname__};'.encode())
+        skip=getattr(cls, '_fingerprint_skip', ())
+        attributes=getattr(value, '__dict__', {})
+        _update_fingerprint(digest, {key: item for key, item in attributes.items() if key not in skip})
+
+
+def _chunk_counts(stream, num_shots, first_chunk):
+    '''
+    The (chunk index, shots used) of the chunks holding num_shots shots from first_chunk on
+    '''
+    chunk_index=first_chunk
+    remaining=num_shots
+    while remaining>0:
+        yield chunk_index, min(remaining, stream.chunk_size)
+        remaining-=stream.chunk_size
+        chunk_index+=1
+
+
+def _mistaken(predictions, observables):
+    '''
+    Whether each shot has any observable predicted wrong
+    '''
+    if predictions.shape[1]<observables.shape[1]: # the matching graph may not know about every observable
+        predictions=np.pad(predictions, ((0, 0), (0, observables.shape[1]-predictions.shape[1])))
+    return np.any(np.bitwise_xor(predictions, observables), axis=1)
+
+
+def _check_name(name):
+    if not re.fullmatch(r'[A-Za-z0-9_+-]+', name):
+        raise ValueError(f"decoder name {name!r} must be letters, digits, '_', '+' or '-'")
+
+
+def _short_fingerprint(fingerprint):
+    fingerprint=str(fingerprint)
+    if not re.fullmatch(r'[A-Za-z0-9_+-]+', fingerprint):
+        raise ValueError(f"decoder fingerprint {fingerprint!r} must be letters, digits, '_', '+' or '-'")
+    return fingerprint[:16]
+
+
+def _predictions_path(directory, chunk_index, name, fingerprint):
+    return os.path.join(directory, f'{chunk_index:07d}.{name}.{fingerprint}.predictions.npy')
+
+
+def _predictions_paths(directory, chunk_index, name):
+    '''
+    The paths of the predictions of chunk_index kept under name, whatever their fingerprint
+    '''
+    if not os.path.isdir(directory):
+        return []
+    prefix=f'{chunk_index:07d}.{name}.'
+    return sorted(os.path.join(directory, file_name) for file_name in os.listdir(directory)
+                  if file_name.startswith(prefix) and file_name.endswith('.predictions.npy')
+                  and file_name.count('.')==4)
+
+
+def _path_fingerprint(path):
+    return os.path.basename(path).split('.')[2]
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _save(path, array):
+    fd, tmp_path=tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+    except BaseException:
+        _remove(tmp_path)
+        raise